@@ -0,0 +1,74 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Compares sending one message per changed file (the old behaviour of "!gitlab commit diff") with
+packing files into size-capped messages with pack_diff_messages.
+
+Run from the repository root: python benchmarks/bench_diff_packing.py
+"""
+from typing import List, Tuple
+import random
+import json
+import time
+
+from gitlab_matrix.util.diff import highlight_diff_lines, pack_diff_messages
+
+MAX_EVENT_SIZE = 65536
+
+
+def synthetic_diff(rng: random.Random, lines: int) -> str:
+    output = [f"@@ -1,{lines} +1,{lines} @@"]
+    for _ in range(lines):
+        text = "".join(rng.choice("abcdefgh <>&\"漢字") for _ in range(rng.randint(10, 100)))
+        output.append(rng.choice("+- ") + text)
+    return "\n".join(output)
+
+
+def event_size(html: str) -> int:
+    return len(json.dumps({"msgtype": "m.text", "format": "org.matrix.custom.html",
+                           "body": html, "formatted_body": html}))
+
+
+def main() -> None:
+    rng = random.Random(0)
+    # Many small files and a few big ones, like a typical refactoring commit.
+    files: List[Tuple[str, str]] = [
+        (f"src/module{n}.py",
+         synthetic_diff(rng, rng.choices([3, 5, 10, 20, 40, 1000], [30, 30, 20, 10, 8, 2])[0]))
+        for n in range(300)
+    ]
+    highlighted = [(path, highlight_diff_lines(diff)) for path, diff in files]
+
+    start = time.perf_counter()
+    per_file = [f"{path}:\n<pre><code>{chr(10).join(lines)}</code></pre>"
+                for path, lines in highlighted]
+    per_file_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    packed = list(pack_diff_messages(((path, list(lines)) for path, lines in highlighted),
+                                     24000))
+    packed_time = time.perf_counter() - start
+
+    for name, messages, duration in (("one per file", per_file, per_file_time),
+                                     ("packed", packed, packed_time)):
+        sizes = [event_size(msg) for msg in messages]
+        too_large = sum(size > MAX_EVENT_SIZE for size in sizes)
+        print(f"{name:>12}: {len(messages):4} messages, largest {max(sizes):7} bytes, "
+              f"{too_large} over the event size limit, {duration * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
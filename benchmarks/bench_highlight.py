@@ -0,0 +1,71 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Compares the diff highlighter with the per-line closure that "!gitlab commit diff" used
+before, with and without the HTML escaping it was missing.
+
+Run from the repository root: python benchmarks/bench_highlight.py
+"""
+from html import escape
+import random
+import timeit
+import re
+
+from gitlab_matrix.util.diff import highlight_diff_lines
+
+
+def old_color_diff(line: str) -> str:
+    if line.startswith("@@") and re.fullmatch(r"(@@ -[0-9]+,[0-9]+ \+[0-9]+,[0-9]+ @@)", line):
+        return f"<font color='#00A'>{line}</font>"
+    elif line.startswith(("+++", "---")):
+        return f"<font color='#000'>{line}</font>"
+    elif line.startswith("+"):
+        return f"<font color='#0A0'>{line}</font>"
+    elif line.startswith("-"):
+        return f"<font color='#A00'>{line}</font>"
+    else:
+        return f"<font color='#666'>{line}</font>"
+
+
+def old_highlight(diff: str) -> list:
+    return [old_color_diff(line) for line in diff.split("\n")]
+
+
+def old_highlight_escaped(diff: str) -> list:
+    return [old_color_diff(escape(line, quote=False)) for line in diff.split("\n")]
+
+
+def synthetic_diff(lines: int) -> str:
+    rng = random.Random(0)
+    output = ["--- a/file.py", "+++ b/file.py"]
+    for n in range(lines):
+        if n % 50 == 0:
+            output.append(f"@@ -{n},50 +{n},50 @@")
+        text = "".join(rng.choice("abcdefgh    ()<>&") for _ in range(rng.randint(10, 80)))
+        output.append(rng.choice("+-  ") + text)
+    return "\n".join(output)
+
+
+def main() -> None:
+    diff = synthetic_diff(100_000)
+    for name, func in (("old", old_highlight), ("old + escaping", old_highlight_escaped),
+                       ("highlight_diff_lines", highlight_diff_lines)):
+        best = min(timeit.repeat(lambda: func(diff), number=1, repeat=5))
+        print(f"{name:>20}: {best * 1000:6.1f} ms for 100k lines")
+
+
+if __name__ == "__main__":
+    main()
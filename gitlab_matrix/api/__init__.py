@@ -0,0 +1,8 @@
+from .client import GitlabAPI, GitlabClient
+from .errors import (GitlabError, GitlabAuthError, GitlabNotFound, GitlabBusy, GitlabUnavailable,
+                     GitlabGraphQLError)
+from .scheduler import RequestScheduler
+from .breaker import CircuitBreaker, BreakerState
+from .pagination import Paginator
+from .types import (APIProject, APIIssue, APIMergeRequest, APINote, APICommit, APIDiff, APIHook,
+                    APIEvent, APIPushData, APIEventNote)
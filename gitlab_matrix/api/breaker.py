@@ -0,0 +1,95 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Awaitable, Callable, Optional
+from enum import Enum
+import logging as log
+import asyncio
+import time
+
+from .errors import GitlabUnavailable
+
+Probe = Callable[[], Awaitable[bool]]
+
+
+class BreakerState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a GitLab server after several consecutive failures. While the
+    circuit is open, a background task probes the server and closes the circuit once it
+    responds again.
+    """
+    server: str
+    failure_threshold: int
+    probe_interval: float
+    state: BreakerState
+    failures: int
+    opened_at: Optional[float]
+    _probe: Probe
+    _probe_task: Optional[asyncio.Task]
+
+    def __init__(self, server: str, probe: Probe, failure_threshold: int = 5,
+                 probe_interval: float = 30) -> None:
+        self.server = server
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.state = BreakerState.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._probe = probe
+        self._probe_task = None
+
+    def check(self) -> None:
+        if self.state != BreakerState.CLOSED:
+            raise GitlabUnavailable(self.server, time.monotonic() - self.opened_at)
+
+    def record_success(self) -> None:
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == BreakerState.CLOSED and self.failures >= self.failure_threshold:
+            log.warning(f"{self.server} failed {self.failures} times in a row, "
+                        "pausing requests to it")
+            self.state = BreakerState.OPEN
+            self.opened_at = time.monotonic()
+            self._probe_task = asyncio.create_task(self._probe_loop())
+
+    async def _probe_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            self.state = BreakerState.HALF_OPEN
+            try:
+                alive = await self._probe()
+            except Exception:
+                alive = False
+            if alive:
+                log.info(f"{self.server} is reachable again, resuming requests to it")
+                self.state = BreakerState.CLOSED
+                self.failures = 0
+                self.opened_at = None
+                self._probe_task = None
+                return
+            self.state = BreakerState.OPEN
+
+    def stop(self) -> None:
+        if self._probe_task:
+            self._probe_task.cancel()
+            self._probe_task = None
@@ -0,0 +1,47 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, NamedTuple, Optional, Union
+import time
+
+from .types import APIProject
+
+CachedProject = NamedTuple('CachedProject', project=APIProject, etag=Optional[str],
+                           fetched_at=float)
+
+
+class ProjectCache:
+    """Caches project metadata of a single GitLab server by both path and ID."""
+    ttl: float
+    _projects: Dict[str, CachedProject]
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self._projects = {}
+
+    @staticmethod
+    def _key(project: Union[str, int]) -> str:
+        return str(project).strip("/").lower()
+
+    def get(self, project: Union[str, int]) -> Optional[CachedProject]:
+        return self._projects.get(self._key(project))
+
+    def is_fresh(self, cached: CachedProject) -> bool:
+        return time.monotonic() - cached.fetched_at < self.ttl
+
+    def put(self, project: APIProject, etag: Optional[str] = None) -> None:
+        cached = CachedProject(project=project, etag=etag, fetched_at=time.monotonic())
+        self._projects[self._key(project.id)] = cached
+        self._projects[self._key(project.path_with_namespace)] = cached
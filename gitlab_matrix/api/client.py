@@ -0,0 +1,515 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Dict, List, NoReturn, Optional, Set, Tuple, Union
+from functools import partial
+from urllib.parse import quote
+import logging as log
+import asyncio
+import hashlib
+import time
+
+from aiohttp import (ClientResponse, ClientSession, ClientTimeout, TCPConnector,
+                     ClientConnectionError)
+from multidict import CIMultiDictProxy
+from yarl import URL
+
+from mautrix.types import JSON
+
+from ..db import AuthInfo
+from ..types import GitlabUser
+from .types import (APIProject, APIIssue, APIMergeRequest, APINote, APICommit, APIDiff, APIHook,
+                    APIEvent)
+from .errors import GitlabError, GitlabAuthError, GitlabNotFound, GitlabGraphQLError
+from .scheduler import RequestScheduler
+from .cache import ProjectCache
+from .breaker import CircuitBreaker
+from .pagination import Paginator
+from .graphql import ISSUE_DETAILS_QUERY, issue_from_graphql, note_from_graphql
+
+ProjectRef = Union[str, int]
+# Error codes that mean the query doesn't match the server's schema, i.e. the GitLab version is
+# too old for it, rather than that something went wrong with this particular request.
+GRAPHQL_SCHEMA_ERRORS = {"undefinedField", "undefinedType", "argumentNotAccepted",
+                         "argumentLiteralsIncompatible", "variableMismatch"}
+# How long a successful project access check is trusted for a single token, in seconds.
+PROJECT_ACCESS_TTL = 60
+
+
+class GitlabClient:
+    url: str
+    api_token: str
+    http: ClientSession
+    scheduler: RequestScheduler
+    breaker: CircuitBreaker
+    projects: ProjectCache
+    owner: str
+    max_retries: int
+    use_graphql: bool
+    user: Optional[GitlabUser]
+    auth_failed: bool
+    last_used: float
+    _project_access: Dict[str, float]
+
+    def __init__(self, url: str, api_token: str, http: ClientSession,
+                 scheduler: RequestScheduler, breaker: CircuitBreaker, projects: ProjectCache,
+                 owner: str, max_retries: int = 3, use_graphql: bool = True) -> None:
+        self.url = url.rstrip("/")
+        self.api_token = api_token
+        self.http = http
+        self.scheduler = scheduler
+        self.breaker = breaker
+        self.projects = projects
+        self.owner = owner
+        self.max_retries = max_retries
+        self.use_graphql = use_graphql
+        self.user = None
+        self.auth_failed = False
+        self.last_used = time.monotonic()
+        self._project_access = {}
+
+    @staticmethod
+    def _project_path(project: ProjectRef) -> str:
+        return f"projects/{quote(str(project), safe='')}"
+
+    @staticmethod
+    def _group_path(group: ProjectRef) -> str:
+        return f"groups/{quote(str(group), safe='')}"
+
+    async def request(self, method: str, path: str, query: Optional[Dict[str, Any]] = None,
+                      data: Optional[JSON] = None) -> JSON:
+        _, _, body = await self.request_raw(method, path, query, data)
+        return body
+
+    async def request_raw(self, method: str, path: str, query: Optional[Dict[str, Any]] = None,
+                          data: Optional[JSON] = None, headers: Optional[Dict[str, str]] = None,
+                          prefix: str = "api/v4"
+                          ) -> Tuple[int, CIMultiDictProxy, Optional[JSON]]:
+        url = URL(f"{self.url}/{prefix}/{path}", encoded=True)
+        headers = {**(headers or {}), "PRIVATE-TOKEN": self.api_token}
+        for attempt in range(self.max_retries + 1):
+            self.breaker.check()
+            async with self.scheduler.slot(self.owner):
+                try:
+                    resp = await self.http.request(method, url, params=query, json=data,
+                                                   headers=headers)
+                except (ClientConnectionError, asyncio.TimeoutError):
+                    self.breaker.record_failure()
+                    raise
+                async with resp:
+                    if resp.status >= 500:
+                        self.breaker.record_failure()
+                    else:
+                        self.breaker.record_success()
+                    self.scheduler.update(resp.status, resp.headers, attempt)
+                    if resp.status == 429 and attempt < self.max_retries:
+                        continue
+                    elif resp.status >= 400:
+                        await self._raise_error(resp)
+                    elif resp.status == 304:
+                        return resp.status, resp.headers, None
+                    return resp.status, resp.headers, await resp.json()
+
+    async def _raise_error(self, resp: ClientResponse) -> NoReturn:
+        try:
+            body = await resp.json()
+            message = body.get("message") or body.get("error") or resp.reason
+        except Exception:
+            message = resp.reason
+        if resp.status == 401:
+            # Make the pool replace this client instead of reusing it.
+            self.auth_failed = True
+            self.user = None
+            raise GitlabAuthError(resp.status, str(message))
+        elif resp.status == 404:
+            raise GitlabNotFound(resp.status, str(message))
+        raise GitlabError(resp.status, str(message))
+
+    async def graphql(self, query: str, variables: Dict[str, Any]) -> JSON:
+        _, _, body = await self.request_raw("POST", "graphql", prefix="api",
+                                            data={"query": query, "variables": variables})
+        if body.get("errors"):
+            schema_error = any((error.get("extensions") or {}).get("code") in GRAPHQL_SCHEMA_ERRORS
+                               for error in body["errors"])
+            raise GitlabGraphQLError(200, "; ".join(error.get("message", "unknown error")
+                                                    for error in body["errors"]),
+                                     schema_error=schema_error)
+        return body["data"]
+
+    async def get_current_user(self) -> GitlabUser:
+        if not self.user:
+            self.user = GitlabUser.deserialize(await self.request("GET", "user"))
+        return self.user
+
+    async def get_project(self, project: ProjectRef) -> APIProject:
+        """
+        Get the metadata of a project. The project cache is shared by all logins on the server,
+        so a cached project is only returned as-is if this client's token could read it
+        recently. Otherwise it's revalidated with this token, which is cheap thanks to the ETag.
+        """
+        cached = self.projects.get(project)
+        if cached and self.projects.is_fresh(cached) and self._has_access(project):
+            return cached.project
+        headers = {"If-None-Match": cached.etag} if cached and cached.etag else None
+        status, resp_headers, data = await self.request_raw("GET", self._project_path(project),
+                                                            headers=headers)
+        if status == 304:
+            info, etag = cached.project, cached.etag
+        else:
+            info, etag = APIProject.deserialize(data), resp_headers.get("ETag")
+        self.projects.put(info, etag)
+        self._remember_access(info)
+        return info
+
+    def _has_access(self, project: ProjectRef) -> bool:
+        checked_at = self._project_access.get(str(project).strip("/").lower())
+        return checked_at is not None and time.monotonic() - checked_at < PROJECT_ACCESS_TTL
+
+    def _remember_access(self, project: APIProject) -> None:
+        now = time.monotonic()
+        self._project_access[str(project.id)] = now
+        self._project_access[project.path_with_namespace.lower()] = now
+
+    async def can_access_project(self, project: ProjectRef) -> bool:
+        """Check whether this client's token can read a project."""
+        try:
+            await self.get_project(project)
+        except GitlabError as e:
+            # GitLab answers 404 for private projects the token can't see.
+            if e.status in (403, 404):
+                return False
+            raise
+        return True
+
+    async def create_project_hook(self, project: ProjectRef, hook: JSON) -> APIHook:
+        path = f"{self._project_path(project)}/hooks"
+        return APIHook.deserialize(await self.request("POST", path, data=hook))
+
+    async def list_project_events(self, project: ProjectRef, etag: Optional[str] = None,
+                                  per_page: int = 100
+                                  ) -> Tuple[Optional[str], Optional[List[APIEvent]]]:
+        """
+        Get the newest events of a project. Returns the new ETag, and ``None`` instead of the
+        events if they haven't changed since ``etag``.
+        """
+        path = f"{self._project_path(project)}/events"
+        headers = {"If-None-Match": etag} if etag else None
+        status, resp_headers, events = await self.request_raw("GET", path, headers=headers,
+                                                              query={"per_page": per_page})
+        if status == 304:
+            return etag, None
+        return resp_headers.get("ETag"), [APIEvent.deserialize(evt) for evt in events]
+
+    async def list_group_projects(self, group: ProjectRef, page: int = 1, per_page: int = 100
+                                  ) -> List[APIProject]:
+        path = f"{self._group_path(group)}/projects"
+        query = {"page": page, "per_page": per_page, "include_subgroups": "true",
+                 "simple": "true"}
+        projects = [APIProject.deserialize(info)
+                    for info in await self.request("GET", path, query=query)]
+        for project in projects:
+            self.projects.put(project)
+            self._remember_access(project)
+        return projects
+
+    def paginate_group_projects(self, group: ProjectRef, per_page: int = 100
+                                ) -> Paginator[APIProject]:
+        return Paginator(partial(self.list_group_projects, group), per_page=per_page)
+
+    async def create_group_hook(self, group: ProjectRef, hook: JSON) -> APIHook:
+        path = f"{self._group_path(group)}/hooks"
+        return APIHook.deserialize(await self.request("POST", path, data=hook))
+
+    async def get_issue(self, project: ProjectRef, iid: int) -> APIIssue:
+        path = f"{self._project_path(project)}/issues/{iid}"
+        return APIIssue.deserialize(await self.request("GET", path))
+
+    async def get_issue_details(self, project: ProjectRef, iid: int, notes: int = 0
+                                ) -> Tuple[APIIssue, List[APINote]]:
+        """
+        Get an issue with its author and assignees, and optionally the first page of its notes
+        (newest first), in a single GraphQL request. Falls back to REST if the server doesn't
+        support GraphQL or the project is referenced by ID.
+        """
+        if self.use_graphql and not str(project).isdigit():
+            try:
+                data = await self.graphql(ISSUE_DETAILS_QUERY, {
+                    "project": project, "iid": str(iid),
+                    "withNotes": notes > 0, "notes": notes or None,
+                })
+            except (GitlabGraphQLError, GitlabNotFound) as e:
+                # Only stop using GraphQL if the server doesn't have it or doesn't support the
+                # query. Other errors may be temporary or specific to this issue.
+                if isinstance(e, GitlabNotFound) or e.schema_error:
+                    log.info(f"GraphQL isn't usable on {self.url}, using REST instead: {e}")
+                    self.use_graphql = False
+                else:
+                    log.debug(f"GraphQL request to {self.url} failed, falling back to REST: {e}")
+            else:
+                issue = (data.get("project") or {}).get("issue")
+                if not issue:
+                    raise GitlabNotFound(404, "Issue Not Found")
+                note_nodes = issue["notes"]["nodes"] if notes > 0 else []
+                return (issue_from_graphql(issue),
+                        [note_from_graphql(note) for note in reversed(note_nodes)])
+        if notes <= 0:
+            return await self.get_issue(project, iid), []
+        issue, note_list = await asyncio.gather(self.get_issue(project, iid),
+                                                self.list_issue_notes(project, iid,
+                                                                      per_page=notes))
+        return issue, note_list
+
+    async def create_issue(self, project: ProjectRef, title: str,
+                           description: Optional[str] = None) -> APIIssue:
+        path = f"{self._project_path(project)}/issues"
+        data = {"title": title, "description": description}
+        return APIIssue.deserialize(await self.request("POST", path, data=data))
+
+    async def update_issue(self, project: ProjectRef, iid: int, **changes: Any) -> APIIssue:
+        path = f"{self._project_path(project)}/issues/{iid}"
+        return APIIssue.deserialize(await self.request("PUT", path, data=changes))
+
+    async def get_merge_request(self, project: ProjectRef, iid: int) -> APIMergeRequest:
+        path = f"{self._project_path(project)}/merge_requests/{iid}"
+        return APIMergeRequest.deserialize(await self.request("GET", path))
+
+    async def list_issue_notes(self, project: ProjectRef, iid: int, page: int = 1,
+                               per_page: int = 20) -> List[APINote]:
+        path = f"{self._project_path(project)}/issues/{iid}/notes"
+        notes = await self.request("GET", path, query={"page": page, "per_page": per_page})
+        return [APINote.deserialize(note) for note in notes]
+
+    def paginate_issue_notes(self, project: ProjectRef, iid: int, page: int = 1,
+                             per_page: int = 20) -> Paginator[APINote]:
+        return Paginator(partial(self.list_issue_notes, project, iid), page, per_page)
+
+    async def create_issue_note(self, project: ProjectRef, iid: int, body: str) -> APINote:
+        path = f"{self._project_path(project)}/issues/{iid}/notes"
+        return APINote.deserialize(await self.request("POST", path, data={"body": body}))
+
+    async def get_commit(self, project: ProjectRef, sha: str) -> APICommit:
+        path = f"{self._project_path(project)}/repository/commits/{quote(sha, safe='')}"
+        return APICommit.deserialize(await self.request("GET", path))
+
+    async def list_commits(self, project: ProjectRef, page: int = 1, per_page: int = 20
+                           ) -> List[APICommit]:
+        path = f"{self._project_path(project)}/repository/commits"
+        commits = await self.request("GET", path, query={"page": page, "per_page": per_page})
+        return [APICommit.deserialize(commit) for commit in commits]
+
+    def paginate_commits(self, project: ProjectRef, page: int = 1, per_page: int = 20
+                         ) -> Paginator[APICommit]:
+        return Paginator(partial(self.list_commits, project), page, per_page)
+
+    async def compare_commits(self, project: ProjectRef, from_sha: str, to_sha: str
+                              ) -> List[APICommit]:
+        path = f"{self._project_path(project)}/repository/compare"
+        data = await self.request("GET", path, query={"from": from_sha, "to": to_sha})
+        return [APICommit.deserialize(commit) for commit in data["commits"]]
+
+    async def get_commit_diff(self, project: ProjectRef, sha: str) -> List[APIDiff]:
+        path = f"{self._project_path(project)}/repository/commits/{quote(sha, safe='')}/diff"
+        return [APIDiff.deserialize(diff) for diff in await self.request("GET", path)]
+
+
+ClientKey = Tuple[str, str]
+
+
+class GitlabAPI:
+    """
+    Holds one keep-alive connection pool and request scheduler per GitLab server, and a pool of
+    authenticated clients per server and access token.
+    """
+    connections_per_server: int
+    keepalive_timeout: float
+    timeout: float
+    max_queued_per_server: int
+    queue_timeout: float
+    client_idle_timeout: float
+    project_cache_ttl: float
+    max_retries: int
+    failure_threshold: int
+    probe_interval: float
+    use_graphql: bool
+    _sessions: Dict[str, ClientSession]
+    _schedulers: Dict[str, RequestScheduler]
+    _breakers: Dict[str, CircuitBreaker]
+    _project_caches: Dict[str, ProjectCache]
+    _clients: Dict[ClientKey, GitlabClient]
+    _busy_released: Set[str]
+
+    def __init__(self, connections_per_server: int = 8, keepalive_timeout: float = 60,
+                 timeout: float = 30, max_queued_per_server: int = 32,
+                 queue_timeout: float = 10, client_idle_timeout: float = 3600,
+                 project_cache_ttl: float = 3600, max_retries: int = 3,
+                 failure_threshold: int = 5, probe_interval: float = 30,
+                 use_graphql: bool = True) -> None:
+        self.connections_per_server = connections_per_server
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self.max_queued_per_server = max_queued_per_server
+        self.queue_timeout = queue_timeout
+        self.client_idle_timeout = client_idle_timeout
+        self.project_cache_ttl = project_cache_ttl
+        self.max_retries = max_retries
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.use_graphql = use_graphql
+        self._sessions = {}
+        self._schedulers = {}
+        self._breakers = {}
+        self._project_caches = {}
+        self._clients = {}
+        self._busy_released = set()
+
+    @staticmethod
+    def _client_key(login: AuthInfo) -> ClientKey:
+        return login.server, hashlib.sha256(login.api_token.encode("utf-8")).hexdigest()
+
+    def _get_session(self, server: str) -> ClientSession:
+        try:
+            return self._sessions[server]
+        except KeyError:
+            pass
+        connector = TCPConnector(limit=self.connections_per_server,
+                                 keepalive_timeout=self.keepalive_timeout)
+        session = ClientSession(connector=connector, timeout=ClientTimeout(total=self.timeout),
+                                raise_for_status=False)
+        self._sessions[server] = session
+        return session
+
+    @property
+    def schedulers(self) -> Dict[str, RequestScheduler]:
+        return self._schedulers
+
+    def _get_scheduler(self, server: str) -> RequestScheduler:
+        try:
+            return self._schedulers[server]
+        except KeyError:
+            pass
+        scheduler = RequestScheduler(server, concurrency=self.connections_per_server,
+                                     max_queued=self.max_queued_per_server,
+                                     queue_timeout=self.queue_timeout)
+        self._schedulers[server] = scheduler
+        return scheduler
+
+    @property
+    def breakers(self) -> Dict[str, CircuitBreaker]:
+        return self._breakers
+
+    def _get_breaker(self, server: str) -> CircuitBreaker:
+        try:
+            return self._breakers[server]
+        except KeyError:
+            pass
+        breaker = CircuitBreaker(server, probe=lambda: self._probe(server),
+                                 failure_threshold=self.failure_threshold,
+                                 probe_interval=self.probe_interval)
+        self._breakers[server] = breaker
+        return breaker
+
+    async def _probe(self, server: str) -> bool:
+        # Any non-5xx answer (usually 401, as the probe isn't authenticated) means the
+        # server is up again.
+        url = URL(f"{server.rstrip('/')}/api/v4/version")
+        async with self._get_session(server).get(url) as resp:
+            return resp.status < 500
+
+    def get_project_cache(self, server: str) -> ProjectCache:
+        server = server.rstrip("/")
+        try:
+            return self._project_caches[server]
+        except KeyError:
+            pass
+        cache = ProjectCache(ttl=self.project_cache_ttl)
+        self._project_caches[server] = cache
+        return cache
+
+    def _evict_idle_clients(self, now: float) -> None:
+        expired = [key for key, client in self._clients.items()
+                   if now - client.last_used > self.client_idle_timeout]
+        for key in expired:
+            del self._clients[key]
+        # Servers that were still busy when their last client went away are checked again.
+        for server in {server for server, _ in expired} | self._busy_released:
+            self._release_server(server)
+
+    def _release_server(self, server: str) -> None:
+        """Close the connection pool and stop the probes of a server nobody uses anymore."""
+        if any(client_server == server for client_server, _ in self._clients):
+            self._busy_released.discard(server)
+            return
+        scheduler = self._schedulers.get(server)
+        if scheduler and (scheduler.active or scheduler.queued):
+            # Retried on every eviction pass until the last requests are done.
+            self._busy_released.add(server)
+            return
+        self._busy_released.discard(server)
+        self._schedulers.pop(server, None)
+        breaker = self._breakers.pop(server, None)
+        if breaker:
+            breaker.stop()
+        session = self._sessions.pop(server, None)
+        if session:
+            asyncio.ensure_future(session.close())
+
+    async def check_login(self, login: AuthInfo) -> GitlabUser:
+        """
+        Get the user of an access token without adding anything to the pool, so that logins with
+        mistyped URLs or invalid tokens don't leave connection pools and probes behind.
+        """
+        session = ClientSession(timeout=ClientTimeout(total=self.timeout),
+                                raise_for_status=False)
+        # A single check can't fail often enough to open the circuit and start probing.
+        breaker = CircuitBreaker(login.server, probe=lambda: asyncio.sleep(0, True),
+                                 failure_threshold=self.max_retries + 2)
+        scheduler = RequestScheduler(login.server, concurrency=1, max_queued=0,
+                                     queue_timeout=self.queue_timeout)
+        client = GitlabClient(login.server, login.api_token, session, scheduler, breaker,
+                              ProjectCache(ttl=0), owner="login", max_retries=self.max_retries,
+                              use_graphql=False)
+        try:
+            return await client.get_current_user()
+        finally:
+            breaker.stop()
+            await session.close()
+
+    def client(self, login: AuthInfo) -> GitlabClient:
+        now = time.monotonic()
+        self._evict_idle_clients(now)
+        key = self._client_key(login)
+        client = self._clients.get(key)
+        if not client or client.auth_failed:
+            client = GitlabClient(login.server, login.api_token, self._get_session(login.server),
+                                  self._get_scheduler(login.server),
+                                  self._get_breaker(login.server),
+                                  self.get_project_cache(login.server), owner=key[1],
+                                  max_retries=self.max_retries,
+                                  use_graphql=self.use_graphql)
+            self._clients[key] = client
+        client.last_used = now
+        return client
+
+    def invalidate(self, login: AuthInfo) -> None:
+        self._clients.pop(self._client_key(login), None)
+        self._release_server(login.server)
+
+    async def close(self) -> None:
+        for breaker in self._breakers.values():
+            breaker.stop()
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions = {}
+        self._clients = {}
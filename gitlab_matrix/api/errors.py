@@ -0,0 +1,61 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+class GitlabError(Exception):
+    status: int
+    message: str
+
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(f"{status}: {message}")
+        self.status = status
+        self.message = message
+
+
+class GitlabAuthError(GitlabError):
+    pass
+
+
+class GitlabNotFound(GitlabError):
+    pass
+
+
+class GitlabBusy(Exception):
+    server: str
+    reason: str
+
+    def __init__(self, server: str, reason: str) -> None:
+        super().__init__(f"{server} is busy: {reason}")
+        self.server = server
+        self.reason = reason
+
+
+class GitlabUnavailable(Exception):
+    server: str
+    down_for: float
+
+    def __init__(self, server: str, down_for: float) -> None:
+        super().__init__(f"{server} has been unreachable for {down_for:.0f} seconds")
+        self.server = server
+        self.down_for = down_for
+
+
+class GitlabGraphQLError(GitlabError):
+    schema_error: bool
+
+    def __init__(self, status: int, message: str, schema_error: bool = False) -> None:
+        super().__init__(status, message)
+        self.schema_error = schema_error
@@ -0,0 +1,83 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Dict, Optional
+
+from mautrix.types import JSON
+
+from .types import APIIssue, APINote
+
+USER_FIELDS = "id username name avatarUrl webUrl"
+
+ISSUE_DETAILS_QUERY = f"""
+query($project: ID!, $iid: String!, $withNotes: Boolean!, $notes: Int) {{
+  project(fullPath: $project) {{
+    issue(iid: $iid) {{
+      id iid projectId title state webUrl description createdAt updatedAt confidential
+      author {{ {USER_FIELDS} }}
+      assignees {{ nodes {{ {USER_FIELDS} }} }}
+      labels {{ nodes {{ title }} }}
+      notes(last: $notes) @include(if: $withNotes) {{
+        nodes {{ id body system createdAt author {{ {USER_FIELDS} }} }}
+      }}
+    }}
+  }}
+}}
+"""
+
+
+def parse_gid(gid: str) -> int:
+    # Global IDs look like gid://gitlab/Issue/123
+    return int(gid.rsplit("/", 1)[-1])
+
+
+def user_from_graphql(data: Optional[JSON]) -> Dict[str, Any]:
+    if not data:
+        return {"name": "Ghost User"}
+    return {
+        "id": parse_gid(data["id"]),
+        "username": data.get("username"),
+        "name": data["name"],
+        "avatar_url": data.get("avatarUrl"),
+        "web_url": data.get("webUrl"),
+    }
+
+
+def issue_from_graphql(data: JSON) -> APIIssue:
+    return APIIssue.deserialize({
+        "id": parse_gid(data["id"]),
+        "iid": int(data["iid"]),
+        "project_id": data["projectId"],
+        "title": data["title"],
+        "state": data["state"],
+        "web_url": data["webUrl"],
+        "description": data.get("description"),
+        "created_at": data["createdAt"],
+        "updated_at": data["updatedAt"],
+        "author": user_from_graphql(data.get("author")),
+        "assignees": [user_from_graphql(user) for user in data["assignees"]["nodes"]],
+        "labels": [label["title"] for label in data["labels"]["nodes"]],
+        "confidential": data.get("confidential", False),
+    })
+
+
+def note_from_graphql(data: JSON) -> APINote:
+    return APINote.deserialize({
+        "id": parse_gid(data["id"]),
+        "body": data["body"],
+        "system": data.get("system", False),
+        "created_at": data["createdAt"],
+        "author": user_from_graphql(data.get("author")),
+    })
@@ -0,0 +1,83 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import AsyncIterator, Awaitable, Callable, Generic, List, Optional, TypeVar
+import asyncio
+
+T = TypeVar("T")
+PageFetcher = Callable[[int, int], Awaitable[List[T]]]
+
+
+class Paginator(Generic[T]):
+    """
+    Lazily walks the pages of a GitLab list endpoint. While a page is being shown, the next one
+    is already fetched in the background.
+    """
+    page: int
+    per_page: int
+    done: bool
+    _fetch: PageFetcher
+    _next: Optional[asyncio.Future]
+
+    def __init__(self, fetch: PageFetcher, page: int = 1, per_page: int = 20) -> None:
+        self._fetch = fetch
+        self.page = page
+        self.per_page = per_page
+        self.done = False
+        self._next = None
+
+    @property
+    def has_more(self) -> bool:
+        return not self.done
+
+    def _prefetch(self) -> None:
+        self._next = asyncio.ensure_future(self._fetch(self.page, self.per_page))
+        # The prefetched page may never be requested, so don't let its errors go unretrieved.
+        self._next.add_done_callback(lambda fut: fut.cancelled() or fut.exception())
+
+    async def next_page(self) -> List[T]:
+        if self.done:
+            return []
+        if not self._next:
+            self._prefetch()
+        fut, self._next = self._next, None
+        try:
+            items = await fut
+        except Exception:
+            self.done = True
+            raise
+        return self.skip(items)
+
+    def skip(self, items: List[T]) -> List[T]:
+        """Continue after a page that was fetched some other way."""
+        self.page += 1
+        # GitLab doesn't send pagination headers for large collections, so a short page is the
+        # only reliable end marker.
+        if len(items) < self.per_page:
+            self.done = True
+        else:
+            self._prefetch()
+        return items
+
+    def close(self) -> None:
+        self.done = True
+        if self._next:
+            self._next.cancel()
+            self._next = None
+
+    async def __aiter__(self) -> AsyncIterator[T]:
+        while not self.done:
+            for item in await self.next_page():
+                yield item
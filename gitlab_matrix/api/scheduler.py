@@ -0,0 +1,140 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import AsyncIterator, Deque, Dict, Mapping, Optional
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+import asyncio
+import time
+
+from .errors import GitlabBusy
+
+
+class RequestScheduler:
+    """
+    Schedules the requests to a single GitLab server. Limits the number of in-flight and queued
+    requests, serves the queues of different users in turn and pauses all requests when GitLab
+    says the rate limit has been reached.
+    """
+    server: str
+    concurrency: int
+    max_queued: int
+    queue_timeout: float
+
+    active: int
+    requests: int
+    throttled: int
+    rate_limit_remaining: Optional[int]
+    rate_limit_reset: Optional[float]
+    blocked_until: float
+    _waiters: Dict[str, Deque[asyncio.Future]]
+
+    def __init__(self, server: str, concurrency: int, max_queued: int, queue_timeout: float
+                 ) -> None:
+        self.server = server
+        self.concurrency = concurrency
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.requests = 0
+        self.throttled = 0
+        self.rate_limit_remaining = None
+        self.rate_limit_reset = None
+        self.blocked_until = 0
+        self._waiters = OrderedDict()
+
+    @property
+    def queued(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    @property
+    def blocked_for(self) -> float:
+        return max(0.0, self.blocked_until - time.monotonic())
+
+    @asynccontextmanager
+    async def slot(self, owner: str) -> AsyncIterator[None]:
+        await self._acquire(owner)
+        try:
+            delay = self.blocked_for
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.requests += 1
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, owner: str) -> None:
+        if self.active < self.concurrency and not self._waiters:
+            self.active += 1
+            return
+        elif self.queued >= self.max_queued:
+            raise GitlabBusy(self.server, "too many queued requests")
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(owner, deque()).append(fut)
+        try:
+            await asyncio.wait_for(fut, self.queue_timeout)
+        except BaseException as e:
+            if fut.done() and not fut.cancelled():
+                # The slot was handed over just as we gave up on it.
+                self._release()
+            else:
+                self._remove_waiter(owner, fut)
+            if isinstance(e, asyncio.TimeoutError):
+                raise GitlabBusy(self.server, "timed out waiting for a free connection") from None
+            raise
+
+    def _remove_waiter(self, owner: str, fut: asyncio.Future) -> None:
+        waiters = self._waiters.get(owner)
+        if waiters is None:
+            return
+        try:
+            waiters.remove(fut)
+        except ValueError:
+            pass
+        if not waiters:
+            del self._waiters[owner]
+
+    def _release(self) -> None:
+        self.active -= 1
+        while self._waiters and self.active < self.concurrency:
+            # Round-robin between users: take the first user's oldest request and move
+            # that user to the back of the line.
+            owner, waiters = next(iter(self._waiters.items()))
+            fut = waiters.popleft()
+            if waiters:
+                self._waiters.move_to_end(owner)
+            else:
+                del self._waiters[owner]
+            if not fut.done():
+                self.active += 1
+                fut.set_result(None)
+
+    def update(self, status: int, headers: Mapping[str, str], attempt: int = 0) -> None:
+        try:
+            self.rate_limit_remaining = int(headers["RateLimit-Remaining"])
+            self.rate_limit_reset = float(headers["RateLimit-Reset"])
+        except (KeyError, ValueError):
+            pass
+        now = time.monotonic()
+        if status == 429:
+            self.throttled += 1
+            try:
+                retry_after = float(headers["Retry-After"])
+            except (KeyError, ValueError):
+                retry_after = min(2 ** attempt, 60)
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+        elif self.rate_limit_remaining == 0 and self.rate_limit_reset:
+            reset_in = self.rate_limit_reset - time.time()
+            self.blocked_until = max(self.blocked_until, now + max(reset_in, 0))
@@ -0,0 +1,152 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import List, Optional
+from datetime import datetime
+
+from attr import dataclass
+import attr
+
+from mautrix.types import SerializableAttrs
+
+# Importing the webhook types also registers the datetime (de)serializers.
+from ..types import GitlabUser, GitlabProject
+
+
+@dataclass
+class APIProject(SerializableAttrs):
+    id: int
+    path_with_namespace: str
+    web_url: str
+    name: Optional[str] = None
+    description: Optional[str] = None
+    default_branch: Optional[str] = None
+
+    @classmethod
+    def from_webhook(cls, project: GitlabProject) -> 'APIProject':
+        return cls(id=project.id, path_with_namespace=project.path_with_namespace,
+                   web_url=project.web_url, name=project.name,
+                   description=project.description, default_branch=project.default_branch)
+
+
+@dataclass
+class APIIssue(SerializableAttrs):
+    id: int
+    iid: int
+    project_id: int
+    title: str
+    state: str
+    web_url: str
+    author: GitlabUser
+    created_at: datetime
+    updated_at: datetime
+    description: Optional[str] = None
+    assignees: List[GitlabUser] = attr.ib(factory=list)
+    labels: List[str] = attr.ib(factory=list)
+    confidential: bool = False
+
+
+@dataclass
+class APIMergeRequest(SerializableAttrs):
+    id: int
+    iid: int
+    project_id: int
+    title: str
+    state: str
+    web_url: str
+    author: GitlabUser
+    created_at: datetime
+    updated_at: datetime
+    source_branch: str
+    target_branch: str
+    source_project_id: int
+    target_project_id: int
+    description: Optional[str] = None
+    sha: Optional[str] = None
+    merge_status: Optional[str] = None
+    work_in_progress: bool = False
+    assignees: List[GitlabUser] = attr.ib(factory=list)
+    labels: List[str] = attr.ib(factory=list)
+
+
+@dataclass
+class APINote(SerializableAttrs):
+    id: int
+    body: str
+    author: GitlabUser
+    created_at: datetime
+    system: bool = False
+
+
+@dataclass
+class APICommit(SerializableAttrs):
+    id: str
+    short_id: str
+    title: str
+    message: str
+    author_name: str
+    committed_date: datetime
+    author_email: Optional[str] = None
+    web_url: Optional[str] = None
+
+
+@dataclass
+class APIDiff(SerializableAttrs):
+    diff: str
+    new_path: str
+    old_path: str
+    new_file: bool = False
+    renamed_file: bool = False
+    deleted_file: bool = False
+
+
+@dataclass
+class APIHook(SerializableAttrs):
+    id: int
+    url: str
+
+
+@dataclass
+class APIPushData(SerializableAttrs):
+    commit_count: int
+    action: str
+    ref_type: str
+    ref: Optional[str] = None
+    commit_from: Optional[str] = None
+    commit_to: Optional[str] = None
+    commit_title: Optional[str] = None
+
+
+@dataclass
+class APIEventNote(SerializableAttrs):
+    id: int
+    body: str
+    created_at: datetime
+    updated_at: datetime
+    noteable_type: Optional[str] = None
+    noteable_iid: Optional[int] = None
+    system: bool = False
+
+
+@dataclass
+class APIEvent(SerializableAttrs):
+    id: int
+    action_name: str
+    author: GitlabUser
+    created_at: datetime
+    target_type: Optional[str] = None
+    target_iid: Optional[int] = None
+    push_data: Optional[APIPushData] = None
+    note: Optional[APIEventNote] = None
@@ -15,33 +15,98 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from typing import Type
+from datetime import datetime, timedelta
+import asyncio
 
 from mautrix.util.config import BaseProxyConfig
 from maubot import Plugin
 
 from .db import Database
 from .util import Config
+from .api import GitlabAPI
+from .store import IssueStore
+from .search import SearchIndex
 from .webhook import GitlabWebhook
+from .poller import EventPoller
+from .sender import MatrixSender
 from .commands import GitlabCommands
 
 
 class GitlabBot(Plugin):
     db: Database
+    gitlab: GitlabAPI
+    issues: IssueStore
+    search: SearchIndex
     webhook: GitlabWebhook
+    poller: EventPoller
+    sender: MatrixSender
     commands: GitlabCommands
+    prune_task: asyncio.Task
 
     async def start(self) -> None:
         self.config.load_and_update()
 
-        self.db = Database(self.database)
+        self.db = Database(self.database, batch_window=self.config["event_batch.window"],
+                           batch_max_rows=self.config["event_batch.max_rows"])
+        self.gitlab = GitlabAPI(connections_per_server=self.config["api.connections_per_server"],
+                                keepalive_timeout=self.config["api.keepalive_timeout"],
+                                timeout=self.config["api.timeout"],
+                                max_queued_per_server=self.config["api.max_queued_per_server"],
+                                queue_timeout=self.config["api.queue_timeout"],
+                                client_idle_timeout=self.config["api.client_idle_timeout"],
+                                project_cache_ttl=self.config["api.project_cache_ttl"],
+                                max_retries=self.config["api.max_retries"],
+                                failure_threshold=self.config["api.failure_threshold"],
+                                probe_interval=self.config["api.probe_interval"],
+                                use_graphql=self.config["api.graphql"])
+        self.sender = MatrixSender(self.client, rate=self.config["matrix_send.rate"],
+                                   burst=self.config["matrix_send.burst"],
+                                   room_rate=self.config["matrix_send.room_rate"],
+                                   room_burst=self.config["matrix_send.room_burst"],
+                                   max_retries=self.config["matrix_send.max_retries"])
+        self.issues = IssueStore(self.db, max_age=self.config["issue_store.max_age"],
+                                 api_max_age=self.config["issue_store.api_max_age"])
+        self.search = SearchIndex(self.database)
         self.webhook = await GitlabWebhook(self).start()
+        self.poller = EventPoller(self)
         self.commands = GitlabCommands(self)
 
         self.register_handler_class(self.webhook)
         self.register_handler_class(self.commands)
+        self.prune_task = asyncio.create_task(self.prune_loop())
+        self.poller.start()
 
     async def stop(self) -> None:
+        self.prune_task.cancel()
+        await self.poller.stop()
         await self.webhook.stop()
+        await self.gitlab.close()
+        self.db.flush_events(retry=False)
+        self.log.debug(f"Stored {self.db.event_rows} Matrix event IDs in "
+                       f"{self.db.event_commits} commits "
+                       f"({self.db.commits_saved} saved by batching)")
+
+    async def prune_loop(self) -> None:
+        while True:
+            if self.config["message_retention.days"] > 0:
+                try:
+                    await self.prune_messages()
+                except Exception:
+                    self.log.exception("Failed to prune old Matrix event IDs")
+            await asyncio.sleep(self.config["message_retention.interval"])
+
+    async def prune_messages(self) -> None:
+        older_than = datetime.utcnow() - timedelta(days=self.config["message_retention.days"])
+        batch_size = self.config["message_retention.batch_size"]
+        total = 0
+        while True:
+            count = self.db.prune_events(older_than, limit=batch_size)
+            total += count
+            if count < batch_size:
+                break
+            await asyncio.sleep(self.config["message_retention.batch_delay"])
+        if total > 0:
+            self.log.debug(f"Pruned {total} Matrix event IDs older than {older_than}")
 
     @classmethod
     def get_config_class(cls) -> Type[BaseProxyConfig]:
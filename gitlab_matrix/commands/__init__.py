@@ -5,10 +5,14 @@ from .alias import CommandAlias
 from .server import CommandServer
 from .commit import CommandCommit
 from .webhook import CommandWebhook
+from .stats import CommandStats
+from .more import CommandMore
+from .search import CommandSearch
+from .poll import CommandPoll
 
 
 class GitlabCommands(CommandRoom, CommandIssue, CommandAlias, CommandServer, CommandCommit,
-                     CommandWebhook):
+                     CommandWebhook, CommandPoll, CommandStats, CommandSearch, CommandMore):
     pass
 
 
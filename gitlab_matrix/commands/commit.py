@@ -14,19 +14,21 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from datetime import datetime
-import re
+from typing import List
 
-from gitlab import Gitlab as Gl
+from mautrix.types import MediaMessageEventContent, MessageType, FileInfo
 
 from maubot.handlers import command
 from maubot import MessageEvent
 
-from ..util import OptUrlAliasArgument, OptRepoArgument, with_gitlab_session, optional_int
+from ..util import (OptUrlAliasArgument, OptRepoArgument, with_gitlab_session, optional_int,
+                    diff_size, to_unified_diff, pack_diff_messages, highlight_diff_lines)
+from ..api import GitlabClient as Gl, APICommit
 from .base import Command
+from .more import CommandMore
 
 
-class CommandCommit(Command):
+class CommandCommit(CommandMore):
     @Command.gitlab.subcommand("commit", help="View GitLab commits.")
     async def commit(self) -> None:
         pass
@@ -37,26 +39,25 @@ class CommandCommit(Command):
     @command.argument("hash", "commit hash")
     @with_gitlab_session
     async def diff(self, evt: MessageEvent, repo: str, hash: str, gl: Gl) -> None:
-        project = gl.projects.get(repo)
-        diffs = project.commits.get(hash).diff()
+        diffs = await gl.get_commit_diff(repo, hash)
 
-        def color_diff(line: str) -> str:
-            if line.startswith("@@") and re.fullmatch(r"(@@ -[0-9]+,[0-9]+ \+[0-9]+,[0-9]+ @@)",
-                                                      line):
-                return f"<font color='#00A'>{line}</font>"
-            elif line.startswith(("+++", "---")):
-                return f"<font color='#000'>{line}</font>"
-            elif line.startswith("+"):
-                return f"<font color='#0A0'>{line}</font>"
-            elif line.startswith("-"):
-                return f"<font color='#A00'>{line}</font>"
-            else:
-                return f"<font color='#666'>{line}</font>"
+        size, lines = diff_size(diffs)
+        if size > self.bot.config["diff.max_bytes"] or lines > self.bot.config["diff.max_lines"]:
+            data = to_unified_diff(diffs).encode("utf-8")
+            filename = f"{hash[:12]}.diff"
+            mxc = await self.bot.client.upload_media(data, mime_type="text/x-diff",
+                                                     filename=filename)
+            content = MediaMessageEventContent(msgtype=MessageType.FILE, body=filename, url=mxc,
+                                               info=FileInfo(mimetype="text/x-diff",
+                                                             size=len(data)))
+            await evt.reply(content)
+            return
 
-        for index, diff in enumerate(diffs):
-            msg = "{path}:\n<pre><code>{diff}</code></pre>".format(
-                path=diff["new_path"],
-                diff="\n".join(color_diff(line) for line in diff["diff"].split("\n")))
+        # Files are highlighted lazily as messages are packed, so the event loop isn't blocked
+        # by rendering the whole diff up front.
+        files = ((diff.new_path, highlight_diff_lines(diff.diff)) for diff in diffs)
+        messages = pack_diff_messages(files, self.bot.config["diff.message_size"])
+        for index, msg in enumerate(messages):
             await evt.respond(msg, reply=index == 0, allow_html=True)
 
     @commit.subcommand("log", help="Get the log of a specific repo.")
@@ -67,8 +68,7 @@ class CommandCommit(Command):
     @with_gitlab_session
     async def log_cmd(self, evt: MessageEvent, repo: str, page: int, per_page: int,
                       gl: Gl) -> None:
-        project = gl.projects.get(repo)
-        commits = project.commits.list(page=page or 1, per_page=per_page or 10)
+        commits = gl.paginate_commits(repo, page=page or 1, per_page=per_page or 10)
 
         def first_line(message: str) -> str:
             lines = message.strip().split("\n")
@@ -79,10 +79,12 @@ class CommandCommit(Command):
                 message += " (…)"
             return message
 
-        await evt.reply("".join(f"* [`{commit.short_id}`]({gl.url}/{repo}/commit/{commit.id})"
-                                f" {first_line(commit.message)}\n"
-                                for commit in commits),
-                        allow_html=True)
+        def render(page: List[APICommit]) -> str:
+            return "".join(f"* [`{commit.short_id}`]({gl.url}/{repo}/commit/{commit.id})"
+                           f" {first_line(commit.message)}\n"
+                           for commit in page)
+
+        await self.send_page(evt, gl, commits, render)
 
     @commit.subcommand("show", help="Get details about a specific commit.")
     @OptUrlAliasArgument("login", "server URL or alias", arg_num=2)
@@ -90,11 +92,8 @@ class CommandCommit(Command):
     @command.argument("hash", "commit hash")
     @with_gitlab_session
     async def show(self, evt: MessageEvent, repo: str, hash: str, gl: Gl) -> None:
-        project = gl.projects.get(repo)
-        commit = project.commits.get(hash)
-        date = (datetime
-                .strptime(commit.committed_date, "%Y-%m-%dT%H:%M:%S.%f%z")
-                .strftime(self.bot.config["time_format"]))
+        commit = await gl.get_commit(repo, hash)
+        date = commit.committed_date.strftime(self.bot.config["time_format"])
         message = "\n".join(f"> {line}" for line in commit.message.strip().split("\n"))
 
         await evt.reply(f"Commit [`{commit.short_id}`]({gl.url}/{repo}/commit/{commit.id})"
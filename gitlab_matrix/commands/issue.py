@@ -14,36 +14,66 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import List, Optional, Tuple
 from functools import partial
-from datetime import datetime
-
-from gitlab import Gitlab as Gl
+import asyncio
 
 from maubot.handlers import command
 from maubot import MessageEvent
 
 from ..util import (OptUrlAliasArgument, OptRepoArgument, with_gitlab_session, sigil_int,
-                    optional_int, quote_parser)
+                    optional_int, quote_parser, issue_id_list)
+from ..api import (GitlabClient as Gl, APINote, APIIssue, GitlabError, GitlabAuthError,
+                   GitlabBusy, GitlabUnavailable)
 from .base import Command
+from .more import CommandMore
 
 
-class CommandIssue(Command):
+class CommandIssue(CommandMore):
     @Command.gitlab.subcommand("issue", help="Manage GitLab issues.")
     async def issue(self) -> None:
         pass
 
-    @issue.subcommand("close", help="Close an issue.")
+    async def _set_issue_states(self, evt: MessageEvent, gl: Gl, repo: str, ids: List[int],
+                                state_event: str, verb: str) -> None:
+        if len(ids) == 1:
+            issue = await gl.update_issue(repo, ids[0], state_event=state_event)
+            self.bot.issues.put_issue(gl.url, issue)
+            await evt.reply(f"{verb} issue #{issue.iid}: {issue.title}")
+            return
+
+        # The scheduler would reject requests beyond its queue limit, so only keep as many in
+        # flight as it can run at once.
+        limit = asyncio.Semaphore(gl.scheduler.concurrency)
+
+        async def update(iid: int) -> Tuple[int, Optional[APIIssue], Optional[str]]:
+            async with limit:
+                try:
+                    issue = await gl.update_issue(repo, iid, state_event=state_event)
+                    self.bot.issues.put_issue(gl.url, issue)
+                    return iid, issue, None
+                except GitlabAuthError:
+                    raise
+                except (GitlabError, GitlabBusy, GitlabUnavailable, asyncio.TimeoutError) as e:
+                    return iid, None, str(e) or type(e).__name__
+
+        results = await asyncio.gather(*(update(iid) for iid in ids))
+        changed = [issue for _, issue, _ in results if issue]
+        failed = [(iid, error) for iid, issue, error in results if not issue]
+        msg = f"{verb} {len(changed)} of {len(ids)} issues in {repo}"
+        if changed:
+            msg += ":\n\n" + "\n".join(f"* #{issue.iid}: {issue.title}" for issue in changed)
+        if failed:
+            msg += "\n\nFailed:\n\n" + "\n".join(f"* #{iid}: {error}" for iid, error in failed)
+        await evt.reply(msg)
+
+    @issue.subcommand("close", help="Close one or more issues, e.g. #12 #15 #20-30.")
     @OptUrlAliasArgument("login", "server URL or alias", arg_num=2)
     @OptRepoArgument("repo", "repository")
-    @command.argument("id", "issue ID")
+    @command.argument("ids", "issue IDs", pass_raw=True, parser=issue_id_list)
     @with_gitlab_session
-    async def issue_close(self, evt: MessageEvent, repo: str, id: str, gl: Gl) -> None:
-        project = gl.projects.get(repo)
-        issue = project.issues.get(id)
-        issue.state_event = "close"
-        issue.save()
-
-        await evt.reply(f"Closed issue #{issue.iid}: {issue.title}")
+    async def issue_close(self, evt: MessageEvent, repo: str, ids: List[int], gl: Gl) -> None:
+        await self._set_issue_states(evt, gl, repo, ids, "close", "Closed")
 
     @issue.subcommand("comment", help="Write a comment on an issue.")
     @OptUrlAliasArgument("login", "server URL or alias", arg_num=3)
@@ -52,9 +82,8 @@ class CommandIssue(Command):
     @command.argument("body", "comment body", pass_raw=True)
     @with_gitlab_session
     async def issue_comment(self, evt: MessageEvent, repo: str, id: int, body: str, gl: Gl) -> None:
-        project = gl.projects.get(repo)
-        issue = project.issues.get(id)
-        issue.notes.create({"body": body.strip()})
+        issue = await gl.get_issue(repo, id)
+        await gl.create_issue_note(repo, id, body.strip())
 
         await evt.reply(f"Commented on issue #{issue.iid}: {issue.title}")
 
@@ -68,19 +97,24 @@ class CommandIssue(Command):
     @with_gitlab_session
     async def issue_comments_read(self, evt: MessageEvent, repo: str, id: int,
                                   page: int, per_page: int, gl: Gl) -> None:
-        project = gl.projects.get(repo)
-        issue = project.issues.get(id)
-        notes = issue.notes.list(per_page=per_page or 5, page=page or 1)
-
-        def format_note(note) -> str:
+        notes = gl.paginate_issue_notes(repo, id, page=page or 1, per_page=per_page or 5)
+        if notes.page == 1:
+            issue, first_page = await gl.get_issue_details(repo, id, notes=notes.per_page)
+            notes.skip(first_page)
+        else:
+            issue, first_page = await asyncio.gather(gl.get_issue(repo, id), notes.next_page())
+
+        def format_note(note: APINote) -> str:
             body = "\n".join(f"> {line}" for line in note.body.split("\n"))
-            date = (datetime
-                    .strptime(note.created_at, "%Y-%m-%dT%H:%M:%S.%f%z")
-                    .strftime(self.bot.config["time_format"]))
-            author = note.author["name"]
+            date = note.created_at.strftime(self.bot.config["time_format"])
+            author = note.author.name
             return f"{author} at {date}:\n{body}"
 
-        await evt.reply("\n\n".join(format_note(note) for note in reversed(notes)))
+        def render(page: List[APINote]) -> str:
+            return "\n\n".join(format_note(note) for note in reversed(page))
+
+        header = f"Comments on issue [#{issue.iid}]({issue.web_url}): {issue.title}\n\n"
+        await self.send_page(evt, gl, notes, render, first_page, header=header)
 
     @issue.subcommand("create", help="Create an Issue. The issue body can be placed on a new line.")
     @OptUrlAliasArgument("login", "server URL or alias", arg_num=3)
@@ -91,8 +125,7 @@ class CommandIssue(Command):
     @with_gitlab_session
     async def issue_create(self, evt: MessageEvent, repo: str, title: str,
                            desc: str, gl: Gl) -> None:
-        project = gl.projects.get(repo)
-        issue = project.issues.create({"title": title, "description": desc})
+        issue = await gl.create_issue(repo, title, desc)
         await evt.reply(f"Created issue [#{issue.iid}]({issue.web_url}): {issue.title}")
 
     @issue.subcommand("read", aliases=("view", "show"),
@@ -102,28 +135,28 @@ class CommandIssue(Command):
     @command.argument("id", "issue ID", parser=sigil_int)
     @with_gitlab_session
     async def issue_read(self, evt: MessageEvent, repo: str, id: int, gl: Gl) -> None:
-        project = gl.projects.get(repo)
-        issue = project.issues.get(id)
-
-        msg = f"Issue #{issue.iid} by {issue.author['name']}: [{issue.title}]({issue.web_url})  \n"
-        names = [assignee['name'] for assignee in issue.assignees]
+        issue = self.bot.issues.get_issue(gl.url, repo, id)
+        # The stored issue may have come from a webhook or another user's token.
+        if issue and not await gl.can_access_project(issue.project_id):
+            issue = None
+        if not issue:
+            issue, _ = await gl.get_issue_details(repo, id)
+            self.bot.issues.put_issue(gl.url, issue)
+
+        msg = f"Issue #{issue.iid} by {issue.author.name}: [{issue.title}]({issue.web_url})  \n"
+        names = [assignee.name for assignee in issue.assignees]
         if len(names) > 1:
             msg += f"Assigned to {', '.join(names[:-1])} and {names[-1]}.  \n"
         elif len(names) == 1:
             msg += f"Assigned to {names[0]}.  \n"
-        msg += "\n".join(f"> {line}" for line in issue.description.strip().split("\n"))
+        msg += "\n".join(f"> {line}" for line in (issue.description or "").strip().split("\n"))
 
         await evt.reply(msg)
 
-    @issue.subcommand("reopen", help="Reopen an issue.")
+    @issue.subcommand("reopen", help="Reopen one or more issues, e.g. #12 #15 #20-30.")
     @OptUrlAliasArgument("login", "server URL or alias", arg_num=2)
     @OptRepoArgument("repo", "repository")
-    @command.argument("id", "issue ID", parser=sigil_int)
+    @command.argument("ids", "issue IDs", pass_raw=True, parser=issue_id_list)
     @with_gitlab_session
-    async def issue_reopen(self, evt: MessageEvent, repo: str, id: int, gl: Gl) -> None:
-        project = gl.projects.get(repo)
-        issue = project.issues.get(id)
-        issue.state_event = "reopen"
-        issue.save()
-
-        await evt.reply(f"Reopened issue #{issue.iid}: {issue.title}")
+    async def issue_reopen(self, evt: MessageEvent, repo: str, ids: List[int], gl: Gl) -> None:
+        await self._set_issue_states(evt, gl, repo, ids, "reopen", "Reopened")
@@ -0,0 +1,177 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple, TYPE_CHECKING
+from functools import partial
+import asyncio
+import time
+
+from aiohttp import ClientError
+
+from mautrix.types import EventID, EventType, MessageType, ReactionEvent, RoomID, UserID
+
+from maubot.handlers import event
+from maubot import MessageEvent
+
+from ..api import (GitlabClient, Paginator, GitlabError, GitlabAuthError, GitlabUnavailable,
+                   GitlabBusy)
+from ..db import AuthInfo
+from .base import Command
+
+if TYPE_CHECKING:
+    from ..bot import GitlabBot
+
+MORE_REACTION = "➡️"
+
+Renderer = Callable[[List[Any]], str]
+Sender = Callable[[str], Awaitable[EventID]]
+
+
+class Continuation(NamedTuple):
+    sender: UserID
+    room_id: RoomID
+    login: AuthInfo
+    paginator: Paginator
+    render: Renderer
+    allow_html: bool
+    expires_at: float
+
+
+class CommandMore(Command):
+    continuations: Dict[EventID, Continuation]
+    latest_continuation: Dict[Tuple[RoomID, UserID], EventID]
+
+    def __init__(self, bot: 'GitlabBot') -> None:
+        super().__init__(bot)
+        self.continuations = {}
+        self.latest_continuation = {}
+
+    def _drop_continuation(self, event_id: EventID) -> Optional[Continuation]:
+        cont = self.continuations.pop(event_id, None)
+        if cont and self.latest_continuation.get((cont.room_id, cont.sender)) == event_id:
+            del self.latest_continuation[cont.room_id, cont.sender]
+        return cont
+
+    def drop_continuations(self, sender: UserID, login: AuthInfo) -> None:
+        """Forget the listings that a user fetched with a login, e.g. when they log out."""
+        login = AuthInfo(login.server.rstrip("/"), login.api_token)
+        for event_id, cont in list(self.continuations.items()):
+            if cont.sender == sender and cont.login == login:
+                self._drop_continuation(event_id).paginator.close()
+
+    def _is_logged_in(self, cont: Continuation) -> bool:
+        return any(AuthInfo(login.server.rstrip("/"), login.api_token) == cont.login
+                   for login in self.bot.db.get_user_logins(cont.sender).logins.values())
+
+    def _expire_continuations(self) -> None:
+        now = time.monotonic()
+        for event_id, cont in list(self.continuations.items()):
+            if cont.expires_at < now:
+                self._drop_continuation(event_id).paginator.close()
+
+    async def send_page(self, evt: MessageEvent, gl: GitlabClient, paginator: Paginator,
+                        render: Renderer, items: Optional[List[Any]] = None, header: str = "",
+                        allow_html: bool = False) -> None:
+        """
+        Reply with a page of a listing. If there are more pages, the user can continue the
+        listing by reacting to the reply or with ``!gitlab more``. Only set ``allow_html`` if
+        the rendered pages can't contain HTML from GitLab users.
+        """
+        if items is None:
+            items = await paginator.next_page()
+        await self._send_page(partial(evt.reply, allow_html=allow_html), evt.room_id,
+                              evt.sender, AuthInfo(gl.url, gl.api_token), paginator, render,
+                              allow_html, items, header)
+
+    async def _send_page(self, send: Sender, room_id: RoomID, sender: UserID, login: AuthInfo,
+                         paginator: Paginator, render: Renderer, allow_html: bool,
+                         items: List[Any], header: str = "") -> None:
+        if not items:
+            await send(header or "Nothing more to show.")
+            paginator.close()
+            return
+        text = header + render(items)
+        if not paginator.has_more:
+            await send(text)
+            return
+        text += f"\n\nReact with {MORE_REACTION} or use `!gitlab more` to show more."
+        event_id = await send(text)
+
+        self._expire_continuations()
+        previous = self.latest_continuation.get((room_id, sender))
+        if previous:
+            self._drop_continuation(previous).paginator.close()
+        timeout = self.bot.config["pagination.continuation_timeout"]
+        self.continuations[event_id] = Continuation(sender, room_id, login, paginator, render,
+                                                    allow_html,
+                                                    expires_at=time.monotonic() + timeout)
+        self.latest_continuation[room_id, sender] = event_id
+        await self.bot.client.react(room_id, event_id, MORE_REACTION)
+
+    async def _continue(self, send: Sender, cont: Continuation) -> None:
+        if not self._is_logged_in(cont):
+            cont.paginator.close()
+            await send(f"You're no longer logged into {cont.login.server}.")
+            return
+        try:
+            items = await cont.paginator.next_page()
+        except GitlabAuthError as e:
+            await send(f"Invalid access token.\n\n{e}")
+            return
+        except GitlabUnavailable as e:
+            await send(f"{e.server} seems to be down, so the bot has stopped sending "
+                       "requests to it for now. Please try again later.")
+            return
+        except GitlabBusy as e:
+            await send(f"{e.server} is busy ({e.reason}), please try again later.")
+            return
+        except asyncio.TimeoutError:
+            await send("GitLab didn't respond in time.")
+            return
+        except GitlabError as e:
+            await send(f"GitLab returned an error: {e}")
+            return
+        except (ClientError, RuntimeError) as e:
+            # The connection pool of the server is closed once nobody is logged into it.
+            self.bot.log.debug(f"Failed to fetch the next page from {cont.login.server}: {e}")
+            await send(f"Failed to fetch the next page from {cont.login.server}, please run "
+                       "the command again.")
+            return
+        await self._send_page(send, cont.room_id, cont.sender, cont.login, cont.paginator,
+                              cont.render, cont.allow_html, items)
+
+    @Command.gitlab.subcommand("more", help="Show the next page of your last listing.")
+    async def more(self, evt: MessageEvent) -> None:
+        self._expire_continuations()
+        event_id = self.latest_continuation.get((evt.room_id, evt.sender))
+        if not event_id:
+            await evt.reply("There's nothing more to show.")
+            return
+        cont = self._drop_continuation(event_id)
+        await self._continue(partial(evt.reply, allow_html=cont.allow_html), cont)
+
+    @event.on(EventType.REACTION)
+    async def more_reaction_handler(self, evt: ReactionEvent) -> None:
+        relates_to = evt.content.relates_to
+        if relates_to.key != MORE_REACTION:
+            return
+        cont = self.continuations.get(relates_to.event_id)
+        # The listing was fetched with the original requester's token.
+        if not cont or cont.sender != evt.sender or cont.expires_at < time.monotonic():
+            return
+        self._drop_continuation(relates_to.event_id)
+        await self._continue(partial(self.bot.client.send_markdown, evt.room_id,
+                                     allow_html=cont.allow_html, msgtype=MessageType.NOTICE),
+                             cont)
@@ -0,0 +1,66 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from maubot import MessageEvent
+
+from ..util import OptUrlAliasArgument, OptRepoArgument, with_gitlab_session
+from ..api import GitlabClient as Gl, GitlabNotFound
+from .base import Command
+
+
+class CommandPoll(Command):
+    @Command.gitlab.subcommand("poll", help="Follow projects that can't have webhooks by polling "
+                                            "their activity.")
+    async def poll(self) -> None:
+        pass
+
+    @poll.subcommand("add", help="Post the activity of a project to this room.")
+    @OptUrlAliasArgument("login", "server URL or alias", arg_num=1)
+    @OptRepoArgument("repo", "repository")
+    @with_gitlab_session
+    async def poll_add(self, evt: MessageEvent, repo: str, gl: Gl) -> None:
+        try:
+            project = await gl.get_project(repo)
+        except GitlabNotFound:
+            await evt.reply(f"Couldn't find {repo} on {gl.url}")
+            return
+        sub = self.bot.db.add_event_subscription(evt.room_id, gl.url,
+                                                 project.path_with_namespace, evt.sender)
+        self.bot.poller.add(sub)
+        await evt.reply(f"Following the activity of {project.path_with_namespace} using your "
+                        "access token")
+
+    @poll.subcommand("remove", aliases=("rm", "delete", "del"),
+                     help="Stop posting the activity of a project to this room.")
+    @OptUrlAliasArgument("login", "server URL or alias", arg_num=1)
+    @OptRepoArgument("repo", "repository")
+    @with_gitlab_session
+    async def poll_remove(self, evt: MessageEvent, repo: str, gl: Gl) -> None:
+        for sub in self.bot.poller.subscriptions(evt.room_id):
+            if sub.server == gl.url and sub.project.lower() == repo.strip("/").lower():
+                self.bot.db.rm_event_subscription(evt.room_id, sub.server, sub.project)
+                self.bot.poller.remove(evt.room_id, sub.server, sub.project)
+                await evt.reply(f"Stopped following {sub.project}")
+                return
+        await evt.reply(f"This room isn't following {repo}")
+
+    @poll.subcommand("list", aliases=("ls", "l"), help="List the projects followed in this room.")
+    async def poll_list(self, evt: MessageEvent) -> None:
+        subs = self.bot.poller.subscriptions(evt.room_id)
+        if not subs:
+            await evt.reply("This room isn't following any projects by polling.")
+            return
+        await evt.reply("This room is following:\n\n"
+                        + "\n".join(f"* {sub.project} on {sub.server}" for sub in subs))
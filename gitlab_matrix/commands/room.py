@@ -14,18 +14,49 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from gitlab import Gitlab as Gl, GitlabGetError
+from typing import Dict, Optional, TYPE_CHECKING
 
-from mautrix.types import EventType
+from mautrix.types import (EventType, RoomID, StateEvent, Membership,
+                           PowerLevelStateEventContent)
 
-from maubot.handlers import command
+from maubot.handlers import command, event
 from maubot import MessageEvent
 
-from ..util import OptUrlAliasArgument, with_gitlab_session
+from ..util import OptUrlAliasArgument, optional_int, with_gitlab_session
+from ..api import GitlabClient as Gl, GitlabNotFound
 from .base import Command
 
+if TYPE_CHECKING:
+    from ..bot import GitlabBot
+
 
 class CommandRoom(Command):
+    power_levels: Dict[RoomID, PowerLevelStateEventContent]
+
+    def __init__(self, bot: 'GitlabBot') -> None:
+        super().__init__(bot)
+        self.power_levels = {}
+
+    async def get_power_levels(self, room_id: RoomID) -> PowerLevelStateEventContent:
+        try:
+            return self.power_levels[room_id]
+        except KeyError:
+            pass
+        levels = await self.bot.client.get_state_event(room_id, EventType.ROOM_POWER_LEVELS)
+        self.power_levels[room_id] = levels
+        return levels
+
+    @event.on(EventType.ROOM_POWER_LEVELS)
+    async def power_levels_handler(self, evt: StateEvent) -> None:
+        self.power_levels[evt.room_id] = evt.content
+
+    @event.on(EventType.ROOM_MEMBER)
+    async def power_levels_member_handler(self, evt: StateEvent) -> None:
+        # The cached levels may be outdated if the bot rejoins the room later.
+        if (evt.state_key == self.bot.client.mxid
+                and evt.content.membership in (Membership.LEAVE, Membership.BAN)):
+            self.power_levels.pop(evt.room_id, None)
+
     @Command.gitlab.subcommand("room", aliases=("r",), help="Manage the settings for this room.")
     async def room(self) -> None:
         pass
@@ -36,17 +67,42 @@ class CommandRoom(Command):
     @command.argument("repo", "repository")
     @with_gitlab_session
     async def default_repo(self, evt: MessageEvent, repo: str, gl: Gl) -> None:
-        power_levels = await self.bot.client.get_state_event(evt.room_id, EventType.ROOM_POWER_LEVELS)
+        power_levels = await self.get_power_levels(evt.room_id)
         if power_levels.get_user_level(evt.sender) < power_levels.state_default:
             await evt.reply("You don't have the permission to change the default repo of this room")
             return
 
         try:
-            project = gl.projects.get(repo)
-        except GitlabGetError as e:
-            if e.response_code == 404:
-                await evt.reply(f"Couldn't find {repo} on {gl.url}")
-                return
-            raise
+            await gl.get_project(repo)
+        except GitlabNotFound:
+            await evt.reply(f"Couldn't find {repo} on {gl.url}")
+            return
         self.bot.db.set_default_repo(evt.room_id, gl.url, repo)
         await evt.reply(f"Changed the default repo to {repo} on {gl.url}")
+
+    @room.subcommand("digest", help="Collect webhook messages in this room into one message "
+                                    "every few seconds. Set to 0 to send them right away.")
+    @command.argument("window", "seconds", required=False, parser=optional_int)
+    async def digest(self, evt: MessageEvent, window: Optional[int]) -> None:
+        if window is None:
+            window = self.bot.db.get_digest_window(evt.room_id)
+            if window > 0:
+                await evt.reply(f"Webhook messages are sent as a digest every {window} seconds")
+            else:
+                await evt.reply("Webhook messages are sent right away")
+            return
+
+        power_levels = await self.get_power_levels(evt.room_id)
+        if power_levels.get_user_level(evt.sender) < power_levels.state_default:
+            await evt.reply("You don't have the permission to change the digest window of this "
+                            "room")
+            return
+        max_window = self.bot.config["digest.max_window"]
+        if not 0 <= window <= max_window:
+            await evt.reply(f"The digest window must be between 0 and {max_window} seconds")
+            return
+        self.bot.db.set_digest_window(evt.room_id, window)
+        if window > 0:
+            await evt.reply(f"Webhook messages will be sent as a digest every {window} seconds")
+        else:
+            await evt.reply("Webhook messages will be sent right away")
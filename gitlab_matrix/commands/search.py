@@ -0,0 +1,67 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import time
+import re
+
+from maubot.handlers import command
+from maubot import MessageEvent
+
+from .base import Command
+
+repo_regex = re.compile(r"\w+/[\w\-./]+")
+kind_names = {
+    "issue": "issue #",
+    "merge_request": "MR !",
+    "note": "comment ",
+    "commit": "commit ",
+}
+
+
+class CommandSearch(Command):
+    @Command.gitlab.subcommand("search", aliases=("find",),
+                               help="Search issues, merge requests, comments and commits that "
+                                    "webhooks sent to this room, in the room's default repo or "
+                                    "in a given repo.")
+    @command.argument("query", "[repo] query", pass_raw=True)
+    async def search(self, evt: MessageEvent, query: str) -> None:
+        if not self.bot.search.enabled:
+            await evt.reply("Search is not available, as it requires SQLite with FTS5")
+            return
+        server = project = None
+        first, *rest = query.split(" ", 1)
+        if repo_regex.fullmatch(first) and rest:
+            project, query = first, rest[0]
+        else:
+            default_repo = self.bot.db.get_default_repo(evt.room_id)
+            if default_repo:
+                server, project = default_repo
+        start = time.monotonic()
+        results = self.bot.search.search(evt.room_id, query, server=server, project=project,
+                                         limit=self.bot.config["search.max_results"])
+        duration = (time.monotonic() - start) * 1000
+        scope = f" in {project}" if project else ""
+        if not results:
+            await evt.reply(f"No results{scope}")
+            return
+        lines = []
+        for result in results:
+            ref = result.ref[:8] if result.kind == "commit" else result.ref
+            name = f"{kind_names.get(result.kind, result.kind + ' ')}{ref}"
+            snippet = " ".join(result.snippet.split())
+            where = "" if project else f"{result.project} "
+            lines.append(f"* {where}[{name}]({result.url}): {result.title}  \n  {snippet}")
+        await evt.reply(f"{len(results)} results{scope} ({duration:.1f} ms):\n\n"
+                        + "\n".join(lines))
@@ -14,17 +14,19 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from gitlab import Gitlab as Gl, GitlabAuthenticationError
 from yarl import URL
 
 from maubot.handlers import command
 from maubot import MessageEvent
 
 from ..util import OptUrlAliasArgument, with_gitlab_session
+from ..api import GitlabClient as Gl, GitlabAuthError
+from ..db import AuthInfo
 from .base import Command
+from .more import CommandMore
 
 
-class CommandServer(Command):
+class CommandServer(CommandMore):
     @Command.gitlab.subcommand("server", aliases=("s",), help="Manage GitLab Servers.")
     async def server(self) -> None:
         pass
@@ -49,10 +51,9 @@ class CommandServer(Command):
     @command.argument("url", "server URL")
     @command.argument("token", "access token", pass_raw=True)
     async def server_login(self, evt: MessageEvent, url: str, token: str) -> None:
-        gl = Gl(url, private_token=token)
         try:
-            gl.auth()
-        except GitlabAuthenticationError:
+            user = await self.bot.gitlab.check_login(AuthInfo(server=url, api_token=token))
+        except GitlabAuthError:
             await evt.reply("Invalid access token")
             return
         except Exception as e:
@@ -61,12 +62,18 @@ class CommandServer(Command):
             await evt.reply(f"GitLab login failed: {e}")
             return
         self.bot.db.add_login(evt.sender, url, token)
-        await evt.reply(f"Successfully logged into GitLab at {url} as {gl.user.name}")
+        await evt.reply(f"Successfully logged into GitLab at {url} as {user.name}")
 
     @server.subcommand("logout", help="Remove the access token from the bot's database.")
     @command.argument("url", "server URL")
     async def server_logout(self, evt: MessageEvent, url: str) -> None:
+        login = self.bot.db.get_login_by_server(evt.sender, url)
+        if not login:
+            await evt.reply(f"You're not logged into {url}")
+            return
         self.bot.db.rm_login(evt.sender, url)
+        self.drop_continuations(evt.sender, login)
+        self.bot.gitlab.invalidate(login)
         await evt.reply(f"Removed {url} from the database.")
 
     @Command.gitlab.subcommand("ping", aliases=("p",), help="Ping the bot.")
@@ -77,6 +84,6 @@ class CommandServer(Command):
     @OptUrlAliasArgument("login", "server URL or alias", arg_num=0)
     @with_gitlab_session
     async def whoami(self, evt: MessageEvent, gl: Gl) -> None:
-        gl.auth()
+        user = await gl.get_current_user()
         await evt.reply(f"You're logged into {URL(gl.url).host} as "
-                        f"[{gl.user.name}]({gl.url}/{gl.user.username})")
+                        f"[{user.name}]({gl.url}/{user.username})")
@@ -0,0 +1,54 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from maubot import MessageEvent
+
+from .base import Command
+
+
+class CommandStats(Command):
+    @Command.gitlab.subcommand("stats", help="Show database statistics of the bot.")
+    async def stats(self, evt: MessageEvent) -> None:
+        db = self.bot.db
+        time_format = self.bot.config["time_format"]
+        retention = self.bot.config["message_retention.days"]
+        count, oldest = db.count_events()
+
+        msg = f"**Stored Matrix event IDs:** {count}"
+        if oldest:
+            msg += f" (oldest from {oldest.strftime(time_format)})"
+        msg += "  \n**Retention:** " + (f"{retention} days" if retention > 0 else "forever")
+        msg += f"  \n**Pruned since start:** {db.pruned_events}"
+        if db.last_pruned_at:
+            msg += f" (last run at {db.last_pruned_at.strftime(time_format)})"
+        msg += (f"  \n**Batched writes:** {db.event_rows} rows in {db.event_commits} commits"
+                f" ({db.commits_saved} commits saved)")
+        sender = self.bot.sender
+        msg += (f"  \n**Matrix sends:** {sender.queued} queued, {sender.retries} retried"
+                f" ({sender.rate_limited} rate limited by the homeserver)")
+        # Other users' servers aren't shown, as their URLs may be private.
+        for server in self.bot.db.get_servers(evt.sender):
+            scheduler = self.bot.gitlab.schedulers.get(server)
+            breaker = self.bot.gitlab.breakers.get(server)
+            if not scheduler or not breaker:
+                continue
+            msg += (f"\n\n**{server}:** {breaker.state.value}, {scheduler.requests} requests, "
+                    f"{scheduler.active} active, {scheduler.queued} queued, "
+                    f"{scheduler.throttled} rate limited")
+            if scheduler.rate_limit_remaining is not None:
+                msg += f", {scheduler.rate_limit_remaining} remaining in rate limit"
+            if scheduler.blocked_for > 0:
+                msg += f", paused for {scheduler.blocked_for:.0f} more seconds"
+        await evt.reply(msg)
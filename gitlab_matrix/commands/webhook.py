@@ -13,17 +13,77 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Awaitable, Callable, List, Optional, Pattern, Tuple
+from functools import partial
+import asyncio
 import secrets
+import re
 
-from gitlab import Gitlab as Gl
+from mautrix.types import JSON
 
+from maubot.handlers import command
 from maubot import MessageEvent
 
 from ..util import OptUrlAliasArgument, OptRepoArgument, with_gitlab_session
+from ..api import (GitlabClient as Gl, APIHook, APIProject, GitlabError, GitlabAuthError,
+                   GitlabNotFound, GitlabBusy, GitlabUnavailable)
 from .base import Command
 
+glob_chars = re.compile(r"[*?\[]")
+glob_token = re.compile(r"(\*\*|\*|\?|\[!?\]?[^\]]*\])")
+
+
+def glob_to_regex(pattern: str) -> Pattern:
+    """
+    Translate a project path pattern to a regex. Unlike in fnmatch, ``*`` and ``?`` don't match
+    slashes, so that ``group/*`` doesn't include subgroups. ``**`` matches across slashes.
+    """
+    parts = []
+    for token in glob_token.split(pattern.lower()):
+        if token == "**":
+            parts.append(".*")
+        elif token == "*":
+            parts.append("[^/]*")
+        elif token == "?":
+            parts.append("[^/]")
+        elif token.startswith("[") and len(token) > 2:
+            negate = token.startswith("[!")
+            chars = token[2 if negate else 1:-1]
+            chars = "".join(char if char == "-" else re.escape(char) for char in chars)
+            parts.append(f"[{'^/' if negate else ''}{chars}]")
+        else:
+            parts.append(re.escape(token))
+    return re.compile("".join(parts) + r"\Z")
+
 
 class CommandWebhook(Command):
+    def hook_config(self, token: str) -> JSON:
+        return {
+            "url": f"{self.bot.webapp_url}/webhooks",
+            "push_events": True,
+            "tag_push_events": True,
+            "issues_events": True,
+            "merge_requests_events": True,
+            "note_events": True,
+            "job_events": True,
+            "token": token,
+        }
+
+    def new_token(self, evt: MessageEvent) -> str:
+        token = secrets.token_urlsafe(64)
+        self.bot.db.add_webhook_room(token, evt.room_id)
+        return token
+
+    async def create_hook(self, evt: MessageEvent, create: Callable[[JSON], Awaitable[APIHook]]
+                          ) -> APIHook:
+        """Create a webhook with a new token, and remove the token if creating the hook fails."""
+        token = self.new_token(evt)
+        try:
+            return await create(self.hook_config(token))
+        except BaseException:
+            self.bot.db.rm_webhook_room(token)
+            raise
+
     @Command.gitlab.subcommand("webhook", help="Manage GitLab webhooks.")
     async def webhook(self) -> None:
         pass
@@ -33,18 +93,97 @@ class CommandWebhook(Command):
     @OptRepoArgument("repo", "repository")
     @with_gitlab_session
     async def webhook_add(self, evt: MessageEvent, repo: str, gl: Gl) -> None:
-        token = secrets.token_urlsafe(64)
-        self.bot.db.add_webhook_room(token, evt.room_id)
-        project = gl.projects.get(repo)
-        hook = project.hooks.create({
-            "url": f"{self.bot.webapp_url}/webhooks",
-            "push_events": True,
-            "tag_push_events": True,
-            "issues_events": True,
-            "merge_requests_events": True,
-            "note_events": True,
-            "job_events": True,
-            "token": token,
-        })
+        project = await gl.get_project(repo)
+        hook = await self.create_hook(evt, partial(gl.create_project_hook, project.id))
         await evt.reply(f"Added [**webhook #{hook.id}**]({project.web_url}/-/hooks/{hook.id}/edit)"
                         f" for {project.path_with_namespace}")
+
+    @webhook.subcommand("add-group", help="Add a webhook for every project in a group, using a "
+                                          "group webhook if the GitLab instance supports it.")
+    @OptUrlAliasArgument("login", "server URL or alias", arg_num=1)
+    @command.argument("group", "group path")
+    @with_gitlab_session
+    async def webhook_add_group(self, evt: MessageEvent, group: str, gl: Gl) -> None:
+        group = group.strip("/")
+        try:
+            hook = await self.create_hook(evt, partial(gl.create_group_hook, group))
+        except GitlabAuthError:
+            raise
+        except GitlabError as e:
+            # Group webhooks are a paid feature, so fall back to hooks for each project.
+            self.bot.log.debug(f"Failed to create group webhook for {group} on {gl.url}: {e}")
+        else:
+            await evt.reply(f"Added [**group webhook #{hook.id}**]"
+                            f"({gl.url}/groups/{group}/-/hooks/{hook.id}/edit) for {group}")
+            return
+        projects = [project async for project in gl.paginate_group_projects(group)]
+        if not projects:
+            await evt.reply(f"Didn't find any projects in {group}")
+            return
+        await self._add_project_hooks(evt, gl, projects)
+
+    @webhook.subcommand("add-many", help="Add webhooks for several projects. Projects can be "
+                                         "glob patterns: group/* matches the projects directly "
+                                         "in a group, and group/** also those in subgroups.")
+    @OptUrlAliasArgument("login", "server URL or alias", arg_num=1)
+    @command.argument("patterns", "projects or patterns", pass_raw=True)
+    @with_gitlab_session
+    async def webhook_add_many(self, evt: MessageEvent, patterns: str, gl: Gl) -> None:
+        projects = {}
+        for pattern in patterns.split():
+            pattern = pattern.strip("/")
+            if not glob_chars.search(pattern):
+                try:
+                    project = await gl.get_project(pattern)
+                except GitlabNotFound:
+                    await evt.reply(f"Couldn't find {pattern} on {gl.url}")
+                    return
+                projects[project.id] = project
+                continue
+            # List the deepest group that doesn't contain wildcards, then filter its projects.
+            group = "/".join(glob_chars.split(pattern, 1)[0].split("/")[:-1])
+            if not group:
+                await evt.reply(f"Patterns must start with a group, e.g. group/*, not {pattern}")
+                return
+            regex = glob_to_regex(pattern)
+            async for project in gl.paginate_group_projects(group):
+                if regex.match(project.path_with_namespace.lower()):
+                    projects[project.id] = project
+        if not projects:
+            await evt.reply("No projects matched")
+            return
+        await self._add_project_hooks(evt, gl, list(projects.values()))
+
+    async def _add_project_hooks(self, evt: MessageEvent, gl: Gl, projects: List[APIProject]
+                                 ) -> None:
+        # All hooks share one token, so they all post to this room.
+        token = self.new_token(evt)
+        hook = self.hook_config(token)
+        created = 0
+        # The scheduler would reject requests beyond its queue limit, so only keep as many in
+        # flight as it can run at once.
+        limit = asyncio.Semaphore(gl.scheduler.concurrency)
+
+        async def add(project: APIProject) -> Tuple[APIProject, Optional[str]]:
+            nonlocal created
+            async with limit:
+                try:
+                    await gl.create_project_hook(project.id, hook)
+                    created += 1
+                    return project, None
+                except GitlabAuthError:
+                    raise
+                except (GitlabError, GitlabBusy, GitlabUnavailable, asyncio.TimeoutError) as e:
+                    return project, str(e) or type(e).__name__
+
+        try:
+            results = await asyncio.gather(*(add(project) for project in projects))
+        finally:
+            if not created:
+                self.bot.db.rm_webhook_room(token)
+        failed = [(project, error) for project, error in results if error]
+        msg = f"Added webhooks for {len(projects) - len(failed)} of {len(projects)} projects"
+        if failed:
+            msg += ".\n\nFailed:\n\n" + "\n".join(f"* {project.path_with_namespace}: {error}"
+                                                   for project, error in failed)
+        await evt.reply(msg)
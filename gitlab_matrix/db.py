@@ -14,10 +14,14 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import List, NamedTuple, Optional
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+from collections import OrderedDict
+from datetime import datetime
 import logging as log
+import asyncio
 
-from sqlalchemy import Column, String, Text, ForeignKeyConstraint, or_, ForeignKey
+from sqlalchemy import (Column, String, Text, Integer, Boolean, DateTime, ForeignKeyConstraint,
+                        ForeignKey, Index, and_, func)
 from sqlalchemy.orm import sessionmaker, relationship, Session
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 from sqlalchemy.engine.base import Engine
@@ -25,10 +29,28 @@ from sqlalchemy.ext.declarative import declarative_base
 
 from mautrix.types import UserID, EventID, RoomID
 
+from .migrations import upgrade
+
 AuthInfo = NamedTuple('AuthInfo', server=str, api_token=str)
 AliasInfo = NamedTuple('AliasInfo', server=str, alias=str)
 DefaultRepoInfo = NamedTuple('DefaultRepoInfo', server=str, repo=str)
 Base = declarative_base()
+# How long to wait before retrying a failed write of batched event IDs, in seconds
+FLUSH_RETRY_DELAY = 5
+
+
+class UserLogins(NamedTuple):
+    logins: Dict[str, AuthInfo]
+    aliases: Dict[str, str]
+    default: Optional[str]
+
+    def __contains__(self, url_alias: str) -> bool:
+        return url_alias in self.logins or url_alias in self.aliases
+
+    def resolve(self, url_alias: Optional[str] = None) -> Optional[AuthInfo]:
+        if url_alias:
+            return self.logins.get(self.aliases.get(url_alias, url_alias))
+        return self.logins.get(self.default)
 
 
 class Token(Base):
@@ -72,12 +94,21 @@ class DefaultRepo(Base):
     repo: str = Column(String(255), nullable=False)
 
 
+class RoomSettings(Base):
+    __tablename__ = "room_settings"
+
+    room_id: RoomID = Column(String(255), primary_key=True)
+    digest_window: int = Column(Integer, nullable=False, default=0)
+
+
 class MatrixMessage(Base):
     __tablename__ = "matrix_message"
 
     message_id: str = Column(String(255), primary_key=True)
     room_id: RoomID = Column(String(255), primary_key=True)
     event_id: EventID = Column(String(255), nullable=False)
+    created_at: datetime = Column(DateTime, nullable=False, default=datetime.utcnow)
+    __table_args__ = (Index("ix_matrix_message_created_at", created_at),)
 
 
 class WebhookToken(Base):
@@ -87,45 +118,215 @@ class WebhookToken(Base):
     secret: str = Column(Text, primary_key=True)
 
 
+class IssueState(Base):
+    __tablename__ = "issue_state"
+
+    server: str = Column(String(255), primary_key=True)
+    project_id: int = Column(Integer, primary_key=True)
+    kind: str = Column(String(16), primary_key=True)
+    iid: int = Column(Integer, primary_key=True)
+    project_path: str = Column(String(255), nullable=False)
+    updated_at: datetime = Column(DateTime, nullable=False)
+    stored_at: datetime = Column(DateTime, nullable=False, default=datetime.utcnow)
+    from_webhook: bool = Column(Boolean, nullable=False, default=False)
+    data: str = Column(Text, nullable=False)
+    __table_args__ = (Index("ix_issue_state_project_path", server, project_path, kind, iid),)
+
+
+class EventSubscription(Base):
+    __tablename__ = "event_subscription"
+
+    room_id: RoomID = Column(String(255), primary_key=True)
+    server: str = Column(String(255), primary_key=True)
+    project: str = Column(String(255), primary_key=True)
+    user_id: UserID = Column(String(255), nullable=False)
+    last_event_id: Optional[int] = Column(Integer, nullable=True)
+    etag: Optional[str] = Column(Text, nullable=True)
+
+
 class Database:
     db: Engine
-
-    def __init__(self, db: Engine) -> None:
+    batch_window: float
+    batch_max_rows: int
+    event_rows: int
+    event_commits: int
+    pruned_events: int
+    last_pruned_at: Optional[datetime]
+    _pending_events: Dict[Tuple[str, RoomID], Tuple[EventID, datetime]]
+    _flush_handle: Optional[asyncio.TimerHandle]
+    login_cache_size: int
+    _user_logins: 'OrderedDict[UserID, UserLogins]'
+    _default_repos: Dict[RoomID, Optional[DefaultRepoInfo]]
+    _digest_windows: Dict[RoomID, int]
+
+    def __init__(self, db: Engine, batch_window: float = 0, batch_max_rows: int = 1,
+                 login_cache_size: int = 1000) -> None:
         self.db = db
-        Base.metadata.create_all(db)
+        upgrade(db, Base.metadata)
         self.Session = sessionmaker(bind=self.db)
+        self.batch_window = batch_window
+        self.batch_max_rows = batch_max_rows
+        self.event_rows = 0
+        self.event_commits = 0
+        self.pruned_events = 0
+        self.last_pruned_at = None
+        self._pending_events = {}
+        self._flush_handle = None
+        self.login_cache_size = login_cache_size
+        self._user_logins = OrderedDict()
+        self._default_repos = {}
+        self._digest_windows = {}
+
+    @property
+    def commits_saved(self) -> int:
+        return self.event_rows - self.event_commits
 
     def get_event(self, message_id: str, room_id: RoomID) -> Optional[EventID]:
         if not message_id:
             return None
+        try:
+            return self._pending_events[(message_id, room_id)][0]
+        except KeyError:
+            pass
         s: Session = self.Session()
         event = s.query(MatrixMessage).get((message_id, room_id))
         return event.event_id if event else None
 
-    def put_event(self, message_id: str, room_id: RoomID, event_id: EventID, merge: bool = False
-                  ) -> None:
+    def put_event(self, message_id: str, room_id: RoomID, event_id: EventID) -> None:
+        self._pending_events[(message_id, room_id)] = (event_id, datetime.utcnow())
+        if self.batch_window <= 0 or len(self._pending_events) >= self.batch_max_rows:
+            self.flush_events()
+        elif not self._flush_handle:
+            self._flush_handle = asyncio.get_event_loop().call_later(self.batch_window,
+                                                                     self.flush_events)
+
+    def flush_events(self, retry: bool = True) -> None:
+        """
+        Write the pending event IDs in one commit. If the commit fails, the rows are kept for
+        another attempt after ``FLUSH_RETRY_DELAY`` seconds, unless ``retry`` is false.
+        """
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending_events:
+            return
+        pending, self._pending_events = self._pending_events, {}
         s: Session = self.Session()
-        evt = MatrixMessage(message_id=message_id, room_id=room_id, event_id=event_id)
-        if merge:
-            s.merge(evt)
-        else:
-            s.add(evt)
+        # Rows are always merged, as several writes for the same message may have been
+        # coalesced into one (e.g. a job reaction being replaced).
+        for (message_id, room_id), (event_id, created_at) in pending.items():
+            s.merge(MatrixMessage(message_id=message_id, room_id=room_id, event_id=event_id,
+                                  created_at=created_at))
+        try:
+            s.commit()
+        except Exception:
+            s.rollback()
+            if not retry:
+                log.exception(f"Failed to store {len(pending)} Matrix event IDs, dropping them")
+                return
+            log.exception(f"Failed to store {len(pending)} Matrix event IDs, retrying in "
+                          f"{FLUSH_RETRY_DELAY} seconds")
+            # Rows written since the swap are newer, so they take precedence.
+            self._pending_events = {**pending, **self._pending_events}
+            self._flush_handle = asyncio.get_event_loop().call_later(FLUSH_RETRY_DELAY,
+                                                                     self.flush_events)
+            return
+        self.event_rows += len(pending)
+        self.event_commits += 1
+        log.debug(f"Stored {len(pending)} Matrix event IDs in one commit "
+                  f"({self.commits_saved} commits saved so far)")
+
+    def count_events(self) -> Tuple[int, Optional[datetime]]:
+        s: Session = self.Session()
+        return s.query(func.count(MatrixMessage.message_id),
+                       func.min(MatrixMessage.created_at)).one()
+
+    def prune_events(self, older_than: datetime, limit: int) -> int:
+        s: Session = self.Session()
+        rows = (s.query(MatrixMessage.room_id, MatrixMessage.message_id)
+                .filter(MatrixMessage.created_at < older_than)
+                .limit(limit))
+        by_room: Dict[RoomID, List[str]] = {}
+        for room_id, message_id in rows:
+            by_room.setdefault(room_id, []).append(message_id)
+        for room_id, message_ids in by_room.items():
+            (s.query(MatrixMessage)
+             .filter(MatrixMessage.room_id == room_id, MatrixMessage.message_id.in_(message_ids))
+             .delete(synchronize_session=False))
         s.commit()
+        count = sum(len(message_ids) for message_ids in by_room.values())
+        self.pruned_events += count
+        self.last_pruned_at = datetime.utcnow()
+        return count
 
-    def get_default_repo(self, room_id: RoomID) -> DefaultRepoInfo:
+    def get_default_repo(self, room_id: RoomID) -> Optional[DefaultRepoInfo]:
+        try:
+            return self._default_repos[room_id]
+        except KeyError:
+            pass
         s: Session = self.Session()
         default = s.query(DefaultRepo).get((room_id,))
-        return DefaultRepoInfo(default.server, default.repo) if default else None
+        info = DefaultRepoInfo(default.server, default.repo) if default else None
+        self._default_repos[room_id] = info
+        return info
 
     def set_default_repo(self, room_id: RoomID, server: str, repo: str) -> None:
         s: Session = self.Session()
         s.merge(DefaultRepo(room_id=room_id, server=server, repo=repo))
         s.commit()
+        self._default_repos[room_id] = DefaultRepoInfo(server, repo)
+
+    def get_digest_window(self, room_id: RoomID) -> int:
+        try:
+            return self._digest_windows[room_id]
+        except KeyError:
+            pass
+        s: Session = self.Session()
+        settings = s.query(RoomSettings).get((room_id,))
+        window = settings.digest_window if settings else 0
+        self._digest_windows[room_id] = window
+        return window
+
+    def set_digest_window(self, room_id: RoomID, window: int) -> None:
+        s: Session = self.Session()
+        s.merge(RoomSettings(room_id=room_id, digest_window=window))
+        s.commit()
+        self._digest_windows[room_id] = window
+
+    def get_user_logins(self, mxid: UserID) -> UserLogins:
+        try:
+            user_logins = self._user_logins[mxid]
+        except KeyError:
+            pass
+        else:
+            self._user_logins.move_to_end(mxid)
+            return user_logins
+        s: Session = self.Session()
+        rows = (s.query(Token.gitlab_server, Token.api_token, Alias.alias,
+                        Default.gitlab_server)
+                .outerjoin(Alias, and_(Alias.user_id == Token.user_id,
+                                       Alias.gitlab_server == Token.gitlab_server))
+                .outerjoin(Default, Default.user_id == Token.user_id)
+                .filter(Token.user_id == mxid))
+        logins: Dict[str, AuthInfo] = {}
+        aliases: Dict[str, str] = {}
+        default: Optional[str] = None
+        for server, api_token, alias, default_server in rows:
+            logins[server] = AuthInfo(server=server, api_token=api_token)
+            if alias:
+                aliases[alias] = server
+            default = default_server or default
+        user_logins = UserLogins(logins=logins, aliases=aliases, default=default)
+        # Users who aren't logged in aren't cached, so anyone running commands can't fill the
+        # cache with empty entries.
+        if logins:
+            self._user_logins[mxid] = user_logins
+            if len(self._user_logins) > self.login_cache_size:
+                self._user_logins.popitem(last=False)
+        return user_logins
 
     def get_servers(self, mxid: UserID) -> List[str]:
-        s = self.Session()
-        rows = s.query(Token).filter(Token.user_id == mxid)
-        return [row.gitlab_server for row in rows]
+        return list(self.get_user_logins(mxid).logins.keys())
 
     def add_login(self, mxid: UserID, url: str, token: str) -> None:
         token_row = Token(user_id=mxid, gitlab_server=url, api_token=token)
@@ -141,43 +342,31 @@ class Database:
             log.warning(e)
             raise e
         s.commit()
+        self._user_logins.pop(mxid, None)
 
     def rm_login(self, mxid: UserID, url: str) -> None:
         s = self.Session()
         token = s.query(Token).get((mxid, url))
         s.delete(token)
         s.commit()
+        self._user_logins.pop(mxid, None)
 
-    def get_login(self, mxid: UserID, url_alias: str = None) -> AuthInfo:
-        s = self.Session()
-        if url_alias:
-            row = (s.query(Token)
-                   .join(Alias)
-                   .filter(Token.user_id == mxid,
-                           or_(Token.gitlab_server == url_alias,
-                               Alias.alias == url_alias)).one())
-        else:
-            row = (s.query(Token)
-                   .join(Default, Default.user_id == Token.user_id)
-                   .filter(Token.user_id == mxid).first())
-        return AuthInfo(server=row.gitlab_server, api_token=row.api_token)
+    def get_login(self, mxid: UserID, url_alias: str = None) -> Optional[AuthInfo]:
+        return self.get_user_logins(mxid).resolve(url_alias)
 
-    def get_login_by_server(self, mxid: UserID, url: str) -> AuthInfo:
-        s = self.Session()
-        row = s.query(Token).get((mxid, url))
-        return AuthInfo(server=row.gitlab_server, api_token=row.api_token)
+    def get_login_by_server(self, mxid: UserID, url: str) -> Optional[AuthInfo]:
+        return self.get_user_logins(mxid).logins.get(url)
 
-    def get_login_by_alias(self, mxid: UserID, alias: str) -> AuthInfo:
-        s = self.Session()
-        row = s.query(Token).join(Alias).filter(Token.user_id == mxid,
-                                                Alias.alias == alias).one()
-        return AuthInfo(server=row.gitlab_server, api_token=row.api_token)
+    def get_login_by_alias(self, mxid: UserID, alias: str) -> Optional[AuthInfo]:
+        logins = self.get_user_logins(mxid)
+        return logins.logins.get(logins.aliases.get(alias))
 
     def add_alias(self, mxid: UserID, url: str, alias: str) -> None:
         s = self.Session()
         alias = Alias(user_id=mxid, gitlab_server=url, alias=alias)
         s.add(alias)
         s.commit()
+        self._user_logins.pop(mxid, None)
 
     def rm_alias(self, mxid: UserID, alias: str) -> None:
         s = self.Session()
@@ -185,27 +374,83 @@ class Database:
                                       Alias.alias == alias).one()
         s.delete(alias)
         s.commit()
+        self._user_logins.pop(mxid, None)
 
     def has_alias(self, user_id: UserID, alias: str) -> bool:
-        s: Session = self.Session()
-        return s.query(Alias).filter(Alias.user_id == user_id, Alias.alias == alias).count() > 0
+        return alias in self.get_user_logins(user_id).aliases
 
     def get_aliases(self, user_id: UserID) -> List[AliasInfo]:
-        s = self.Session()
-        rows = s.query(Alias).filter(Alias.user_id == user_id)
-        return [AliasInfo(row.gitlab_server, row.alias) for row in rows]
+        return [AliasInfo(server, alias)
+                for alias, server in self.get_user_logins(user_id).aliases.items()]
 
     def get_aliases_per_server(self, user_id: UserID, url: str) -> List[AliasInfo]:
-        s = self.Session()
-        rows = s.query(Alias).filter(Alias.user_id == user_id,
-                                     Alias.gitlab_server == url)
-        return [AliasInfo(row.gitlab_server, row.alias) for row in rows]
+        return [alias for alias in self.get_aliases(user_id) if alias.server == url]
 
     def change_default(self, mxid: UserID, url: str) -> None:
         s = self.Session()
         default = s.query(Default).get((mxid,))
         default.gitlab_server = url
         s.commit()
+        self._user_logins.pop(mxid, None)
+
+    def get_issue_state(self, server: str, project: Union[str, int], kind: str, iid: int
+                        ) -> Optional[IssueState]:
+        s: Session = self.Session()
+        query = s.query(IssueState).filter(IssueState.server == server, IssueState.kind == kind,
+                                           IssueState.iid == iid)
+        if str(project).isdigit():
+            query = query.filter(IssueState.project_id == int(project))
+        else:
+            query = query.filter(IssueState.project_path == str(project).strip("/").lower())
+        return query.first()
+
+    def put_issue_state(self, server: str, project_id: int, kind: str, iid: int,
+                        project_path: str, updated_at: datetime, data: str,
+                        from_webhook: bool = False) -> bool:
+        s: Session = self.Session()
+        state = s.query(IssueState).get((server, project_id, kind, iid))
+        # Webhooks may be delivered out of order, so never replace newer data with older.
+        if state and state.updated_at > updated_at:
+            return False
+        s.merge(IssueState(server=server, project_id=project_id, kind=kind, iid=iid,
+                           project_path=project_path.strip("/").lower(), updated_at=updated_at,
+                           stored_at=datetime.utcnow(), from_webhook=from_webhook,
+                           data=data))
+        s.commit()
+        return True
+
+    def get_event_subscriptions(self) -> List[EventSubscription]:
+        s: Session = self.Session()
+        subs = s.query(EventSubscription).all()
+        s.expunge_all()
+        return subs
+
+    def add_event_subscription(self, room_id: RoomID, server: str, project: str,
+                               user_id: UserID) -> EventSubscription:
+        s: Session = self.Session()
+        sub = EventSubscription(room_id=room_id, server=server, project=project,
+                                user_id=user_id, last_event_id=None, etag=None)
+        s.merge(sub)
+        s.commit()
+        return sub
+
+    def rm_event_subscription(self, room_id: RoomID, server: str, project: str) -> bool:
+        s: Session = self.Session()
+        count = (s.query(EventSubscription)
+                 .filter(EventSubscription.room_id == room_id, EventSubscription.server == server,
+                         EventSubscription.project == project)
+                 .delete(synchronize_session=False))
+        s.commit()
+        return count > 0
+
+    def update_event_cursor(self, sub: EventSubscription) -> None:
+        s: Session = self.Session()
+        s.query(EventSubscription).filter(
+            EventSubscription.room_id == sub.room_id, EventSubscription.server == sub.server,
+            EventSubscription.project == sub.project,
+        ).update({"last_event_id": sub.last_event_id, "etag": sub.etag},
+                 synchronize_session=False)
+        s.commit()
 
     def get_webhook_room(self, secret: str) -> Optional[RoomID]:
         s = self.Session()
@@ -217,3 +462,8 @@ class Database:
         webhook_token = WebhookToken(secret=secret, room_id=room_id)
         s.add(webhook_token)
         s.commit()
+
+    def rm_webhook_room(self, secret: str) -> None:
+        s = self.Session()
+        s.query(WebhookToken).filter(WebhookToken.secret == secret).delete()
+        s.commit()
@@ -0,0 +1,92 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Callable, List
+from datetime import datetime
+import logging as log
+
+from sqlalchemy import Column, Integer, MetaData, Table, inspect, select
+from sqlalchemy.engine.base import Engine, Connection
+
+Migration = Callable[[Connection, MetaData], None]
+
+version_table = Table("version", MetaData(), Column("version", Integer, primary_key=True))
+upgrade_steps: List[Migration] = []
+
+
+def migration(func: Migration) -> Migration:
+    upgrade_steps.append(func)
+    return func
+
+
+def create_indexes(conn: Connection, metadata: MetaData, table: str, *names: str) -> None:
+    existing = {index["name"] for index in inspect(conn).get_indexes(table)}
+    for index in metadata.tables[table].indexes:
+        if index.name in names and index.name not in existing:
+            index.create(conn)
+
+
+@migration
+def add_message_created_at(conn: Connection, metadata: MetaData) -> None:
+    """Add created_at column to matrix_message"""
+    columns = {column["name"] for column in inspect(conn).get_columns("matrix_message")}
+    if "created_at" in columns:
+        return
+    conn.execute("ALTER TABLE matrix_message ADD COLUMN created_at TIMESTAMP")
+    # Existing rows start their retention period now.
+    message_table = metadata.tables["matrix_message"]
+    conn.execute(message_table.update().values(created_at=datetime.utcnow()))
+
+
+@migration
+def add_lookup_indexes(conn: Connection, metadata: MetaData) -> None:
+    """Add index for message retention lookups"""
+    create_indexes(conn, metadata, "matrix_message", "ix_matrix_message_created_at")
+
+
+@migration
+def add_issue_state(conn: Connection, metadata: MetaData) -> None:
+    """Add issue_state table for the webhook-fed issue store"""
+    metadata.tables["issue_state"].create(conn, checkfirst=True)
+
+
+@migration
+def add_event_subscription(conn: Connection, metadata: MetaData) -> None:
+    """Add event_subscription table for polled projects"""
+    metadata.tables["event_subscription"].create(conn, checkfirst=True)
+
+
+@migration
+def add_room_settings(conn: Connection, metadata: MetaData) -> None:
+    """Add room_settings table for digest windows"""
+    metadata.tables["room_settings"].create(conn, checkfirst=True)
+
+
+def upgrade(db: Engine, metadata: MetaData) -> None:
+    is_new = "token" not in inspect(db).get_table_names()
+    metadata.create_all(db)
+    version_table.create(db, checkfirst=True)
+    with db.begin() as conn:
+        version = conn.execute(select([version_table.c.version])).scalar()
+        if version is None:
+            # A fresh database was created with the latest schema by create_all above.
+            version = len(upgrade_steps) if is_new else 0
+            conn.execute(version_table.insert().values(version=version))
+    for step in upgrade_steps[version:]:
+        version += 1
+        log.info(f"Upgrading database to v{version}: {step.__doc__}")
+        with db.begin() as conn:
+            step(conn, metadata)
+            conn.execute(version_table.update().values(version=version))
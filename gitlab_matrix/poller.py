@@ -0,0 +1,390 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, List, Optional, Set, Tuple, TYPE_CHECKING
+import asyncio
+import random
+import time
+
+from mautrix.types import JSON, RoomID
+
+from .db import EventSubscription
+from .api import (GitlabClient, GitlabError, GitlabBusy, GitlabUnavailable, APIProject, APIIssue,
+                  APIMergeRequest, APIEvent)
+
+if TYPE_CHECKING:
+    from .bot import GitlabBot
+
+SubscriptionKey = Tuple[RoomID, str, str]
+
+# Events API action names of issues and merge requests, mapped to webhook actions
+actions = {
+    "opened": "open",
+    "closed": "close",
+    "reopened": "reopen",
+    "accepted": "merge",
+}
+null_sha = "0" * 40
+# How many polls may fail to send the same event before it's skipped
+MAX_EVENT_ATTEMPTS = 3
+
+
+class PollState:
+    sub: EventSubscription
+    interval: float
+    next_poll: float
+
+    def __init__(self, sub: EventSubscription, interval: float, next_poll: float) -> None:
+        self.sub = sub
+        self.interval = interval
+        self.next_poll = next_poll
+
+
+def project_json(project: APIProject) -> JSON:
+    return {
+        "id": project.id,
+        "name": project.name or project.path_with_namespace.rsplit("/", 1)[-1],
+        "namespace": project.path_with_namespace.rsplit("/", 1)[0],
+        "description": project.description,
+        "web_url": project.web_url,
+        "homepage": project.web_url,
+        "path_with_namespace": project.path_with_namespace,
+        "default_branch": project.default_branch,
+    }
+
+
+def repository_json(project: APIProject) -> JSON:
+    return {
+        "name": project.name or project.path_with_namespace,
+        "url": project.web_url,
+        "homepage": project.web_url,
+        "description": project.description,
+    }
+
+
+def issue_json(issue: APIIssue) -> JSON:
+    data = issue.serialize()
+    return {
+        "id": issue.id,
+        "iid": issue.iid,
+        "project_id": issue.project_id,
+        "title": issue.title,
+        "description": issue.description or "",
+        "state": issue.state,
+        "url": issue.web_url,
+        "author_id": issue.author.id,
+        "assignee_ids": [user.id for user in issue.assignees],
+        "created_at": data["created_at"],
+        "updated_at": data["updated_at"],
+    }
+
+
+def merge_request_json(mr: APIMergeRequest, project: APIProject) -> JSON:
+    data = mr.serialize()
+    return {
+        "id": mr.id,
+        "iid": mr.iid,
+        "title": mr.title,
+        "description": mr.description or "",
+        "state": mr.state,
+        "url": mr.web_url,
+        "author_id": mr.author.id,
+        "assignee_id": mr.assignees[0].id if mr.assignees else None,
+        "milestone_id": None,
+        "merge_status": mr.merge_status,
+        "work_in_progress": mr.work_in_progress,
+        "source_branch": mr.source_branch,
+        "target_branch": mr.target_branch,
+        "source_project_id": mr.source_project_id,
+        "target_project_id": mr.target_project_id,
+        # Forks aren't looked up, so the source is approximated with the target project.
+        "source": project_json(project),
+        "target": project_json(project),
+        "last_commit": {"id": mr.sha or "", "message": ""},
+        "created_at": data["created_at"],
+        "updated_at": data["updated_at"],
+    }
+
+
+class EventPoller:
+    """
+    Follows projects that can't have webhooks by polling their events, and renders new events
+    with the webhook message templates. Projects with recent activity are polled more often.
+    """
+    bot: 'GitlabBot'
+    states: Dict[SubscriptionKey, PollState]
+    task: Optional[asyncio.Task]
+    _polls: Set[asyncio.Task]
+    _failures: Dict[SubscriptionKey, Tuple[int, int]]
+    _wakeup: asyncio.Event
+    _limit: asyncio.Semaphore
+
+    def __init__(self, bot: 'GitlabBot') -> None:
+        self.bot = bot
+        self.states = {}
+        self.task = None
+        self._polls = set()
+        self._failures = {}
+
+    @staticmethod
+    def _key(sub: EventSubscription) -> SubscriptionKey:
+        return sub.room_id, sub.server, sub.project
+
+    def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._limit = asyncio.Semaphore(self.bot.config["poller.concurrency"])
+        now = time.monotonic()
+        min_interval = self.bot.config["poller.min_interval"]
+        for sub in self.bot.db.get_event_subscriptions():
+            # Spread the first polls out, so that hundreds of projects don't poll at once.
+            next_poll = now + random.uniform(0, min_interval)
+            self.states[self._key(sub)] = PollState(sub, min_interval, next_poll)
+        self.task = asyncio.create_task(self.loop())
+
+    async def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+        for task in self._polls:
+            task.cancel()
+
+    def add(self, sub: EventSubscription) -> None:
+        self.states[self._key(sub)] = PollState(sub, self.bot.config["poller.min_interval"],
+                                                next_poll=time.monotonic())
+        self._wakeup.set()
+
+    def subscriptions(self, room_id: RoomID) -> List[EventSubscription]:
+        return [state.sub for state in self.states.values() if state.sub.room_id == room_id]
+
+    def remove(self, room_id: RoomID, server: str, project: str) -> None:
+        self.states.pop((room_id, server, project), None)
+        self._failures.pop((room_id, server, project), None)
+
+    async def loop(self) -> None:
+        while True:
+            now = time.monotonic()
+            for state in self.states.values():
+                if state.next_poll <= now:
+                    # Don't start another poll of the same project until this one is done.
+                    state.next_poll = float("inf")
+                    task = asyncio.create_task(self._poll(state))
+                    self._polls.add(task)
+                    task.add_done_callback(self._polls.discard)
+            next_poll = min((state.next_poll for state in self.states.values()),
+                            default=float("inf"))
+            timeout = None if next_poll == float("inf") else max(0.0, next_poll - now)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _poll(self, state: PollState) -> None:
+        active = False
+        try:
+            async with self._limit:
+                active = await self.poll(state.sub)
+        except (GitlabError, GitlabBusy, GitlabUnavailable, asyncio.TimeoutError) as e:
+            self.bot.log.debug(f"Failed to poll events of {state.sub.project} on "
+                               f"{state.sub.server}: {e}")
+        except Exception:
+            self.bot.log.exception(f"Failed to poll events of {state.sub.project} on "
+                                   f"{state.sub.server}")
+        if active:
+            state.interval = self.bot.config["poller.min_interval"]
+        else:
+            state.interval = min(state.interval * self.bot.config["poller.backoff"],
+                                 self.bot.config["poller.max_interval"])
+        state.next_poll = time.monotonic() + state.interval
+        self._wakeup.set()
+
+    async def poll(self, sub: EventSubscription) -> bool:
+        login = self.bot.db.get_login_by_server(sub.user_id, sub.server)
+        if not login:
+            self.bot.log.debug(f"{sub.user_id} is no longer logged into {sub.server}, "
+                               f"not polling {sub.project}")
+            return False
+        gl = self.bot.gitlab.client(login)
+        per_page = self.bot.config["poller.page_size"]
+        etag, events = await gl.list_project_events(sub.project, etag=sub.etag,
+                                                    per_page=per_page)
+        if events is None:
+            return False
+        first_poll = sub.last_event_id is None
+        new_events = sorted((evt for evt in events
+                             if first_poll or evt.id > sub.last_event_id),
+                            key=lambda evt: evt.id)
+        # Only events after the subscription was created are sent.
+        if first_poll or not new_events:
+            self._move_cursor(sub, etag, new_events[-1].id if new_events else None)
+            return False
+        if len(new_events) >= per_page:
+            self.bot.log.warning(f"Got a full page of new events for {sub.project}, "
+                                 "some events may have been missed")
+        if sub.room_id not in self.bot.webhook.joined_rooms:
+            self._move_cursor(sub, etag, new_events[-1].id)
+            return True
+        project = await gl.get_project(sub.project)
+        for evt in new_events:
+            # If fetching the details fails temporarily, the exception stops the poll with
+            # the cursor on the last handled event, so the rest are retried on the next poll.
+            try:
+                hook = await self.to_hook(gl, project, evt)
+            except GitlabError as e:
+                if e.status not in (403, 404):
+                    raise
+                # The target was deleted or made private since the event.
+                self.bot.log.debug(f"Failed to fetch details of event {evt.id} in "
+                                   f"{sub.project}: {e}")
+                hook = None
+            if hook:
+                evt_type, body = hook
+                try:
+                    await self.bot.webhook.process_hook(body, evt_type, sub.room_id)
+                except Exception:
+                    if self._should_retry(sub, evt):
+                        self.bot.log.warning(f"Failed to process event {evt.id} in "
+                                             f"{sub.project}, retrying on the next poll",
+                                             exc_info=True)
+                        return True
+                    self.bot.log.exception(f"Failed to process event {evt.id} in "
+                                           f"{sub.project} {MAX_EVENT_ATTEMPTS} times, "
+                                           "skipping it")
+            self._failures.pop(self._key(sub), None)
+            self._move_cursor(sub, sub.etag, evt.id)
+        self._move_cursor(sub, etag, None)
+        return True
+
+    def _should_retry(self, sub: EventSubscription, evt: APIEvent) -> bool:
+        # Keep count of consecutive failures, so that an event that can never be sent doesn't
+        # block the subscription forever.
+        event_id, attempts = self._failures.get(self._key(sub), (evt.id, 0))
+        attempts = attempts + 1 if event_id == evt.id else 1
+        self._failures[self._key(sub)] = (evt.id, attempts)
+        return attempts < MAX_EVENT_ATTEMPTS
+
+    def _move_cursor(self, sub: EventSubscription, etag: Optional[str],
+                     last_event_id: Optional[int]) -> None:
+        # The ETag is only saved once all events of the response have been handled, as the
+        # server would otherwise answer the retry with 304 Not Modified.
+        if etag == sub.etag and last_event_id is None:
+            return
+        sub.etag = etag
+        if last_event_id is not None:
+            sub.last_event_id = last_event_id
+        self.bot.db.update_event_cursor(sub)
+
+    async def to_hook(self, gl: GitlabClient, project: APIProject, evt: APIEvent
+                      ) -> Optional[Tuple[str, JSON]]:
+        """Convert an entry from the Events API into a webhook payload."""
+        base = {
+            "user": evt.author.serialize(),
+            "project": project_json(project),
+            "repository": repository_json(project),
+        }
+        if evt.push_data:
+            return await self._push_hook(gl, project, evt, base)
+        elif evt.note:
+            if evt.note.system:
+                return None
+            note = evt.note.serialize()
+            if evt.note.noteable_type == "Issue":
+                issue = await gl.get_issue(project.id, evt.note.noteable_iid)
+                target, url = {"issue": issue_json(issue)}, issue.web_url
+            elif evt.note.noteable_type == "MergeRequest":
+                mr = await gl.get_merge_request(project.id, evt.note.noteable_iid)
+                target, url = {"merge_request": merge_request_json(mr, project)}, mr.web_url
+            else:
+                return None
+            return "Note Hook", {
+                **base,
+                **target,
+                "object_kind": "note",
+                "project_id": project.id,
+                "object_attributes": {
+                    "id": evt.note.id,
+                    "note": evt.note.body,
+                    "noteable_type": evt.note.noteable_type,
+                    "project_id": project.id,
+                    "url": f"{url}#note_{evt.note.id}",
+                    "author_id": evt.author.id,
+                    "created_at": note["created_at"],
+                    "updated_at": note["updated_at"],
+                },
+            }
+        action = actions.get(evt.action_name)
+        if not action or not evt.target_iid:
+            return None
+        elif evt.target_type == "Issue":
+            issue = await gl.get_issue(project.id, evt.target_iid)
+            return "Issue Hook", {
+                **base,
+                "object_kind": "issue",
+                "object_attributes": {**issue_json(issue), "action": action},
+                "assignees": [user.serialize() for user in issue.assignees],
+                "labels": [],
+            }
+        elif evt.target_type == "MergeRequest":
+            mr = await gl.get_merge_request(project.id, evt.target_iid)
+            return "Merge Request Hook", {
+                **base,
+                "object_kind": "merge_request",
+                "object_attributes": {**merge_request_json(mr, project), "action": action},
+                "labels": [],
+                "changes": {},
+            }
+        return None
+
+    @staticmethod
+    async def _push_hook(gl: GitlabClient, project: APIProject, evt: APIEvent, base: JSON
+                         ) -> Optional[Tuple[str, JSON]]:
+        push = evt.push_data
+        if not push.ref:
+            return None
+        is_tag = push.ref_type == "tag"
+        before = push.commit_from or null_sha
+        after = push.commit_to or null_sha
+        commits = []
+        if push.commit_from and push.commit_to and push.commit_count > 1:
+            commits = [{
+                "id": commit.id,
+                "message": commit.message,
+                "url": commit.web_url or f"{project.web_url}/-/commit/{commit.id}",
+                "author": {"name": commit.author_name, "email": commit.author_email or ""},
+            } for commit in await gl.compare_commits(project.id, push.commit_from,
+                                                     push.commit_to)]
+        elif push.commit_to and push.commit_count > 0:
+            commits = [{
+                "id": push.commit_to,
+                "message": push.commit_title or "",
+                "url": f"{project.web_url}/-/commit/{push.commit_to}",
+                "author": {"name": evt.author.name, "email": ""},
+            }]
+        return "Tag Push Hook" if is_tag else "Push Hook", {
+            **base,
+            "object_kind": "tag_push" if is_tag else "push",
+            "before": before,
+            "after": after,
+            "ref": f"refs/{'tags' if is_tag else 'heads'}/{push.ref}",
+            "checkout_sha": after,
+            "message": None,
+            "user_id": evt.author.id,
+            "user_name": evt.author.name,
+            "user_username": evt.author.username,
+            "user_email": "",
+            "user_avatar": evt.author.avatar_url or "",
+            "project_id": project.id,
+            "commits": commits,
+            "total_commits_count": push.commit_count,
+        }
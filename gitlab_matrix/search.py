@@ -0,0 +1,164 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+import logging as log
+import hashlib
+import re
+
+from sqlalchemy import text
+from sqlalchemy.engine.base import Engine
+from sqlalchemy.exc import OperationalError
+
+from mautrix.types import RoomID
+
+from .types import (GitlabEvent, GitlabIssueEvent, GitlabMergeRequestEvent, GitlabCommentEvent,
+                    GitlabPushEvent)
+
+word_regex = re.compile(r"\w+")
+
+SearchDocument = NamedTuple('SearchDocument', kind=str, ref=str, url=str, title=str, body=str)
+
+
+class SearchResult(NamedTuple):
+    project: str
+    kind: str
+    ref: str
+    url: str
+    title: str
+    snippet: str
+
+
+class SearchIndex:
+    """
+    Full-text index of issues, merge requests, comments and commits seen in webhooks, stored
+    in an SQLite FTS5 table. Search is unavailable on other databases.
+
+    Documents are indexed per room that the webhook delivered them to, and searches only see
+    the documents of one room, so that rooms can't read about projects they aren't subscribed
+    to.
+    """
+    db: Engine
+    enabled: bool
+
+    def __init__(self, db: Engine) -> None:
+        self.db = db
+        self.enabled = False
+        if db.dialect.name != "sqlite":
+            log.info("Full-text search requires SQLite, disabling it")
+            return
+        try:
+            with db.begin() as conn:
+                conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+                             "room_id UNINDEXED, server UNINDEXED, project UNINDEXED, "
+                             "kind UNINDEXED, ref UNINDEXED, url UNINDEXED, title, body)")
+        except OperationalError:
+            log.warning("SQLite was built without FTS5, disabling full-text search",
+                        exc_info=True)
+            return
+        self.enabled = True
+
+    @staticmethod
+    def _rowid(room_id: RoomID, server: str, project: str, kind: str, ref: str) -> int:
+        # A stable rowid per document lets updates replace the old version without scanning
+        # the unindexed key columns.
+        key = "\0".join((room_id, server, project, kind, ref)).encode("utf-8")
+        return int.from_bytes(hashlib.sha256(key).digest()[:8], "big") >> 1
+
+    def add(self, room_id: RoomID, server: str, project: str, docs: Iterable[SearchDocument]
+            ) -> None:
+        if not self.enabled:
+            return
+        server = server.rstrip("/")
+        project = project.strip("/").lower()
+        rows = [{"rowid": self._rowid(room_id, server, project, doc.kind, doc.ref),
+                 "room_id": room_id, "server": server, "project": project, **doc._asdict()}
+                for doc in docs]
+        if not rows:
+            return
+        with self.db.begin() as conn:
+            conn.execute(text("INSERT OR REPLACE INTO search_index "
+                              "(rowid, room_id, server, project, kind, ref, url, title, body) "
+                              "VALUES (:rowid, :room_id, :server, :project, :kind, :ref, :url, "
+                              ":title, :body)"), rows)
+
+    def add_event(self, evt: GitlabEvent, room_id: RoomID) -> None:
+        if not self.enabled:
+            return
+        project = getattr(evt, "project", None)
+        if not project or not project.path_with_namespace or not project.web_url:
+            return
+        try:
+            self.add(room_id, project.gitlab_base_url, project.path_with_namespace,
+                     self._documents(evt))
+        except Exception:
+            # The index is only a convenience, so don't let it block the message.
+            log.exception("Failed to index webhook event")
+
+    @staticmethod
+    def _documents(evt: GitlabEvent) -> List[SearchDocument]:
+        if isinstance(evt, GitlabIssueEvent):
+            attrs = evt.object_attributes
+            return [SearchDocument("issue", str(attrs.issue_id), attrs.url, attrs.title,
+                                   attrs.description or "")]
+        elif isinstance(evt, GitlabMergeRequestEvent):
+            attrs = evt.object_attributes
+            return [SearchDocument("merge_request", str(attrs.merge_request_id), attrs.url,
+                                   attrs.title, attrs.description or "")]
+        elif isinstance(evt, GitlabCommentEvent):
+            attrs = evt.object_attributes
+            if evt.issue:
+                title = f"Comment on issue #{evt.issue.issue_id}: {evt.issue.title}"
+            elif evt.merge_request:
+                title = (f"Comment on merge request !{evt.merge_request.merge_request_id}: "
+                         f"{evt.merge_request.title}")
+            elif evt.commit:
+                title = f"Comment on commit {evt.commit.id[:8]}"
+            else:
+                title = "Comment"
+            return [SearchDocument("note", str(attrs.id), attrs.url, title, attrs.note or "")]
+        elif isinstance(evt, GitlabPushEvent):
+            return [SearchDocument("commit", commit.id, commit.url or "",
+                                   commit.message.strip().split("\n", 1)[0], commit.message)
+                    for commit in evt.commits]
+        return []
+
+    @staticmethod
+    def _match_query(query: str) -> Optional[str]:
+        words = word_regex.findall(query)
+        if not words:
+            return None
+        # Quote every word so FTS5 query syntax in user input is treated as plain text, and
+        # let the last word match as a prefix while the user is still typing it.
+        return " ".join(f'"{word}"' for word in words) + "*"
+
+    def search(self, room_id: RoomID, query: str, server: Optional[str] = None,
+               project: Optional[str] = None, limit: int = 10) -> List[SearchResult]:
+        match = self._match_query(query)
+        if not self.enabled or not match:
+            return []
+        conditions: List[str] = ["search_index MATCH :match", "room_id = :room_id"]
+        params = {"match": match, "room_id": room_id, "limit": limit}
+        if server:
+            conditions.append("server = :server")
+            params["server"] = server.rstrip("/")
+        if project:
+            conditions.append("project = :project")
+            params["project"] = project.strip("/").lower()
+        rows: Iterable[Tuple[str, ...]] = self.db.execute(text(
+            "SELECT project, kind, ref, url, title, "
+            "snippet(search_index, -1, '**', '**', '…', 16) FROM search_index "
+            f"WHERE {' AND '.join(conditions)} ORDER BY rank LIMIT :limit"), params)
+        return [SearchResult(*row) for row in rows]
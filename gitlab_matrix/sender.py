@@ -0,0 +1,202 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+from enum import IntEnum
+import logging as log
+import asyncio
+import itertools
+import json
+import time
+
+from aiohttp import ClientConnectionError
+
+from mautrix.client import Client
+from mautrix.errors import MatrixRequestError
+from mautrix.types import EventContent, EventID, EventType, RoomID
+
+
+class Priority(IntEnum):
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+
+class TokenBucket:
+    rate: float
+    burst: float
+    tokens: float
+    updated_at: float
+    blocked_until: float
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0
+
+    def delay(self, now: float) -> float:
+        """How long to wait until a token is available."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def block(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+T = TypeVar("T")
+Waiter = Tuple[Priority, int, RoomID, asyncio.Future]
+
+
+class MatrixSender:
+    """
+    Paces the webhook messages sent to Matrix with a global and a per-room token bucket, sends
+    higher priority events first, and retries sends that the homeserver rate limited.
+    """
+    client: Client
+    room_rate: float
+    room_burst: float
+    max_retries: int
+    global_bucket: TokenBucket
+    room_buckets: Dict[RoomID, TokenBucket]
+    rate_limited: int
+    retries: int
+    _waiters: List[Waiter]
+    _counter: itertools.count
+    _timer: Optional[asyncio.TimerHandle]
+
+    def __init__(self, client: Client, rate: float = 10, burst: float = 20,
+                 room_rate: float = 2, room_burst: float = 5, max_retries: int = 5) -> None:
+        self.client = client
+        self.room_rate = room_rate
+        self.room_burst = room_burst
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(rate, burst)
+        self.room_buckets = {}
+        self.rate_limited = 0
+        self.retries = 0
+        self._waiters = []
+        self._counter = itertools.count()
+        self._timer = None
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def _room_bucket(self, room_id: RoomID) -> TokenBucket:
+        try:
+            return self.room_buckets[room_id]
+        except KeyError:
+            bucket = self.room_buckets[room_id] = TokenBucket(self.room_rate, self.room_burst)
+            return bucket
+
+    async def _acquire(self, room_id: RoomID, priority: Priority) -> None:
+        fut = asyncio.get_event_loop().create_future()
+        self._waiters.append((priority, next(self._counter), room_id, fut))
+        self._dispatch()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            self._waiters = [waiter for waiter in self._waiters if waiter[3] is not fut]
+            raise
+
+    def _dispatch(self) -> None:
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        next_check = float("inf")
+        # Waiters are served in priority order, but one that's held back by its room's bucket
+        # doesn't block waiters of other rooms.
+        for waiter in sorted(self._waiters):
+            _, _, room_id, fut = waiter
+            global_delay = self.global_bucket.delay(now)
+            if global_delay > 0:
+                next_check = min(next_check, global_delay)
+                break
+            room_delay = self._room_bucket(room_id).delay(now)
+            if room_delay > 0:
+                next_check = min(next_check, room_delay)
+                continue
+            self.global_bucket.take()
+            self._room_bucket(room_id).take()
+            self._waiters.remove(waiter)
+            fut.set_result(None)
+        if self._waiters and next_check < float("inf"):
+            self._timer = asyncio.get_event_loop().call_later(next_check, self._dispatch)
+
+    @staticmethod
+    def _retry_after(e: MatrixRequestError) -> Optional[float]:
+        retry_after_ms = getattr(e, "retry_after_ms", None)
+        if retry_after_ms is None:
+            try:
+                retry_after_ms = json.loads(getattr(e, "text", "") or "{}").get("retry_after_ms")
+            except (ValueError, AttributeError):
+                pass
+        return retry_after_ms / 1000 if retry_after_ms else None
+
+    async def _send(self, room_id: RoomID, priority: Priority, func: Callable[..., Awaitable[T]],
+                    *args: Any, **kwargs: Any) -> T:
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(room_id, priority)
+            backoff = min(2 ** attempt, 60)
+            try:
+                return await func(*args, **kwargs)
+            except MatrixRequestError as e:
+                if e.errcode != "M_LIMIT_EXCEEDED" and getattr(e, "http_status", 0) < 500:
+                    raise
+                elif attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                if e.errcode == "M_LIMIT_EXCEEDED":
+                    self.rate_limited += 1
+                    delay = self._retry_after(e) or backoff
+                    log.debug(f"Rate limited while sending to {room_id}, "
+                              f"pausing all sends for {delay} seconds")
+                    # The limit applies to the whole account, so hold back all rooms. The
+                    # retry waits for the bucket like any other send.
+                    self.global_bucket.block(delay)
+                    continue
+            except (ClientConnectionError, asyncio.TimeoutError):
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+            log.debug(f"Failed to send to {room_id}, retrying in {backoff} seconds")
+            await asyncio.sleep(backoff)
+
+    async def send_message_event(self, room_id: RoomID, event_type: EventType,
+                                 content: EventContent, priority: Priority = Priority.NORMAL,
+                                 txn_id: Optional[str] = None) -> EventID:
+        # The same transaction ID is used for every attempt, so the homeserver drops
+        # duplicates if an attempt did go through.
+        txn_id = txn_id or self.client.api.get_txn_id()
+        return await self._send(room_id, priority, self.client.send_message_event, room_id,
+                                event_type, content, txn_id=txn_id)
+
+    async def send_message(self, room_id: RoomID, content: EventContent,
+                           priority: Priority = Priority.NORMAL, txn_id: Optional[str] = None
+                           ) -> EventID:
+        return await self.send_message_event(room_id, EventType.ROOM_MESSAGE, content,
+                                             priority=priority, txn_id=txn_id)
+
+    async def redact(self, room_id: RoomID, event_id: EventID,
+                     priority: Priority = Priority.NORMAL) -> EventID:
+        return await self._send(room_id, priority, self.client.redact, room_id, event_id)
@@ -0,0 +1,133 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Dict, Optional, Union
+from datetime import datetime, timedelta, timezone
+import json
+
+from mautrix.types import JSON
+
+from .db import Database
+from .types import GitlabEvent, GitlabIssueEvent, GitlabMergeRequestEvent
+from .api import APIIssue
+
+ISSUE = "issue"
+MERGE_REQUEST = "merge_request"
+
+
+def as_utc(dt: datetime) -> datetime:
+    # Webhook timestamps like "2021-01-01 12:00:00 UTC" are parsed without a timezone.
+    return dt.replace(tzinfo=timezone.utc) if not dt.tzinfo else dt.astimezone(timezone.utc)
+
+
+def project_path_from_url(server: str, web_url: str) -> str:
+    return web_url[len(server):].strip("/").split("/-/", 1)[0]
+
+
+class IssueStore:
+    """
+    Keeps the latest known state of issues and merge requests, fed by webhooks and API
+    responses, so that read commands don't need to ask GitLab again.
+
+    Rows written by webhooks are trusted for ``max_age``, since the webhook will replace them
+    when the issue changes. Rows from API responses aren't kept up to date by anything, so
+    they expire after ``api_max_age``. Confidential issues are never served from the store.
+    """
+    db: Database
+    max_age: timedelta
+    api_max_age: timedelta
+
+    def __init__(self, db: Database, max_age: float, api_max_age: float) -> None:
+        self.db = db
+        self.max_age = timedelta(seconds=max_age)
+        self.api_max_age = timedelta(seconds=min(api_max_age, max_age))
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_age > timedelta(0)
+
+    def _get(self, server: str, project: Union[str, int], kind: str, iid: int
+             ) -> Optional[JSON]:
+        if not self.enabled:
+            return None
+        state = self.db.get_issue_state(server.rstrip("/"), project, kind, iid)
+        if not state:
+            return None
+        max_age = self.max_age if state.from_webhook else self.api_max_age
+        if datetime.utcnow() - state.stored_at > max_age:
+            return None
+        data = json.loads(state.data)
+        return None if data.get("confidential") else data
+
+    def _put(self, server: str, kind: str, data: Dict[str, Any], updated_at: datetime,
+             from_webhook: bool = False) -> None:
+        if not self.enabled:
+            return
+        server = server.rstrip("/")
+        self.db.put_issue_state(server, data["project_id"], kind, data["iid"],
+                                project_path=project_path_from_url(server, data["web_url"]),
+                                updated_at=as_utc(updated_at).replace(tzinfo=None),
+                                data=json.dumps(data), from_webhook=from_webhook)
+
+    def get_issue(self, server: str, project: Union[str, int], iid: int) -> Optional[APIIssue]:
+        data = self._get(server, project, ISSUE, iid)
+        return APIIssue.deserialize(data) if data else None
+
+    def put_issue(self, server: str, issue: APIIssue) -> None:
+        self._put(server, ISSUE, issue.serialize(), issue.updated_at)
+
+    def update_from_webhook(self, evt: GitlabEvent) -> None:
+        if isinstance(evt, GitlabIssueEvent):
+            kind, attrs = ISSUE, evt.object_attributes
+            assignees = evt.assignees or []
+            labels = evt.labels or attrs.labels or []
+            iid = attrs.issue_id
+            extra = {"confidential": attrs.confidential}
+        elif isinstance(evt, GitlabMergeRequestEvent):
+            kind, attrs = MERGE_REQUEST, evt.object_attributes
+            assignees = [attrs.assignee] if attrs.assignee else []
+            labels = evt.labels or []
+            iid = attrs.merge_request_id
+            extra = {"source_branch": attrs.source_branch, "target_branch": attrs.target_branch,
+                     "merge_status": attrs.merge_status}
+        else:
+            return
+        server = evt.project.gitlab_base_url
+        if not self.enabled:
+            return
+        if evt.user.id is not None and evt.user.id == attrs.author_id:
+            author = evt.user.serialize()
+        else:
+            # Hooks only contain the author's ID, so reuse what an earlier event or API
+            # response said about them.
+            previous = self.db.get_issue_state(server.rstrip("/"), attrs.project_id, kind, iid)
+            if not previous:
+                return
+            author = json.loads(previous.data)["author"]
+        self._put(server, kind, {
+            "id": attrs.id,
+            "iid": iid,
+            "project_id": attrs.project_id,
+            "title": attrs.title,
+            "state": attrs.state,
+            "web_url": attrs.url,
+            "author": author,
+            "created_at": as_utc(attrs.created_at).isoformat(),
+            "updated_at": as_utc(attrs.updated_at).isoformat(),
+            "description": attrs.description,
+            "assignees": [user.serialize() for user in assignees],
+            "labels": [label.title for label in labels],
+            **extra,
+        }, attrs.updated_at, from_webhook=True)
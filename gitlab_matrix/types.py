@@ -554,6 +554,10 @@ class BuildStatus(ExtensibleEnum):
     def color_circle(self) -> str:
         return _build_status_circles[self]
 
+    @property
+    def is_finished(self) -> bool:
+        return self in (BuildStatus.SUCCESS, BuildStatus.FAILED, BuildStatus.CANCELED)
+
 
 _build_status_circles: Dict[BuildStatus, str] = {
     BuildStatus.CREATED: "🟡",
@@ -696,17 +700,19 @@ class GitlabPushEvent(SerializableAttrs, GitlabEvent):
         return f"push-{self.project_id}-{self.checkout_sha}-{self.ref_name}"
 
 
+def split_changes(changes: Optional[GitlabChanges]) -> List[GitlabChanges]:
+    if not changes:
+        return []
+    return [GitlabChanges(**{field.name: getattr(changes, field.name)})
+            for field in attr.fields(GitlabChanges) if getattr(changes, field.name)]
+
+
 def split_updates(evt: Union['GitlabIssueEvent', 'GitlabMergeRequestEvent']) -> List[GitlabEvent]:
     if not evt.changes:
         return [evt]
-    output = []
     # We don't want to handle multiple issue change types in a single Matrix message,
     # so split each change into a separate event.
-    for field in attr.fields(GitlabChanges):
-        value = getattr(evt.changes, field.name)
-        if value:
-            output.append(attr.evolve(evt, changes=GitlabChanges(**{field.name: value})))
-    return output
+    return [attr.evolve(evt, changes=changes) for changes in split_changes(evt.changes)]
 
 
 @dataclass
@@ -738,12 +744,16 @@ class GitlabIssueEvent(SerializableAttrs, GitlabEvent):
 
     @property
     def event_properties(self) -> Iterable[str]:
-        return "action",
+        return "action", "split_changes"
 
     @property
     def action(self) -> Action:
         return self.object_attributes.action
 
+    @property
+    def split_changes(self) -> List[GitlabChanges]:
+        return split_changes(self.changes)
+
 
 @dataclass
 class GitlabCommentEvent(SerializableAttrs, GitlabEvent):
@@ -793,12 +803,16 @@ class GitlabMergeRequestEvent(SerializableAttrs, GitlabEvent):
 
     @property
     def event_properties(self) -> Iterable[str]:
-        return "action",
+        return "action", "split_changes"
 
     @property
     def action(self) -> Action:
         return self.object_attributes.action
 
+    @property
+    def split_changes(self) -> List[GitlabChanges]:
+        return split_changes(self.changes)
+
 
 @dataclass
 class GitlabWikiPageEvent(SerializableAttrs, GitlabEvent):
@@ -1,5 +1,8 @@
 from .config import Config
+from .contrast import contrast, hex_to_rgb, rgb_to_hex
 from .decorators import with_gitlab_session
+from .diff import (diff_size, encoded_size, to_unified_diff, pack_diff_messages,
+                   highlight_diff, highlight_diff_lines)
 from .template import TemplateManager, TemplateUtil
-from .contrast import contrast, hex_to_rgb, rgb_to_hex
-from .arguments import OptRepoArgument, OptUrlAliasArgument, optional_int, quote_parser, sigil_int
+from .arguments import (OptRepoArgument, OptUrlAliasArgument, optional_int, quote_parser,
+                        sigil_int, issue_id_list)
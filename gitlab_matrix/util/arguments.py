@@ -14,7 +14,7 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Tuple, Any, Optional, TYPE_CHECKING
+from typing import List, Tuple, Any, Optional, TYPE_CHECKING
 import re
 
 from maubot import MessageEvent
@@ -34,11 +34,10 @@ class OptUrlAliasArgument(Argument):
               ) -> Tuple[str, Any]:
         vals = val.split(" ")
 
-        if (len(vals) > self.arg_num
-                and (vals[0] in instance.bot.db.get_servers(evt.sender)
-                     or vals[0] in instance.bot.db.get_aliases(evt.sender))):
-            return " ".join(vals[1:]), instance.bot.db.get_login(evt.sender, url_alias=vals[0])
-        return val, instance.bot.db.get_login(evt.sender)
+        logins = instance.bot.db.get_user_logins(evt.sender)
+        if len(vals) > self.arg_num and vals[0] in logins:
+            return " ".join(vals[1:]), logins.resolve(vals[0])
+        return val, logins.resolve()
 
 
 class OptRepoArgument(Argument):
@@ -87,3 +86,28 @@ def sigil_int(val: str) -> int:
     if val[0] == '#':
         return int(val[1:])
     return int(val)
+
+
+issue_id_regex = re.compile(r"#?(\d+)(?:-#?(\d+))?")
+max_issue_ids = 100
+
+
+def issue_id_list(val: str) -> Tuple[str, List[int]]:
+    ids = []
+    for part in re.split(r"[\s,]+", val.strip()):
+        if not part:
+            continue
+        match = issue_id_regex.fullmatch(part)
+        if not match:
+            raise ValueError(f"Invalid issue ID {part}")
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else start
+        if end < start:
+            raise ValueError(f"Invalid issue range {part}")
+        if len(ids) + end - start + 1 > max_issue_ids:
+            raise ValueError(f"Too many issues, at most {max_issue_ids} can be changed at once")
+        ids += range(start, end + 1)
+    if not ids:
+        raise ValueError("No issue ID given")
+    # Keep the given order, but don't touch the same issue twice.
+    return "", list(dict.fromkeys(ids))
@@ -28,3 +28,41 @@ class Config(BaseProxyConfig):
         helper.copy("base_command")
         helper.copy("send_as_notice")
         helper.copy("time_format")
+        helper.copy("update_messages")
+        helper.copy("event_batch.window")
+        helper.copy("event_batch.max_rows")
+        helper.copy("message_retention.days")
+        helper.copy("message_retention.interval")
+        helper.copy("message_retention.batch_size")
+        helper.copy("message_retention.batch_delay")
+        helper.copy("api.connections_per_server")
+        helper.copy("api.keepalive_timeout")
+        helper.copy("api.timeout")
+        helper.copy("api.max_queued_per_server")
+        helper.copy("api.queue_timeout")
+        helper.copy("api.client_idle_timeout")
+        helper.copy("api.project_cache_ttl")
+        helper.copy("api.max_retries")
+        helper.copy("api.failure_threshold")
+        helper.copy("api.probe_interval")
+        helper.copy("api.graphql")
+        helper.copy("diff.max_bytes")
+        helper.copy("diff.max_lines")
+        helper.copy("diff.message_size")
+        helper.copy("pagination.continuation_timeout")
+        helper.copy("issue_store.max_age")
+        helper.copy("issue_store.api_max_age")
+        helper.copy("search.max_results")
+        helper.copy("poller.min_interval")
+        helper.copy("poller.max_interval")
+        helper.copy("poller.backoff")
+        helper.copy("poller.concurrency")
+        helper.copy("poller.page_size")
+        helper.copy("matrix_send.rate")
+        helper.copy("matrix_send.burst")
+        helper.copy("matrix_send.room_rate")
+        helper.copy("matrix_send.room_burst")
+        helper.copy("matrix_send.max_retries")
+        helper.copy("digest.max_window")
+        helper.copy("digest.max_size")
+        helper.copy("job_reactions.window")
@@ -15,13 +15,12 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from typing import Any, Callable, TYPE_CHECKING
-
-from gitlab import Gitlab as Gl
-from gitlab.exceptions import GitlabAuthenticationError
+import asyncio
 
 from maubot import MessageEvent
 
 from ..db import AuthInfo, DefaultRepoInfo
+from ..api import GitlabClient as Gl, GitlabError, GitlabAuthError, GitlabBusy, GitlabUnavailable
 
 if TYPE_CHECKING:
     from ..commands import Command
@@ -37,19 +36,30 @@ def with_gitlab_session(func: Decoratable) -> Decorator:
         try:
             repo: Any = kwargs["repo"]
             if isinstance(repo, DefaultRepoInfo):
-                if repo.server not in self.bot.db.get_servers(evt.sender):
+                login = self.bot.db.get_login_by_server(evt.sender, repo.server)
+                if not login:
                     await evt.reply(f"You're not logged into {repo.server}")
                     return
-                login = self.bot.db.get_login(evt.sender, url_alias=repo.server)
                 kwargs["repo"] = repo.repo
         except KeyError:
             pass
+        if not login:
+            await evt.reply("You're not logged into any GitLab server")
+            return
 
         try:
-            with Gl(login.server, login.api_token) as gl:
-                return await func(self, evt, gl=gl, **kwargs)
-        except GitlabAuthenticationError as e:
+            return await func(self, evt, gl=self.bot.gitlab.client(login), **kwargs)
+        except GitlabAuthError as e:
             await evt.reply(f"Invalid access token.\n\n{e}")
+        except GitlabUnavailable as e:
+            await evt.reply(f"{e.server} seems to be down, so the bot has stopped sending "
+                            "requests to it for now. Please try again later.")
+        except GitlabBusy as e:
+            await evt.reply(f"{e.server} is busy ({e.reason}), please try again later.")
+        except asyncio.TimeoutError:
+            await evt.reply(f"{login.server} didn't respond in time.")
+        except GitlabError as e:
+            await evt.reply(f"GitLab returned an error: {e}")
         except Exception:
             self.bot.log.error("Failed to handle command", exc_info=True)
 
@@ -0,0 +1,143 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Iterable, Iterator, List, Tuple
+from html import escape
+import json
+import re
+
+from ..api import APIDiff
+
+hunk_header_regex = re.compile(r"@@ -\d+(?:,\d+)? \+\d+(?:,\d+)? @@")
+line_prefixes: Dict[str, str] = {
+    "+": "<font color='#0A0'>",
+    "-": "<font color='#A00'>",
+}
+file_header_prefix = "<font color='#000'>"
+hunk_header_prefix = "<font color='#00A'>"
+context_prefix = "<font color='#666'>"
+line_suffix = "</font>"
+
+
+def highlight_diff_lines(diff: str) -> List[str]:
+    """Colors each line of a unified diff, escaping the line contents as HTML."""
+    output = []
+    append = output.append
+    # Escaping never touches the +, -, @ or space line prefixes, so the whole diff can be
+    # escaped at once instead of line by line.
+    for line in escape(diff, quote=False).split("\n"):
+        first = line[:1]
+        if first == "@" and hunk_header_regex.match(line):
+            prefix = hunk_header_prefix
+        elif (first == "+" or first == "-") and line[:3] in ("+++", "---"):
+            prefix = file_header_prefix
+        else:
+            prefix = line_prefixes.get(first, context_prefix)
+        append(prefix + line + line_suffix)
+    return output
+
+
+def highlight_diff(diff: str) -> str:
+    return "\n".join(highlight_diff_lines(diff))
+
+
+def diff_size(diffs: Iterable[APIDiff]) -> Tuple[int, int]:
+    size = lines = 0
+    for diff in diffs:
+        size += len(diff.diff.encode("utf-8"))
+        lines += diff.diff.count("\n") + 1
+    return size, lines
+
+
+def to_unified_diff(diffs: Iterable[APIDiff]) -> str:
+    parts = []
+    for diff in diffs:
+        old_path = "/dev/null" if diff.new_file else f"a/{diff.old_path}"
+        new_path = "/dev/null" if diff.deleted_file else f"b/{diff.new_path}"
+        parts.append(f"diff --git a/{diff.old_path} b/{diff.new_path}\n"
+                     f"--- {old_path}\n+++ {new_path}\n{diff.diff}")
+        if not diff.diff.endswith("\n"):
+            parts.append("\n")
+    return "".join(parts)
+
+
+def encoded_size(html: str) -> int:
+    """
+    The number of bytes the HTML takes up in a message event. It's sent both as the
+    formatted body and (converted to plain text, which is never longer) as the body, and JSON
+    encoding escapes non-ASCII characters as ``\\uXXXX``.
+    """
+    return 2 * (len(json.dumps(html)) - 2)
+
+
+def truncate_line(line: str, max_size: int) -> str:
+    """Cuts a highlighted line so that it fits in ``max_size`` encoded bytes."""
+    content = line[:-len(line_suffix)]
+    low, high = 0, len(content)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if encoded_size(content[:mid] + " …" + line_suffix) <= max_size:
+            low = mid
+        else:
+            high = mid - 1
+    content = content[:low]
+    # Don't leave half of an HTML tag or entity behind.
+    for opening, closing in (("<", ">"), ("&", ";")):
+        if content.rfind(opening) > content.rfind(closing):
+            content = content[:content.rfind(opening)]
+    return content + " …" + line_suffix
+
+
+def pack_diff_messages(files: Iterable[Tuple[str, List[str]]], max_size: int) -> Iterator[str]:
+    """
+    Packs the highlighted lines of each file into as few HTML messages as possible without
+    exceeding ``max_size`` bytes of encoded message event content per message (see
+    :func:`encoded_size`). Files that don't fit in a single message are split between lines,
+    and lines that don't fit in a message on their own are truncated.
+    """
+    message: List[str] = []
+    size = 0
+    for path, lines in files:
+        header = f"{escape(path)}:\n<pre><code>"
+        footer = "</code></pre>"
+        overhead = encoded_size(header + footer + "\n")
+        line_sizes = [encoded_size(line + "\n") for line in lines]
+        start = 0
+        while True:
+            available = max_size - size - overhead
+            end = start
+            while end < len(lines) and available >= line_sizes[end]:
+                available -= line_sizes[end]
+                end += 1
+            if end == start and end < len(lines):
+                if message:
+                    # Not even one line fits, start a new message and try again.
+                    yield "\n".join(message)
+                    message, size = [], 0
+                    continue
+                # The line is longer than a whole message, send what fits of it on its own.
+                lines[start] = truncate_line(lines[start], max_size - overhead)
+                line_sizes[start] = encoded_size(lines[start] + "\n")
+                end += 1
+            section = header + "\n".join(lines[start:end]) + footer
+            message.append(section)
+            size += overhead + sum(line_sizes[start:end])
+            start = end
+            if start >= len(lines):
+                break
+            yield "\n".join(message)
+            message, size = [], 0
+    if message:
+        yield "\n".join(message)
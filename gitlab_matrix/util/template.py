@@ -22,8 +22,12 @@ from mautrix.util import markdown
 
 from maubot.loader import BasePluginLoader
 
+from .diff import highlight_diff
+
 
 class TemplateUtil:
+    highlight_diff = staticmethod(highlight_diff)
+
     @staticmethod
     def bold_scope(label: str) -> str:
         try:
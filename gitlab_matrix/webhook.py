@@ -15,7 +15,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import json
-from typing import List, Set, TYPE_CHECKING
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple, TYPE_CHECKING
 from asyncio import Task
 import asyncio
 import re
@@ -24,13 +24,17 @@ import attr
 from jinja2 import TemplateNotFound
 from aiohttp.web import Response, Request
 
-from mautrix.types import (EventType, RoomID, StateEvent, Membership, MessageType, JSON,
+from mautrix.types import (EventType, RoomID, EventID, StateEvent, Membership, MessageType, JSON,
                            TextMessageEventContent, Format, ReactionEventContent, RelationType)
 from mautrix.util.formatter import parse_html
 from maubot.handlers import web, event
 
-from .types import GitlabJobEvent, EventParse, Action, OTHER_ENUMS
-from .util import TemplateManager, TemplateUtil
+from .types import (GitlabEvent, GitlabJobEvent, GitlabProject, GitlabWikiPageEvent,
+                    GitlabPipelineEvent, GitlabPushEvent, GitlabIssueEvent, GitlabCommentEvent,
+                    GitlabMergeRequestEvent, BuildStatus, EventParse, Action, OTHER_ENUMS)
+from .util import TemplateManager, TemplateUtil, encoded_size
+from .api import APIProject
+from .sender import Priority
 
 if TYPE_CHECKING:
     from .bot import GitlabBot
@@ -39,10 +43,72 @@ spaces = re.compile(" +")
 space = " "
 
 
+def event_priority(evt: GitlabEvent) -> Priority:
+    """Failures are worth sending first when the bot is rate limited, wiki edits last."""
+    if isinstance(evt, GitlabJobEvent):
+        if evt.build_status == BuildStatus.FAILED:
+            return Priority.HIGH
+        elif evt.build_status.is_finished:
+            return Priority.NORMAL
+        return Priority.LOW
+    elif isinstance(evt, GitlabPipelineEvent) and evt.object_attributes.status == "failed":
+        return Priority.HIGH
+    elif isinstance(evt, GitlabWikiPageEvent):
+        return Priority.LOW
+    return Priority.NORMAL
+
+
+# Events that are collected into a single message in rooms with a digest window.
+DIGEST_EVENTS = (GitlabPushEvent, GitlabIssueEvent, GitlabMergeRequestEvent, GitlabCommentEvent)
+
+
+class DigestEntry(NamedTuple):
+    html: str
+    content: TextMessageEventContent
+    message_id: Optional[str]
+
+
+class PendingDigest:
+    window: int
+    entries: List[DigestEntry]
+    size: int
+    task: Optional[Task]
+
+    def __init__(self, window: int) -> None:
+        self.window = window
+        self.entries = []
+        self.size = 0
+        self.task = None
+
+
+def digest_entry_size(entry: DigestEntry) -> int:
+    return (encoded_size(entry.html)
+            + len(json.dumps(entry.content["xyz.maubot.gitlab.webhook"])))
+
+
+class PendingReaction:
+    evt: GitlabJobEvent
+    evt_type: str
+    changed: bool
+    flush: asyncio.Event
+    task: Optional[Task]
+
+    def __init__(self, evt: GitlabJobEvent, evt_type: str) -> None:
+        self.evt = evt
+        self.evt_type = evt_type
+        self.changed = True
+        self.flush = asyncio.Event()
+        self.task = None
+
+
 class GitlabWebhook:
     bot: 'GitlabBot'
     task_list: List[Task]
     joined_rooms: Set[RoomID]
+    digests: Dict[RoomID, PendingDigest]
+    reactions: Dict[Tuple[RoomID, str], PendingReaction]
+    redactions: List[Tuple[RoomID, EventID]]
+    redaction_task: Optional[Task]
     messages: TemplateManager
     templates: TemplateManager
 
@@ -50,6 +116,10 @@ class GitlabWebhook:
         self.bot = bot
         self.task_list = []
         self.joined_rooms = set()
+        self.digests = {}
+        self.reactions = {}
+        self.redactions = []
+        self.redaction_task = None
 
         self.messages = TemplateManager(self.bot.loader, "templates/messages")
         self.templates = TemplateManager(self.bot.loader, "templates/mixins")
@@ -61,6 +131,32 @@ class GitlabWebhook:
     async def stop(self) -> None:
         if self.task_list:
             await asyncio.wait(self.task_list, timeout=1)
+        # Send whatever was collected so far instead of waiting for the windows to end.
+        flushes = []
+        for room_id, digest in list(self.digests.items()):
+            digest.task.cancel()
+            flushes.append(asyncio.create_task(self.send_digest(room_id)))
+        for pending in self.reactions.values():
+            pending.flush.set()
+            flushes.append(pending.task)
+        if flushes:
+            _, unfinished = await asyncio.wait(flushes, timeout=1)
+            # Don't let them send through the sender after the plugin has stopped.
+            for task in unfinished:
+                task.cancel()
+            if unfinished:
+                self.bot.log.warning(f"Timed out sending {len(unfinished)} digests and job "
+                                     "reactions")
+        if self.redaction_task:
+            self.redaction_task.cancel()
+        redactions = self.redactions
+        try:
+            await asyncio.wait_for(self.send_redactions(), timeout=1)
+        except asyncio.TimeoutError:
+            self.bot.log.warning(f"Timed out redacting {len(redactions)} replaced reactions, "
+                                 "these may not have been redacted: "
+                                 + ", ".join(f"{event_id} in {room_id}"
+                                             for room_id, event_id in redactions))
 
     @web.post("/webhooks")
     async def post_handler(self, request: Request) -> Response:
@@ -128,6 +224,9 @@ class GitlabWebhook:
     async def process_hook(self, body: JSON, evt_type: str, room_id: RoomID) -> None:
         msgtype = MessageType.NOTICE if self.bot.config["send_as_notice"] else MessageType.TEXT
         evt = EventParse[evt_type].deserialize(body)
+        self.update_project_cache(evt)
+        self.bot.issues.update_from_webhook(evt)
+        self.bot.search.add_event(evt, room_id)
 
         was_manually_handled = True
         if isinstance(evt, GitlabJobEvent):
@@ -155,46 +254,204 @@ class GitlabWebhook:
             "util": TemplateUtil,
         }
 
-        for subevt in evt.preprocess():
-            args = {
-                **attr.asdict(subevt, recurse=False),
-                **{key: getattr(subevt, key) for key in subevt.event_properties},
-                **base_args,
-            }
-            args["templates"] = self.templates.proxy(args)
-
-            html = tpl.render(**args)
-            if not html or aborted:
-                aborted = False
-                continue
-            html = spaces.sub(space, html.strip())
-
-            content = TextMessageEventContent(msgtype=msgtype, format=Format.HTML,
-                                              formatted_body=html, body=await parse_html(html))
-            content["xyz.maubot.gitlab.webhook"] = {
-                "event_type": evt_type,
-                **subevt.meta,
-            }
-            content["com.beeper.linkpreviews"] = []
-
-            edit_evt = self.bot.db.get_event(subevt.message_id, room_id)
-            if edit_evt:
-                content.set_edit(edit_evt)
-            event_id = await self.bot.client.send_message(room_id, content)
-            if not edit_evt and subevt.message_id:
-                self.bot.db.put_event(subevt.message_id, room_id, event_id)
+        subevents = evt.preprocess()
+        if (self.bot.config["update_messages"] == "merged"
+                and isinstance(evt, (GitlabIssueEvent, GitlabMergeRequestEvent))
+                and evt.action == Action.UPDATE):
+            # All changes of the update are rendered into one message instead of one message
+            # per changed field.
+            subevents = [evt]
+            tpl = self.messages["issue_update_merged"]
+
+        digest_window = self.bot.db.get_digest_window(room_id)
+
+        # Each message is rendered while the previous one is being sent. Sends still happen
+        # one at a time, so the messages arrive in order.
+        sending: Optional[Task] = None
+        sending_message_id: Optional[str] = None
+        try:
+            for subevt in subevents:
+                args = {
+                    **attr.asdict(subevt, recurse=False),
+                    **{key: getattr(subevt, key) for key in subevt.event_properties},
+                    **base_args,
+                }
+                args["templates"] = self.templates.proxy(args)
+
+                html = tpl.render(**args)
+                if not html or aborted:
+                    aborted = False
+                    continue
+                html = spaces.sub(space, html.strip())
+
+                content = TextMessageEventContent(msgtype=msgtype, format=Format.HTML,
+                                                  formatted_body=html,
+                                                  body=await parse_html(html))
+                content["xyz.maubot.gitlab.webhook"] = {
+                    "event_type": evt_type,
+                    **subevt.meta,
+                }
+                content["com.beeper.linkpreviews"] = []
+
+                if digest_window > 0 and isinstance(subevt, DIGEST_EVENTS):
+                    edit_evt = self.bot.db.get_event(subevt.message_id, room_id)
+                    # Edits of messages that were already sent can't be part of a digest.
+                    if not edit_evt:
+                        await self.add_to_digest(room_id, digest_window,
+                                                 DigestEntry(html, content, subevt.message_id))
+                        continue
+
+                # The transaction ID is allocated up front, so a retried send reuses it and
+                # the homeserver can deduplicate it.
+                txn_id = self.bot.client.api.get_txn_id()
+
+                if sending and subevt.message_id and subevt.message_id == sending_message_id:
+                    # This is an edit of the message that's still being sent.
+                    await sending
+                    sending = None
+                edit_evt = self.bot.db.get_event(subevt.message_id, room_id)
+                if edit_evt:
+                    content.set_edit(edit_evt)
+                if sending:
+                    await sending
+                sending = asyncio.create_task(self.send_message(
+                    room_id, content, txn_id, None if edit_evt else subevt.message_id,
+                    event_priority(subevt)))
+                sending_message_id = subevt.message_id
+        finally:
+            if sending:
+                await sending
+
+    async def send_message(self, room_id: RoomID, content: TextMessageEventContent, txn_id: str,
+                           message_id: Optional[str], priority: Priority) -> None:
+        event_id = await self.bot.sender.send_message(room_id, content, priority=priority,
+                                                      txn_id=txn_id)
+        if message_id:
+            self.bot.db.put_event(message_id, room_id, event_id)
+
+    async def add_to_digest(self, room_id: RoomID, window: int, entry: DigestEntry) -> None:
+        size = digest_entry_size(entry)
+        digest = self.digests.get(room_id)
+        if digest and entry.message_id:
+            # A newer version of a message in the same window replaces the old one.
+            for i, existing in enumerate(digest.entries):
+                if existing.message_id == entry.message_id:
+                    digest.size += size - digest_entry_size(existing)
+                    digest.entries[i] = entry
+                    return
+        if digest and digest.size + size > self.bot.config["digest.max_size"]:
+            # Send what was collected so far rather than let the event grow too big.
+            del self.digests[room_id]
+            digest.task.cancel()
+            await self._send_digest(room_id, digest)
+            digest = self.digests.get(room_id)
+        if not digest:
+            digest = self.digests[room_id] = PendingDigest(window)
+            digest.task = asyncio.create_task(self.send_digest_later(room_id, window))
+        digest.entries.append(entry)
+        digest.size += size
+
+    async def send_digest_later(self, room_id: RoomID, window: int) -> None:
+        await asyncio.sleep(window)
+        await self.send_digest(room_id)
+
+    async def send_digest(self, room_id: RoomID) -> None:
+        try:
+            digest = self.digests.pop(room_id)
+        except KeyError:
+            return
+        await self._send_digest(room_id, digest)
+
+    async def _send_digest(self, room_id: RoomID, digest: PendingDigest) -> None:
+        if len(digest.entries) > 1:
+            try:
+                await self.send_message(room_id, await self.render_digest(digest),
+                                        self.bot.client.api.get_txn_id(), None, Priority.NORMAL)
+                return
+            except Exception:
+                self.bot.log.warning(f"Failed to send digest to {room_id}, sending its "
+                                     f"{len(digest.entries)} updates separately", exc_info=True)
+        # A lone event is sent as usual, so it can be edited and reacted to later.
+        for entry in digest.entries:
+            try:
+                await self.send_message(room_id, entry.content, self.bot.client.api.get_txn_id(),
+                                        entry.message_id, Priority.NORMAL)
+            except Exception:
+                self.bot.log.warning(f"Failed to send update to {room_id}", exc_info=True)
+
+    async def render_digest(self, digest: PendingDigest) -> TextMessageEventContent:
+        html = self.messages["digest"].render(entries=[entry.html for entry in digest.entries],
+                                              window=digest.window, util=TemplateUtil)
+        html = spaces.sub(space, html.strip())
+        content = TextMessageEventContent(msgtype=digest.entries[0].content.msgtype,
+                                          format=Format.HTML, formatted_body=html,
+                                          body=await parse_html(html))
+        content["xyz.maubot.gitlab.webhook"] = {
+            "event_type": "Digest",
+            "events": [entry.content["xyz.maubot.gitlab.webhook"] for entry in digest.entries],
+        }
+        content["com.beeper.linkpreviews"] = []
+        return content
+
+    def update_project_cache(self, evt: GitlabEvent) -> None:
+        project = getattr(evt, "project", None)
+        if (isinstance(project, GitlabProject) and project.id and project.web_url
+                and project.path_with_namespace):
+            cache = self.bot.gitlab.get_project_cache(project.gitlab_base_url)
+            cache.put(APIProject.from_webhook(project))
 
     async def handle_job_event(self, evt: GitlabJobEvent, evt_type: str, room_id: RoomID) -> None:
+        key = (room_id, evt.reaction_id)
+        try:
+            pending = self.reactions[key]
+        except KeyError:
+            pending = self.reactions[key] = PendingReaction(evt, evt_type)
+            pending.task = asyncio.create_task(self.send_reactions(key, pending))
+        else:
+            # Only the latest status within the window is sent.
+            pending.evt = evt
+            pending.evt_type = evt_type
+            pending.changed = True
+        if evt.build_status.is_finished:
+            pending.flush.set()
+
+    async def send_reactions(self, key: Tuple[RoomID, str], pending: PendingReaction) -> None:
+        room_id, _ = key
+        window = self.bot.config["job_reactions.window"]
+        sent_key: Optional[str] = None
+        try:
+            # Statuses that arrive while the previous one is being sent start a new window, so
+            # the reactions of a single job are always sent one at a time and in order.
+            while pending.changed:
+                try:
+                    await asyncio.wait_for(pending.flush.wait(), timeout=window)
+                except asyncio.TimeoutError:
+                    pass
+                pending.changed = False
+                pending.flush.clear()
+                evt, evt_type = pending.evt, pending.evt_type
+                try:
+                    reaction_key = f"{evt.build_status.color_circle} {evt.build_name}"
+                except KeyError:
+                    continue
+                if reaction_key == sent_key:
+                    continue
+                await self.send_reaction(evt, evt_type, room_id, reaction_key)
+                sent_key = reaction_key
+        except Exception:
+            self.bot.log.warning(f"Failed to send job reaction to {room_id}", exc_info=True)
+        finally:
+            del self.reactions[key]
+
+    async def send_reaction(self, evt: GitlabJobEvent, evt_type: str, room_id: RoomID,
+                            reaction_key: str) -> None:
         push_evt = self.bot.db.get_event(evt.push_id, room_id)
         if not push_evt:
             self.bot.log.debug(f"No message found to react to push {evt.push_id}")
             return
         reaction = ReactionEventContent()
         reaction.relates_to.event_id = push_evt
-        try:
-            reaction.relates_to.key = f"{evt.build_status.color_circle} {evt.build_name}"
-        except KeyError:
-            return
+        reaction.relates_to.key = reaction_key
         reaction.relates_to.rel_type = RelationType.ANNOTATION
         reaction["xyz.maubot.gitlab.webhook"] = {
             "event_type": evt_type,
@@ -202,10 +459,29 @@ class GitlabWebhook:
         }
 
         prev_reaction = self.bot.db.get_event(evt.reaction_id, room_id)
+        event_id = await self.bot.sender.send_message_event(room_id, EventType.REACTION, reaction,
+                                                            priority=event_priority(evt))
+        self.bot.db.put_event(evt.reaction_id, room_id, event_id)
         if prev_reaction:
-            await self.bot.client.redact(room_id, prev_reaction)
-        event_id = await self.bot.client.send_message_event(room_id, EventType.REACTION, reaction)
-        self.bot.db.put_event(evt.reaction_id, room_id, event_id, merge=prev_reaction is not None)
+            self.redactions.append((room_id, prev_reaction))
+            if not self.redaction_task:
+                self.redaction_task = asyncio.create_task(self.send_redactions_later())
+
+    async def send_redactions_later(self) -> None:
+        await asyncio.sleep(self.bot.config["job_reactions.window"])
+        self.redaction_task = None
+        await self.send_redactions()
+
+    async def send_redactions(self) -> None:
+        """Redact the replaced reactions that were collected since the last call."""
+        redactions, self.redactions = self.redactions, []
+        results = await asyncio.gather(*(self.bot.sender.redact(room_id, event_id,
+                                                                priority=Priority.LOW)
+                                         for room_id, event_id in redactions),
+                                       return_exceptions=True)
+        for (room_id, event_id), result in zip(redactions, results):
+            if isinstance(result, Exception):
+                self.bot.log.warning(f"Failed to redact {event_id} in {room_id}: {result}")
 
     @event.on(EventType.ROOM_MEMBER)
     async def member_handler(self, evt: StateEvent) -> None:
@@ -0,0 +1,316 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import AsyncIterator, Callable, Dict, List, Tuple
+from contextlib import asynccontextmanager
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+import pytest
+
+from gitlab_matrix.api import (GitlabAPI, GitlabClient, GitlabError, GitlabAuthError,
+                               GitlabNotFound, GitlabUnavailable)
+from gitlab_matrix.db import AuthInfo
+
+Handler = Callable[[web.Request], web.Response]
+
+
+def commit(n: int) -> Dict[str, str]:
+    return {"id": f"{n:040x}", "short_id": f"{n:08x}", "title": f"Commit {n}",
+            "message": f"Commit {n}\n", "author_name": "Alice",
+            "committed_date": "2021-01-01T00:00:00Z"}
+
+
+@asynccontextmanager
+async def stub_gitlab(routes: Dict[Tuple[str, str], Handler], **kwargs
+                      ) -> AsyncIterator[Tuple[GitlabAPI, GitlabClient, List[web.Request]]]:
+    """Run a stub GitLab with the given handlers and yield a client logged into it."""
+    requests: List[web.Request] = []
+    app = web.Application()
+
+    def logged(handler: Handler) -> Handler:
+        async def wrapper(request: web.Request) -> web.Response:
+            requests.append(request)
+            return await handler(request)
+        return wrapper
+
+    for (method, path), handler in routes.items():
+        app.router.add_route(method, path, logged(handler))
+    server = TestServer(app)
+    await server.start_server()
+    api = GitlabAPI(**kwargs)
+    try:
+        url = str(server.make_url("")).rstrip("/")
+        yield api, api.client(AuthInfo(server=url, api_token="token")), requests
+    finally:
+        await api.close()
+        await server.close()
+
+
+def run(coro) -> None:
+    asyncio.run(coro)
+
+
+def test_pagination_stops_at_short_page() -> None:
+    all_commits = [commit(n) for n in range(45)]
+
+    async def list_commits(request: web.Request) -> web.Response:
+        page, per_page = int(request.query["page"]), int(request.query["per_page"])
+        return web.json_response(all_commits[(page - 1) * per_page:page * per_page])
+
+    async def test() -> None:
+        routes = {("GET", "/api/v4/projects/group%2Frepo/repository/commits"): list_commits}
+        async with stub_gitlab(routes) as (_, gl, requests):
+            commits = [c async for c in gl.paginate_commits("group/repo", per_page=20)]
+            assert [c.short_id for c in commits] == [c["short_id"] for c in all_commits]
+            assert [r.query["page"] for r in requests] == ["1", "2", "3"]
+            assert all(r.headers["PRIVATE-TOKEN"] == "token" for r in requests)
+
+    run(test())
+
+
+def test_not_found_is_mapped() -> None:
+    async def not_found(_: web.Request) -> web.Response:
+        return web.json_response({"message": "404 Project Not Found"}, status=404)
+
+    async def test() -> None:
+        async with stub_gitlab({("GET", "/api/v4/projects/1"): not_found}) as (_, gl, _r):
+            with pytest.raises(GitlabNotFound) as exc:
+                await gl.get_project(1)
+            assert exc.value.status == 404
+            assert exc.value.message == "404 Project Not Found"
+
+    run(test())
+
+
+def test_unauthorized_replaces_pooled_client() -> None:
+    async def unauthorized(_: web.Request) -> web.Response:
+        return web.json_response({"message": "401 Unauthorized"}, status=401)
+
+    async def test() -> None:
+        async with stub_gitlab({("GET", "/api/v4/user"): unauthorized}) as (api, gl, _r):
+            with pytest.raises(GitlabAuthError):
+                await gl.get_current_user()
+            assert gl.auth_failed
+            assert api.client(AuthInfo(server=gl.url, api_token="token")) is not gl
+
+    run(test())
+
+
+def test_other_errors_are_generic() -> None:
+    async def forbidden(_: web.Request) -> web.Response:
+        return web.json_response({"error": "insufficient_scope"}, status=403)
+
+    async def test() -> None:
+        async with stub_gitlab({("GET", "/api/v4/projects/1"): forbidden}) as (_, gl, _r):
+            with pytest.raises(GitlabError) as exc:
+                await gl.get_project(1)
+            assert type(exc.value) is GitlabError
+            assert (exc.value.status, exc.value.message) == (403, "insufficient_scope")
+
+    run(test())
+
+
+def test_rate_limited_requests_are_retried() -> None:
+    attempts = 0
+
+    async def rate_limited(_: web.Request) -> web.Response:
+        nonlocal attempts
+        attempts += 1
+        if attempts < 3:
+            return web.json_response({"message": "Retry later"}, status=429,
+                                     headers={"Retry-After": "0"})
+        return web.json_response(commit(1))
+
+    async def test() -> None:
+        path = f"/api/v4/projects/1/repository/commits/{commit(1)['id']}"
+        async with stub_gitlab({("GET", path): rate_limited}, max_retries=3) as (_, gl, _r):
+            assert (await gl.get_commit(1, commit(1)["id"])).title == "Commit 1"
+            assert attempts == 3
+            assert gl.scheduler.throttled == 2
+
+    run(test())
+
+
+def test_rate_limit_gives_up_after_max_retries() -> None:
+    async def rate_limited(_: web.Request) -> web.Response:
+        return web.json_response({"message": "Retry later"}, status=429,
+                                 headers={"Retry-After": "0"})
+
+    async def test() -> None:
+        async with stub_gitlab({("GET", "/api/v4/projects/1"): rate_limited},
+                               max_retries=2) as (_, gl, requests):
+            with pytest.raises(GitlabError) as exc:
+                await gl.get_project(1)
+            assert exc.value.status == 429
+            assert len(requests) == 3
+
+    run(test())
+
+
+def test_server_errors_open_the_circuit() -> None:
+    async def broken(_: web.Request) -> web.Response:
+        return web.Response(status=502, text="Bad Gateway")
+
+    async def test() -> None:
+        async with stub_gitlab({("GET", "/api/v4/projects/1"): broken},
+                               failure_threshold=2) as (_, gl, requests):
+            for _ in range(2):
+                with pytest.raises(GitlabError):
+                    await gl.get_project(1)
+            with pytest.raises(GitlabUnavailable):
+                await gl.get_project(1)
+            assert len(requests) == 2
+
+    run(test())
+
+
+def test_project_is_revalidated_with_etag() -> None:
+    project = {"id": 1, "path_with_namespace": "group/repo", "web_url": "http://gitlab/repo"}
+
+    async def get_project(request: web.Request) -> web.Response:
+        if request.headers.get("If-None-Match") == '"v1"':
+            return web.Response(status=304)
+        return web.json_response(project, headers={"ETag": '"v1"'})
+
+    async def test() -> None:
+        async with stub_gitlab({("GET", "/api/v4/projects/1"): get_project},
+                               project_cache_ttl=0) as (_, gl, requests):
+            first = await gl.get_project(1)
+            second = await gl.get_project(1)
+            assert first == second
+            assert requests[1].headers["If-None-Match"] == '"v1"'
+
+    run(test())
+
+
+def test_login_check_is_not_pooled() -> None:
+    async def current_user(request: web.Request) -> web.Response:
+        if request.headers["PRIVATE-TOKEN"] != "token":
+            return web.json_response({"message": "401 Unauthorized"}, status=401)
+        return web.json_response({"id": 1, "name": "Alice", "username": "alice"})
+
+    async def test() -> None:
+        async with stub_gitlab({("GET", "/api/v4/user"): current_user}) as (api, gl, _r):
+            api.invalidate(AuthInfo(server=gl.url, api_token="token"))
+            assert not api.schedulers and not api.breakers
+            with pytest.raises(GitlabAuthError):
+                await api.check_login(AuthInfo(server=gl.url, api_token="wrong"))
+            user = await api.check_login(AuthInfo(server=gl.url, api_token="token"))
+            assert user.username == "alice"
+            assert not api.schedulers and not api.breakers
+
+    run(test())
+
+
+def test_idle_servers_are_released() -> None:
+    async def test() -> None:
+        async with stub_gitlab({}, client_idle_timeout=0) as (api, gl, _r):
+            assert gl.url in api.schedulers
+            api.client(AuthInfo(server="http://other.invalid", api_token="token"))
+            assert gl.url not in api.schedulers and gl.url not in api.breakers
+            await asyncio.sleep(0)
+            assert gl.http.closed
+
+    run(test())
+
+
+def test_busy_server_is_released_once_idle() -> None:
+    release = asyncio.Event()
+
+    async def slow(_: web.Request) -> web.Response:
+        await release.wait()
+        return web.json_response(commit(1))
+
+    async def test() -> None:
+        routes = {("GET", "/api/v4/projects/1/repository/commits/1"): slow}
+        async with stub_gitlab(routes, client_idle_timeout=0) as (api, gl, _r):
+            request = asyncio.create_task(gl.request("GET", "projects/1/repository/commits/1"))
+            await asyncio.sleep(0.1)
+            api.client(AuthInfo(server="http://other.invalid", api_token="token"))
+            # The request is still running, so the server is kept for now.
+            assert gl.url in api.schedulers
+            release.set()
+            await request
+            api.client(AuthInfo(server="http://third.invalid", api_token="token"))
+            assert gl.url not in api.schedulers and gl.url not in api.breakers
+
+    run(test())
+
+
+ISSUE = {"id": 10, "iid": 1, "project_id": 1, "title": "Bug", "state": "opened",
+         "web_url": "http://gitlab/group/repo/-/issues/1",
+         "author": {"id": 1, "name": "Alice", "username": "alice"},
+         "created_at": "2021-01-01T00:00:00Z", "updated_at": "2021-01-01T00:00:00Z"}
+
+
+def graphql_fallback(errors: List[dict]) -> Tuple[bool, int]:
+    """Fetch an issue twice through a GraphQL endpoint that returns the given errors."""
+    async def graphql(_: web.Request) -> web.Response:
+        return web.json_response({"data": None, "errors": errors})
+
+    async def get_issue(_: web.Request) -> web.Response:
+        return web.json_response(ISSUE)
+
+    async def test() -> Tuple[bool, int]:
+        routes = {("POST", "/api/graphql"): graphql,
+                  ("GET", "/api/v4/projects/group%2Frepo/issues/1"): get_issue}
+        async with stub_gitlab(routes) as (_, gl, requests):
+            for _ in range(2):
+                issue, _notes = await gl.get_issue_details("group/repo", 1)
+                assert issue.title == "Bug"
+            return gl.use_graphql, sum(r.path == "/api/graphql" for r in requests)
+
+    return asyncio.run(test())
+
+
+def test_graphql_error_falls_back_for_one_call() -> None:
+    assert graphql_fallback([{"message": "Internal server error"}]) == (True, 2)
+
+
+def test_graphql_schema_error_disables_graphql() -> None:
+    errors = [{"message": "Field 'notes' doesn't exist on type 'Issue'",
+               "extensions": {"code": "undefinedField", "typeName": "Issue",
+                              "fieldName": "notes"}}]
+    assert graphql_fallback(errors) == (False, 1)
+
+
+def test_project_access_is_checked_per_token() -> None:
+    project = {"id": 1, "path_with_namespace": "group/repo", "web_url": "http://gitlab/group/repo"}
+
+    async def get_project(request: web.Request) -> web.Response:
+        if request.headers["PRIVATE-TOKEN"] != "token":
+            return web.json_response({"message": "404 Project Not Found"}, status=404)
+        elif request.headers.get("If-None-Match") == '"v1"':
+            return web.Response(status=304)
+        return web.json_response(project, headers={"ETag": '"v1"'})
+
+    async def test() -> None:
+        routes = {("GET", "/api/v4/projects/1"): get_project,
+                  ("GET", "/api/v4/projects/group%2Frepo"): get_project}
+        async with stub_gitlab(routes) as (api, gl, requests):
+            await gl.get_project(1)
+            other = api.client(AuthInfo(server=gl.url, api_token="other"))
+            # The project is in the shared cache, but the other token can't see it.
+            with pytest.raises(GitlabNotFound):
+                await other.get_project("group/repo")
+            assert not await other.can_access_project(1)
+            # The first token's access is remembered, so its lookups stay local.
+            assert await gl.can_access_project(1)
+            assert (await gl.get_project("group/repo")).id == 1
+            assert [r.headers.get("If-None-Match") for r in requests] == [None, '"v1"', '"v1"']
+
+    run(test())
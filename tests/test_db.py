@@ -0,0 +1,110 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from datetime import datetime
+from typing import List
+import asyncio
+
+from sqlalchemy import create_engine, and_
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Query, Session
+import pytest
+
+from gitlab_matrix.db import Database, Alias, Default, MatrixMessage, Token
+
+
+@pytest.fixture
+def db() -> Database:
+    return Database(create_engine("sqlite://"))
+
+
+def query_plan(db: Database, query: Query) -> List[str]:
+    compiled = query.statement.compile(dialect=db.db.dialect)
+    params = [compiled.params[key] for key in compiled.positiontup]
+    rows = db.db.execute(f"EXPLAIN QUERY PLAN {compiled}", params)
+    return [row[-1] for row in rows]
+
+
+def test_alias_lookup_uses_primary_key(db: Database) -> None:
+    s = db.Session()
+    plan = query_plan(db, s.query(Alias).filter(Alias.user_id == "@user:example.com",
+                                                Alias.alias == "gl"))
+    assert any("sqlite_autoindex_alias_1" in step for step in plan), plan
+    assert not any("SCAN" in step for step in plan), plan
+
+
+def test_login_join_uses_primary_keys(db: Database) -> None:
+    s = db.Session()
+    query = (s.query(Token.gitlab_server, Token.api_token, Alias.alias, Default.gitlab_server)
+             .outerjoin(Alias, and_(Alias.user_id == Token.user_id,
+                                    Alias.gitlab_server == Token.gitlab_server))
+             .outerjoin(Default, Default.user_id == Token.user_id)
+             .filter(Token.user_id == "@user:example.com"))
+    plan = query_plan(db, query)
+    assert any("sqlite_autoindex_token_1" in step for step in plan), plan
+    assert any("sqlite_autoindex_alias_1" in step for step in plan), plan
+    assert not any("SCAN" in step for step in plan), plan
+
+
+def test_prune_uses_created_at_index(db: Database) -> None:
+    s = db.Session()
+    query = (s.query(MatrixMessage.room_id, MatrixMessage.message_id)
+             .filter(MatrixMessage.created_at < datetime(2021, 1, 1))
+             .limit(500))
+    plan = query_plan(db, query)
+    assert any("ix_matrix_message_created_at" in step for step in plan), plan
+
+
+def test_login_cache_skips_empty_and_evicts_oldest() -> None:
+    db = Database(create_engine("sqlite://"), login_cache_size=2)
+    assert not db.get_user_logins("@nobody:example.com").logins
+    assert "@nobody:example.com" not in db._user_logins
+
+    for user in ("@a:example.com", "@b:example.com"):
+        db.add_login(user, "https://gitlab.example.com", "token")
+        db.get_user_logins(user)
+    db.get_user_logins("@a:example.com")
+    db.add_login("@c:example.com", "https://gitlab.example.com", "token")
+    db.get_user_logins("@c:example.com")
+    assert list(db._user_logins) == ["@a:example.com", "@c:example.com"]
+    assert db.get_login("@b:example.com").api_token == "token"
+
+
+def test_failed_flush_keeps_event_ids() -> None:
+    async def test() -> None:
+        db = Database(create_engine("sqlite://"), batch_window=60, batch_max_rows=100)
+        session = db.Session
+
+        def fail() -> None:
+            raise OperationalError("COMMIT", {}, Exception("disk I/O error"))
+
+        def broken_session() -> Session:
+            s = session()
+            s.commit = fail
+            return s
+
+        db.Session = broken_session
+        db.put_event("1", "!room:example.com", "$event")
+        db.flush_events()
+        assert db._flush_handle is not None
+        assert db.get_event("1", "!room:example.com") == "$event"
+
+        db.Session = session
+        db.flush_events()
+        assert not db._pending_events
+        assert db.get_event("1", "!room:example.com") == "$event"
+        assert db.event_rows == 1
+
+    asyncio.run(test())
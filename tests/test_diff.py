@@ -0,0 +1,49 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import json
+
+import pytest
+
+from gitlab_matrix.util.diff import highlight_diff_lines, pack_diff_messages, encoded_size
+
+
+def content_size(html: str) -> int:
+    # The plain text body is never longer than the HTML, so use the HTML for both.
+    return 2 * (len(json.dumps(html).encode("utf-8")) - 2)
+
+
+@pytest.mark.parametrize("line", ["+" + "漢字テスト" * 20, '+x = "<a&b>"' * 10, " plain"])
+def test_messages_fit_the_budget(line: str) -> None:
+    diff = "\n".join(line for _ in range(2000))
+    messages = list(pack_diff_messages([("file.py", highlight_diff_lines(diff))], 24000))
+    assert len(messages) > 1
+    assert all(content_size(msg) <= 24000 for msg in messages)
+    assert sum(msg.count("<font") for msg in messages) == 2000
+
+
+def test_long_line_is_truncated() -> None:
+    lines = highlight_diff_lines("+" + "é&<" * 30000)
+    [message] = pack_diff_messages([("file.py", lines)], 24000)
+    assert content_size(message) <= 24000
+    assert message.endswith(" …</font></code></pre>")
+    assert "&amp;&lt; …" in message or "é …" in message
+
+
+def test_small_files_share_a_message() -> None:
+    files = [(f"file{n}.py", highlight_diff_lines("+a\n-b")) for n in range(5)]
+    [message] = pack_diff_messages(files, 24000)
+    assert encoded_size(message) <= 24000
+    assert all(f"file{n}.py" in message for n in range(5))
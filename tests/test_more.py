@@ -0,0 +1,86 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from types import SimpleNamespace
+from typing import List
+import asyncio
+import logging
+
+from gitlab_matrix.api import Paginator
+from gitlab_matrix.commands.more import CommandMore
+from gitlab_matrix.db import AuthInfo, UserLogins
+
+USER = "@user:example.com"
+ROOM = "!room:example.com"
+LOGIN = AuthInfo(server="http://gitlab/", api_token="token")
+
+
+def make_command(*logins: AuthInfo) -> CommandMore:
+    user_logins = UserLogins({login.server: login for login in logins}, {}, None)
+    bot = SimpleNamespace(log=logging.getLogger("test"),
+                          config={"pagination.continuation_timeout": 600},
+                          db=SimpleNamespace(get_user_logins=lambda _: user_logins),
+                          client=SimpleNamespace(react=lambda *_: asyncio.sleep(0)))
+    return CommandMore(bot)
+
+
+async def send_first_page(cmd: CommandMore, fetch) -> List[str]:
+    replies = []
+
+    async def send(text: str) -> str:
+        replies.append(text)
+        return f"${len(replies)}"
+
+    paginator = Paginator(fetch, per_page=1)
+    await cmd._send_page(send, ROOM, USER, AuthInfo("http://gitlab", "token"), paginator,
+                         lambda items: ", ".join(items), False, ["first"])
+    return replies
+
+
+def test_logout_drops_continuations() -> None:
+    async def fetch(page: int, per_page: int) -> List[str]:
+        return ["more"]
+
+    async def test() -> None:
+        cmd = make_command(LOGIN)
+        await send_first_page(cmd, fetch)
+        assert cmd.continuations
+        cmd.drop_continuations(USER, LOGIN)
+        assert not cmd.continuations and not cmd.latest_continuation
+
+    asyncio.run(test())
+
+
+def test_continue_after_logout_or_closed_session() -> None:
+    async def closed(page: int, per_page: int) -> List[str]:
+        raise RuntimeError("Session is closed")
+
+    async def test() -> None:
+        replies = []
+
+        async def send(text: str) -> None:
+            replies.append(text)
+
+        cmd = make_command(LOGIN)
+        await send_first_page(cmd, closed)
+        await cmd._continue(send, cmd.continuations.popitem()[1])
+        assert replies[-1].startswith("Failed to fetch the next page")
+
+        cmd = make_command()
+        await send_first_page(cmd, closed)
+        await cmd._continue(send, cmd.continuations.popitem()[1])
+        assert replies[-1] == "You're no longer logged into http://gitlab."
+
+    asyncio.run(test())
@@ -0,0 +1,130 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import List, Optional, Tuple
+from types import SimpleNamespace
+import asyncio
+import logging
+
+from sqlalchemy import create_engine
+import pytest
+
+from gitlab_matrix.api import APIEvent, GitlabError, GitlabNotFound, GitlabUnavailable
+from gitlab_matrix.db import AuthInfo, Database
+from gitlab_matrix.poller import EventPoller
+
+ROOM = "!room:example.com"
+SERVER = "http://gitlab"
+
+
+def event(n: int) -> APIEvent:
+    return APIEvent.deserialize({"id": n, "action_name": "opened", "target_type": "Issue",
+                                 "target_iid": n, "created_at": "2021-01-01T00:00:00Z",
+                                 "author": {"id": 1, "name": "Alice", "username": "alice"}})
+
+
+class FakeGitlab:
+    def __init__(self, events: List[APIEvent]) -> None:
+        self.events = events
+
+    async def list_project_events(self, project: str, etag: Optional[str] = None,
+                                  per_page: int = 100
+                                  ) -> Tuple[Optional[str], Optional[List[APIEvent]]]:
+        return f'"{len(self.events)}"', self.events
+
+    async def get_project(self, project: str) -> None:
+        return None
+
+
+class FakeWebhook:
+    def __init__(self, fail: Tuple[int, ...] = ()) -> None:
+        self.joined_rooms = {ROOM}
+        self.fail = fail
+        self.sent: List[int] = []
+
+    async def process_hook(self, body: dict, evt_type: str, room_id: str) -> None:
+        if body["id"] in self.fail:
+            raise ValueError("broken template")
+        self.sent.append(body["id"])
+
+
+@pytest.fixture
+def poller() -> EventPoller:
+    db = Database(create_engine("sqlite://"))
+    db.get_login_by_server = lambda *_: AuthInfo(server=SERVER, api_token="token")
+    sub = db.add_event_subscription(ROOM, SERVER, "group/repo", "@user:example.com")
+    sub.last_event_id, sub.etag = 1, '"1"'
+    db.update_event_cursor(sub)
+    bot = SimpleNamespace(db=db, log=logging.getLogger("test"), webhook=FakeWebhook(),
+                          config={"poller.page_size": 100})
+    poller = EventPoller(bot)
+
+    async def to_hook(gl: FakeGitlab, project: None, evt: APIEvent) -> Tuple[str, dict]:
+        if evt.id in bot.errors:
+            raise bot.errors[evt.id]
+        return "Issue Hook", {"id": evt.id}
+
+    bot.errors = {}
+    poller.to_hook = to_hook
+    return poller
+
+
+def poll(poller: EventPoller, events: List[APIEvent]) -> bool:
+    poller.bot.gitlab = SimpleNamespace(client=lambda _: FakeGitlab(events))
+    return asyncio.run(poller.poll(poller.bot.db.get_event_subscriptions()[0]))
+
+
+def cursor(poller: EventPoller) -> Tuple[int, str]:
+    sub = poller.bot.db.get_event_subscriptions()[0]
+    return sub.last_event_id, sub.etag
+
+
+def test_failed_send_is_retried(poller: EventPoller) -> None:
+    poller.bot.webhook.fail = (3,)
+    assert poll(poller, [event(n) for n in range(1, 5)])
+    # The ETag isn't saved, so the next poll gets the events again instead of 304.
+    assert cursor(poller) == (2, '"1"')
+    poller.bot.webhook.fail = ()
+    assert poll(poller, [event(n) for n in range(1, 5)])
+    assert poller.bot.webhook.sent == [2, 3, 4]
+    assert cursor(poller) == (4, '"4"')
+
+
+def test_event_that_always_fails_is_skipped(poller: EventPoller) -> None:
+    poller.bot.webhook.fail = (3,)
+    for _ in range(3):
+        assert poll(poller, [event(n) for n in range(1, 5)])
+    assert poller.bot.webhook.sent == [2, 4]
+    assert cursor(poller) == (4, '"4"')
+
+
+@pytest.mark.parametrize("error", [GitlabUnavailable(SERVER, 60), GitlabError(502, "Bad Gateway")])
+def test_temporary_error_retries_remaining_events(poller: EventPoller, error: Exception
+                                                  ) -> None:
+    poller.bot.errors = {3: error}
+    with pytest.raises(type(error)):
+        poll(poller, [event(n) for n in range(1, 5)])
+    assert cursor(poller) == (2, '"1"')
+
+    poller.bot.errors = {}
+    assert poll(poller, [event(n) for n in range(1, 5)])
+    assert poller.bot.webhook.sent == [2, 3, 4]
+
+
+def test_deleted_target_is_skipped(poller: EventPoller) -> None:
+    poller.bot.errors = {3: GitlabNotFound(404, "404 Issue Not Found")}
+    assert poll(poller, [event(n) for n in range(1, 5)])
+    assert poller.bot.webhook.sent == [2, 4]
+    assert cursor(poller) == (4, '"4"')
@@ -0,0 +1,50 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from sqlalchemy import create_engine
+import pytest
+
+from gitlab_matrix.search import SearchDocument, SearchIndex
+
+SERVER = "http://gitlab"
+
+
+@pytest.fixture
+def index() -> SearchIndex:
+    index = SearchIndex(create_engine("sqlite://"))
+    if not index.enabled:
+        pytest.skip("SQLite was built without FTS5")
+    return index
+
+
+def doc(ref: str, title: str) -> SearchDocument:
+    return SearchDocument("issue", ref, f"{SERVER}/group/repo/-/issues/{ref}", title, "")
+
+
+def test_search_only_sees_own_room(index: SearchIndex) -> None:
+    index.add("!a:example.com", SERVER, "group/repo", [doc("1", "Crash on startup")])
+    index.add("!b:example.com", SERVER, "group/secret", [doc("2", "Crash in billing")])
+    results = index.search("!a:example.com", "crash")
+    assert [(r.project, r.ref) for r in results] == [("group/repo", "1")]
+    assert index.search("!a:example.com", "crash", project="group/secret") == []
+    assert index.search("!c:example.com", "crash") == []
+
+
+def test_same_document_in_two_rooms(index: SearchIndex) -> None:
+    for room_id in ("!a:example.com", "!b:example.com"):
+        index.add(room_id, SERVER, "group/repo", [doc("1", "Crash on startup")])
+    index.add("!a:example.com", SERVER, "group/repo", [doc("1", "Crash on shutdown")])
+    assert [r.title for r in index.search("!a:example.com", "crash")] == ["Crash on shutdown"]
+    assert [r.title for r in index.search("!b:example.com", "crash")] == ["Crash on startup"]
@@ -0,0 +1,62 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+import pytest
+
+from gitlab_matrix.api import APIIssue
+from gitlab_matrix.db import Database, IssueState
+from gitlab_matrix.store import IssueStore
+
+SERVER = "http://gitlab"
+ISSUE = {"id": 10, "iid": 1, "project_id": 1, "title": "Bug", "state": "opened",
+         "web_url": "http://gitlab/group/repo/-/issues/1",
+         "author": {"id": 1, "name": "Alice", "username": "alice"},
+         "created_at": "2021-01-01T00:00:00+00:00", "updated_at": "2021-01-01T00:00:00+00:00"}
+
+
+@pytest.fixture
+def db() -> Database:
+    return Database(create_engine("sqlite://"))
+
+
+def age(db: Database, seconds: float) -> None:
+    s = db.Session()
+    for state in s.query(IssueState).all():
+        state.stored_at = datetime.utcnow() - timedelta(seconds=seconds)
+    s.commit()
+
+
+def test_api_rows_expire_sooner_than_webhook_rows(db: Database) -> None:
+    store = IssueStore(db, max_age=3600, api_max_age=60)
+    store.put_issue(SERVER, APIIssue.deserialize(ISSUE))
+    assert store.get_issue(SERVER, "group/repo", 1).title == "Bug"
+    age(db, 120)
+    assert store.get_issue(SERVER, "group/repo", 1) is None
+
+    store._put(SERVER, "issue", {**ISSUE, "title": "Hooked"},
+               APIIssue.deserialize(ISSUE).updated_at, from_webhook=True)
+    age(db, 120)
+    assert store.get_issue(SERVER, 1, 1).title == "Hooked"
+    age(db, 7200)
+    assert store.get_issue(SERVER, 1, 1) is None
+
+
+def test_confidential_issues_are_not_served(db: Database) -> None:
+    store = IssueStore(db, max_age=3600, api_max_age=60)
+    store.put_issue(SERVER, APIIssue.deserialize({**ISSUE, "confidential": True}))
+    assert store.get_issue(SERVER, "group/repo", 1) is None
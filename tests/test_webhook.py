@@ -0,0 +1,104 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from types import SimpleNamespace
+import asyncio
+import logging
+import time
+
+from mautrix.types import TextMessageEventContent
+
+from gitlab_matrix.webhook import GitlabWebhook, DigestEntry
+
+ROOM = "!room:example.com"
+
+
+class StuckSender:
+    async def redact(self, room_id: str, event_id: str, priority: int) -> None:
+        await asyncio.sleep(60)
+
+
+class RecordingSender:
+    def __init__(self) -> None:
+        self.sent = []
+
+    async def send_message(self, room_id: str, content: TextMessageEventContent, priority: int,
+                           txn_id: str) -> str:
+        self.sent.append(content.body)
+        return f"${len(self.sent)}"
+
+
+def make_webhook(sender, **config) -> GitlabWebhook:
+    webhook = GitlabWebhook.__new__(GitlabWebhook)
+    webhook.bot = SimpleNamespace(log=logging.getLogger("test"), sender=sender, config=config,
+                                  client=SimpleNamespace(api=SimpleNamespace(get_txn_id=str)),
+                                  db=SimpleNamespace(put_event=lambda *_: None))
+    webhook.task_list, webhook.digests, webhook.reactions = [], {}, {}
+    webhook.redaction_task = None
+    webhook.redactions = []
+    # Without a digest template, combined digests fail to render.
+    webhook.messages = {}
+    return webhook
+
+
+def entry(n: int) -> DigestEntry:
+    content = TextMessageEventContent(body=f"update {n}")
+    content["xyz.maubot.gitlab.webhook"] = {"event_type": "Push Hook"}
+    return DigestEntry("x" * 1000, content, None)
+
+
+def test_full_digest_is_sent_early() -> None:
+    async def test() -> None:
+        webhook = make_webhook(RecordingSender(), **{"digest.max_size": 3000})
+        await webhook.add_to_digest(ROOM, 60, entry(1))
+        await webhook.add_to_digest(ROOM, 60, entry(2))
+        assert webhook.bot.sender.sent == ["update 1"]
+        assert [e.content.body for e in webhook.digests[ROOM].entries] == ["update 2"]
+        webhook.digests[ROOM].task.cancel()
+
+    asyncio.run(test())
+
+
+def test_failed_digest_is_sent_separately() -> None:
+    async def test() -> None:
+        webhook = make_webhook(RecordingSender(), **{"digest.max_size": 10000})
+        for n in range(3):
+            await webhook.add_to_digest(ROOM, 60, entry(n))
+        await webhook.send_digest(ROOM)
+        assert webhook.bot.sender.sent == ["update 0", "update 1", "update 2"]
+
+    asyncio.run(test())
+
+
+def test_stop_gives_up_on_slow_redactions(caplog) -> None:
+    webhook = make_webhook(StuckSender())
+    webhook.redactions = [(ROOM, "$reaction")]
+    start = time.monotonic()
+    with caplog.at_level(logging.WARNING):
+        asyncio.run(webhook.stop())
+    assert time.monotonic() - start < 5
+    assert f"$reaction in {ROOM}" in caplog.text
+
+
+def test_stop_cancels_slow_flushes() -> None:
+    async def test() -> None:
+        webhook = make_webhook(StuckSender())
+        stuck = asyncio.create_task(asyncio.sleep(60))
+        webhook.reactions = {(ROOM, "job"): SimpleNamespace(flush=asyncio.Event(), task=stuck)}
+        await webhook.stop()
+        await asyncio.sleep(0)
+        assert stuck.cancelled()
+
+    asyncio.run(test())
@@ -0,0 +1,76 @@
+# gitlab - A GitLab client and webhook receiver for maubot
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from types import SimpleNamespace
+import asyncio
+import logging
+
+from sqlalchemy import create_engine
+import pytest
+
+from gitlab_matrix.api import APIHook, APIProject, GitlabError
+from gitlab_matrix.commands.webhook import CommandWebhook, glob_to_regex
+from gitlab_matrix.db import Database, WebhookToken
+
+
+@pytest.mark.parametrize("pattern,path,matches", [
+    ("group/*", "group/repo", True),
+    ("group/*", "group/sub/repo", False),
+    ("group/**", "group/sub/repo", True),
+    ("group/*/repo", "group/sub/repo", True),
+    ("group/re?o", "group/repo", True),
+    ("group/re?o", "group/re/o", False),
+    ("group/[a-r]*", "group/repo", True),
+    ("group/[!a-r]*", "group/web", True),
+    ("Group/Repo.*", "group/repo.js", True),
+    ("group/repo.*", "group/repoXjs", False),
+])
+def test_glob_to_regex(pattern: str, path: str, matches: bool) -> None:
+    assert bool(glob_to_regex(pattern).match(path)) == matches
+
+
+class FakeGitlab:
+    def __init__(self, fail: bool) -> None:
+        self.fail = fail
+        self.scheduler = SimpleNamespace(concurrency=2)
+
+    async def create_project_hook(self, project: int, hook: dict) -> APIHook:
+        if self.fail:
+            raise GitlabError(422, "Invalid url given")
+        return APIHook(id=project, url=hook["url"])
+
+
+def tokens(cmd: CommandWebhook) -> int:
+    return cmd.bot.db.Session().query(WebhookToken).count()
+
+
+@pytest.mark.parametrize("fail,expected_tokens", [(True, 0), (False, 1)])
+def test_token_is_only_kept_if_a_hook_was_created(fail: bool, expected_tokens: int) -> None:
+    async def test() -> None:
+        replies = []
+
+        async def reply(text: str) -> None:
+            replies.append(text)
+
+        cmd = CommandWebhook(SimpleNamespace(db=Database(create_engine("sqlite://")),
+                                             webapp_url="http://bot", log=logging.getLogger()))
+        evt = SimpleNamespace(room_id="!room:example.com", reply=reply)
+        projects = [APIProject(id=n, path_with_namespace=f"group/{n}", web_url="")
+                    for n in range(3)]
+        await cmd._add_project_hooks(evt, FakeGitlab(fail), projects)
+        assert tokens(cmd) == expected_tokens
+        assert replies[0].startswith(f"Added webhooks for {3 - 3 * fail} of 3 projects")
+
+    asyncio.run(test())